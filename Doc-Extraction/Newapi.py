@@ -4,10 +4,21 @@ import uuid
 import time
 import logging
 import numpy as np
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 from flask_cors import CORS
 from werkzeug.utils import secure_filename
-from deepface import DeepFace
+import archive
+import cache
+import frames
+import pipeline
+import profiling
+import embedding_store
+import jobs
+import metrics
+import ocr
+import registry
+import shm_transport
+import upload_io
 
 # Configure logging
 logging.basicConfig(level=logging.INFO,
@@ -16,37 +27,67 @@ logger = logging.getLogger(__name__)
 
 # Initialize Flask app
 app = Flask(__name__)
+app.request_class = upload_io.InMemoryRequest
 CORS(app, resources={r"/*": {"origins": "*"}})
+metrics.init_app(app)
 
 # Configuration
 UPLOAD_FOLDER = 'uploads'
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'}
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB limit
+app.config['ARCHIVE_UPLOADS'] = True  # Keep uploads in the deduplicated archive under uploads/archive
+
+archive_store = archive.ArchiveStore(os.path.join(UPLOAD_FOLDER, 'archive'))
+archive_writer = upload_io.ArchiveWriter(sink=archive_store.store)
+job_runner = jobs.JobRunner()
+profiler = profiling.Profiler(app)
 
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
+# Load and warm the configured models before serving the first request
+registry.preload()
+registry.init_app(app)
+
+def archive_upload(role, filename, data, ids, timestamp, digest=None):
+    # Queued for the background writer. Returns the content digest the upload is
+    # archived under (read it back with archive.py or ArchiveStore.read), or None
+    # when archiving is off or the write was dropped; blobs may be LZ4 compressed,
+    # so responses carry digests rather than file paths
+    if not app.config['ARCHIVE_UPLOADS']:
+        return None
+    digest = digest or archive_store.digest(data)
+    queued = archive_writer.submit(
+        dict(ids, role=role, filename=secure_filename(filename), created=int(timestamp), digest=digest),
+        data
+    )
+    return digest if queued else None
+
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def verify_face(selfie_path, document_path, model_name="Facenet", distance_metric="cosine"):
+def verify_face(selfie, document, model_name="Facenet", distance_metric="cosine", stages=None):
     try:
-        if not os.path.isfile(selfie_path):
-            return False, 0, "Selfie image not found"
-        if not os.path.isfile(document_path):
-            return False, 0, "Document image not found"
-
-        result = DeepFace.verify(
-            img1_path=selfie_path,
-            img2_path=document_path,
-            model_name=model_name,
-            distance_metric=distance_metric,
-            enforce_detection=False
-        )
-
-        verified = result["verified"]
-        distance = result["distance"]
-        threshold_value = result.get("threshold", 0.4)
+        if selfie["error"]:
+            return False, 0, f"Error during face verification: {selfie['error']}"
+        if document["error"]:
+            return False, 0, f"Error during face verification: {document['error']}"
+
+        if model_name == pipeline.CASCADE:
+            verified, distance, threshold_value, cascade = pipeline.cascade_analyses(
+                selfie,
+                document,
+                distance_metric=distance_metric
+            )
+            if stages is not None:
+                stages.extend(cascade)
+        else:
+            verified, distance, threshold_value = pipeline.compare_analyses(
+                selfie,
+                document,
+                model_name=model_name,
+                distance_metric=distance_metric
+            )
 
         similarity = (1 - distance) * 100 if distance_metric == "cosine" \
             else max(0, (1 - (distance / (threshold_value * 2))) * 100)
@@ -56,35 +97,63 @@ def verify_face(selfie_path, document_path, model_name="Facenet", distance_metri
     except Exception as e:
         return False, 0, f"Error during face verification: {str(e)}"
 
-def extract_faces_info(image_path):
-    try:
-        faces = DeepFace.extract_faces(image_path, enforce_detection=False)
-
-        if not faces:
-            return {"faces_detected": 0, "message": "No faces detected"}
-
-        faces_info = []
-        for i, face in enumerate(faces):
-            area = face.get('facial_area', {})
-            faces_info.append({
-                "face_id": i + 1,
-                "confidence": face.get('confidence', 0),
-                "position": {
-                    "x": area.get('x', 0),
-                    "y": area.get('y', 0),
-                    "width": area.get('w', 0),
-                    "height": area.get('h', 0)
-                }
-            })
+def extract_faces_info(analysis):
+    if analysis["error"]:
+        return {"faces_detected": 0, "message": f"Error: {analysis['error']}"}
+
+    faces = analysis["faces"]
+    if not faces:
+        return {"faces_detected": 0, "message": "No faces detected"}
+
+    faces_info = []
+    for i, face in enumerate(faces):
+        area = face.get('facial_area', {})
+        faces_info.append({
+            "face_id": i + 1,
+            "confidence": face.get('confidence', 0),
+            "position": {
+                "x": area.get('x', 0),
+                "y": area.get('y', 0),
+                "width": area.get('w', 0),
+                "height": area.get('h', 0)
+            }
+        })
 
-        return {
-            "faces_detected": len(faces),
-            "faces": faces_info
-        }
+    return {
+        "faces_detected": len(faces),
+        "faces": faces_info
+    }
 
-    except Exception as e:
-        logger.error(f"Error extracting faces: {str(e)}")
-        return {"faces_detected": 0, "message": f"Error: {str(e)}"}
+def verification_response(selfie, document, model_name="Facenet", fields=None):
+    stages = []
+    verified, similarity, error = verify_face(selfie, document, model_name=model_name, stages=stages)
+
+    response = {
+        'verified': verified,
+        'similarity': round(similarity, 2),
+        'match': similarity >= 75.0,
+        'threshold': 75.0,
+        'model_used': stages[-1]['model'] if stages else model_name,
+        'selfie_analysis': extract_faces_info(selfie),
+        'document_analysis': extract_faces_info(document)
+    }
+
+    if stages:
+        response['cascade'] = stages
+
+    if fields is not None:
+        response['document_fields'] = ocr.result(fields)
+
+    if error:
+        response['error'] = error
+
+    return response
+
+def verify_pair(selfie_bytes, document_bytes, model_name="Facenet", extract_fields=ocr.OCR_ENABLED):
+    document = pipeline.analyze_image(document_bytes, localize_portrait=True, keep_image=extract_fields)
+    fields = ocr.submit(document, document_bytes) if extract_fields else None
+    selfie = pipeline.analyze_image(selfie_bytes)
+    return verification_response(selfie, document, model_name=model_name, fields=fields)
 
 @app.route('/')
 def index():
@@ -93,8 +162,16 @@ def index():
         "status": "active",
         "endpoints": {
             "/verify": "POST - Verify face match between selfie and document",
+            "/verify/stream": "POST - Verify selfie frames or a video against a document",
+            "/verify/batch": "POST - Verify many selfie/document pairs",
+            "/jobs/<job_id>": "GET - Status and results of a batch job",
             "/detect": "POST - Detect faces in an image",
-            "/models": "GET - List available models"
+            "/enroll": "POST - Store the document face embedding of a user",
+            "/verify/<user_id>": "POST - Verify a selfie against an enrolled user",
+            "/identify": "POST - Find the enrolled users closest to a face",
+            "/models": "GET - List available models",
+            "/stats": "GET - Inference scheduler and cache statistics",
+            "/metrics": "GET - Prometheus metrics"
         }
     })
 
@@ -112,6 +189,16 @@ def verify_faces():
     if not (allowed_file(selfie_file.filename) and allowed_file(document_file.filename)):
         return jsonify({'error': 'Only .png, .jpg, .jpeg files are allowed'}), 400
 
+    model_name = request.form.get('model_name', 'Facenet')
+    if not registry.known_model(model_name):
+        return jsonify({'error': f'Unknown model: {model_name}'}), 400
+
+    try:
+        selfie_bytes = upload_io.read_upload(selfie_file)
+        document_bytes = upload_io.read_upload(document_file)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
     try:
         # Auto-generate UUIDs
         user_id = str(uuid.uuid4())
@@ -119,48 +206,34 @@ def verify_faces():
         client_id = str(uuid.uuid4())
         timestamp = str(int(time.time()))
 
-        # Create directory: uploads/<user_id>/<timestamp>
-        user_dir = os.path.join(app.config['UPLOAD_FOLDER'], user_id, timestamp)
-        os.makedirs(user_dir, exist_ok=True)
+        # Single detection pass per image, shared by verification, analysis and OCR;
+        # the document fields are read while the selfie is analyzed
+        extract_fields = request.form.get('ocr', '1' if ocr.OCR_ENABLED else '0') == '1'
+        document = pipeline.analyze_image(document_bytes, localize_portrait=True, keep_image=extract_fields)
+        fields = ocr.submit(document, document_bytes) if extract_fields else None
+        selfie = pipeline.analyze_image(selfie_bytes)
 
-        # Save files
-        selfie_filename = secure_filename("selfie_" + selfie_file.filename)
-        document_filename = secure_filename("document_" + document_file.filename)
-        selfie_path = os.path.join(user_dir, selfie_filename)
-        document_path = os.path.join(user_dir, document_filename)
-        selfie_file.save(selfie_path)
-        document_file.save(document_path)
+        # Archive off the request path, reusing the content hashes of the analyses
+        ids = {'user_id': user_id, 'lead_id': lead_id, 'client_id': client_id}
+        selfie_digest = archive_upload('selfie', selfie_file.filename, selfie_bytes, ids, timestamp, selfie["digest"])
+        document_digest = archive_upload('document', document_file.filename, document_bytes, ids, timestamp,
+                                         document["digest"])
 
-        # Face verification
-        model_name = request.form.get('model_name', 'Facenet')
-        verified, similarity, error = verify_face(selfie_path, document_path, model_name=model_name)
+        # Face verification and detection info
+        response = verification_response(selfie, document, model_name=model_name, fields=fields)
 
-        # Face detection
-        selfie_faces = extract_faces_info(selfie_path)
-        document_faces = extract_faces_info(document_path)
-
-        response = {
-            'verified': verified,
-            'similarity': round(similarity, 2),
-            'match': similarity >= 75.0,
-            'threshold': 75.0,
-            'model_used': model_name,
+        response.update({
             'generated_ids': {
                 'user_id': user_id,
                 'lead_id': lead_id,
                 'client_id': client_id
             },
             'timestamp': timestamp,
-            'selfie_analysis': selfie_faces,
-            'document_analysis': document_faces,
-            'image_paths': {
-                'selfie': selfie_path,
-                'document': document_path
+            'archived': {
+                'selfie': selfie_digest,
+                'document': document_digest
             }
-        }
-
-        if error:
-            response['error'] = error
+        })
 
         return jsonify(response)
 
@@ -168,6 +241,87 @@ def verify_faces():
         logger.error(f"Error in verification process: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/verify/stream', methods=['POST'])
+def verify_stream():
+    if 'document' not in request.files or not ('frames' in request.files or 'video' in request.files):
+        return jsonify({'error': 'A document image and selfie frames or a video are required'}), 400
+
+    document_file = request.files['document']
+    frame_files = request.files.getlist('frames')
+    video_file = request.files.get('video')
+
+    if not allowed_file(document_file.filename) or not all(allowed_file(f.filename) for f in frame_files):
+        return jsonify({'error': 'Only .png, .jpg, .jpeg files are allowed'}), 400
+    if video_file is not None and video_file.filename.rsplit('.', 1)[-1].lower() not in frames.VIDEO_EXTENSIONS:
+        return jsonify({'error': 'Only .mp4, .mov, .webm, .avi videos are allowed'}), 400
+
+    model_name = request.form.get('model_name', 'Facenet')
+    if not registry.known_model(model_name):
+        return jsonify({'error': f'Unknown model: {model_name}'}), 400
+    if model_name == pipeline.CASCADE:
+        return jsonify({'error': 'Frame streams are verified with a single model'}), 400
+
+    try:
+        document_bytes = upload_io.read_upload(document_file)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    try:
+        document = pipeline.analyze_image(document_bytes, localize_portrait=True)
+        if video_file is not None:
+            selfie_frames = frames.video_frames(video_file.read())
+        else:
+            selfie_frames = frames.image_frames(f.read() for f in frame_files)
+
+        verified, distance, threshold_value, report = frames.verify_frames(selfie_frames, document, model_name)
+        similarity = (1 - distance) * 100
+
+        return jsonify({
+            'verified': bool(verified),
+            'similarity': round(similarity, 2),
+            'match': similarity >= 75.0,
+            'threshold': 75.0,
+            'model_used': model_name,
+            'document_analysis': extract_faces_info(document),
+            'frames': report
+        })
+
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 422
+    except Exception as e:
+        logger.error(f"Error in streaming verification process: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/verify/batch', methods=['POST'])
+def verify_batch():
+    body = (request.get_json(silent=True) if request.is_json else request.form) or {}
+    model_name = body.get('model_name', 'Facenet')
+    mode = request.args.get('mode', body.get('mode', 'stream'))
+    if not registry.known_model(model_name):
+        return jsonify({'error': f'Unknown model: {model_name}'}), 400
+
+    # Multipart selfie/document lists, or a JSON manifest of paths under uploads/
+    try:
+        pairs = jobs.parse_pairs(request, app.config['UPLOAD_FOLDER'], allowed_file)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    def run_pair(selfie_bytes, document_bytes):
+        return verify_pair(selfie_bytes, document_bytes, model_name=model_name)
+
+    if mode == 'job':
+        job_id = job_runner.submit(pairs, run_pair)
+        return jsonify({'job_id': job_id, 'status_url': f'/jobs/{job_id}', 'total': len(pairs)}), 202
+
+    return Response(job_runner.stream_ndjson(pairs, run_pair), mimetype='application/x-ndjson')
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job = job_runner.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job)
+
 @app.route('/detect', methods=['POST'])
 def detect_faces():
     if 'image' not in request.files:
@@ -182,18 +336,12 @@ def detect_faces():
         return jsonify({'error': 'Only .png, .jpg, .jpeg files are allowed'}), 400
 
     try:
-        timestamp = str(int(time.time()))
-        image_filename = secure_filename(f"{timestamp}_{image_file.filename}")
-        image_path = os.path.join(app.config['UPLOAD_FOLDER'], image_filename)
-        image_file.save(image_path)
-
-        faces_info = extract_faces_info(image_path)
+        image_bytes = upload_io.read_upload(image_file)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
 
-        # Optional: delete the file after processing
-        try:
-            os.remove(image_path)
-        except Exception as e:
-            logger.warning(f"Failed to remove temporary file: {str(e)}")
+    try:
+        faces_info = extract_faces_info(pipeline.analyze_image(image_bytes))
 
         return jsonify(faces_info)
 
@@ -201,12 +349,215 @@ def detect_faces():
         logger.error(f"Error in face detection process: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/enroll', methods=['POST'])
+def enroll_user():
+    if 'document' not in request.files:
+        return jsonify({'error': 'Document image is required'}), 400
+
+    document_file = request.files['document']
+
+    if document_file.filename == '':
+        return jsonify({'error': 'No selected file'}), 400
+
+    if not allowed_file(document_file.filename):
+        return jsonify({'error': 'Only .png, .jpg, .jpeg files are allowed'}), 400
+
+    model_name = request.form.get('model_name', 'Facenet')
+    if not registry.known_model(model_name):
+        return jsonify({'error': f'Unknown model: {model_name}'}), 400
+    if model_name == pipeline.CASCADE:
+        return jsonify({'error': 'Enrolled embeddings are stored per model, choose a single model'}), 400
+
+    try:
+        document_bytes = upload_io.read_upload(document_file)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    try:
+        user_id = request.form.get('user_id') or str(uuid.uuid4())
+        timestamp = str(int(time.time()))
+
+        document = pipeline.analyze_image(document_bytes, localize_portrait=True)
+        document_faces = extract_faces_info(document)
+        face_index = pipeline.primary_face(document)
+        if document["error"] or face_index is None:
+            return jsonify({'error': 'No face found in document', 'document_analysis': document_faces}), 422
+
+        # Embed once; later verifications of this user only embed the selfie
+        embedding = pipeline.embed_analysis(document, model_name)[face_index]
+        embedding_store.get_store(model_name).add(user_id, embedding)
+
+        document_digest = archive_upload('document', document_file.filename, document_bytes,
+                                         {'user_id': user_id}, timestamp, document["digest"])
+
+        return jsonify({
+            'user_id': user_id,
+            'enrolled': True,
+            'model_used': model_name,
+            'timestamp': timestamp,
+            'document_analysis': document_faces,
+            'archived': {
+                'document': document_digest
+            }
+        })
+
+    except Exception as e:
+        logger.error(f"Error in enrollment process: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/verify/<user_id>', methods=['POST'])
+def verify_enrolled(user_id):
+    if 'selfie' not in request.files:
+        return jsonify({'error': 'Selfie image is required'}), 400
+
+    selfie_file = request.files['selfie']
+
+    if selfie_file.filename == '':
+        return jsonify({'error': 'No selected file'}), 400
+
+    if not allowed_file(selfie_file.filename):
+        return jsonify({'error': 'Only .png, .jpg, .jpeg files are allowed'}), 400
+
+    model_name = request.form.get('model_name', 'Facenet')
+    if not registry.known_model(model_name):
+        return jsonify({'error': f'Unknown model: {model_name}'}), 400
+    if model_name == pipeline.CASCADE:
+        return jsonify({'error': 'Enrolled embeddings are stored per model, choose a single model'}), 400
+    stored = embedding_store.get_store(model_name).get(user_id)
+    if stored is None:
+        return jsonify({'error': f'User {user_id} is not enrolled for {model_name}'}), 404
+
+    try:
+        selfie_bytes = upload_io.read_upload(selfie_file)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    try:
+        selfie = pipeline.analyze_image(selfie_bytes)
+        document = pipeline.enrolled_analysis(stored, model_name)
+
+        # Stored embeddings are L2-normalized, which cosine distance is invariant to
+        verified, similarity, error = verify_face(selfie, document, model_name=model_name)
+
+        response = {
+            'verified': verified,
+            'similarity': round(similarity, 2),
+            'match': similarity >= 75.0,
+            'threshold': 75.0,
+            'model_used': model_name,
+            'user_id': user_id,
+            'selfie_analysis': extract_faces_info(selfie)
+        }
+
+        if error:
+            response['error'] = error
+
+        return jsonify(response)
+
+    except Exception as e:
+        logger.error(f"Error in verification process: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/identify', methods=['POST'])
+def identify_face():
+    if 'image' not in request.files:
+        return jsonify({'error': 'Image file is required'}), 400
+
+    image_file = request.files['image']
+
+    if image_file.filename == '':
+        return jsonify({'error': 'No selected file'}), 400
+
+    if not allowed_file(image_file.filename):
+        return jsonify({'error': 'Only .png, .jpg, .jpeg files are allowed'}), 400
+
+    model_name = request.form.get('model_name', 'Facenet')
+    if not registry.known_model(model_name):
+        return jsonify({'error': f'Unknown model: {model_name}'}), 400
+    if model_name == pipeline.CASCADE:
+        return jsonify({'error': 'Enrolled embeddings are stored per model, choose a single model'}), 400
+
+    try:
+        top_k = int(request.form.get('top_k', 5))
+        image_bytes = upload_io.read_upload(image_file)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    try:
+        probe = pipeline.analyze_image(image_bytes)
+        probe_faces = extract_faces_info(probe)
+        face_index = pipeline.primary_face(probe)
+        if probe["error"] or face_index is None:
+            return jsonify({'error': 'No face found in image', 'probe_analysis': probe_faces}), 422
+
+        store = embedding_store.get_store(model_name)
+        embedding = pipeline.embed_analysis(probe, model_name)[face_index]
+        results, method = store.search(embedding, k=top_k)
+        threshold_value = pipeline.find_threshold(model_name, 'cosine')
+
+        return jsonify({
+            'model_used': model_name,
+            'gallery_size': len(store),
+            'search_method': method,
+            'probe_analysis': probe_faces,
+            'matches': [
+                {
+                    'user_id': user_id,
+                    'distance': round(distance, 4),
+                    'similarity': round((1 - distance) * 100, 2),
+                    'verified': distance <= threshold_value
+                }
+                for user_id, distance in results
+            ]
+        })
+
+    except Exception as e:
+        logger.error(f"Error in identification process: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/models', methods=['GET'])
 def list_models():
     return jsonify({
-        'available_models': ['Facenet', 'VGG-Face', 'OpenFace', 'DeepFace', 'ArcFace', 'Dlib'],
-        'default_model': 'Facenet'
+        'available_models': registry.AVAILABLE_MODELS,
+        'default_model': registry.DEFAULT_MODEL,
+        'cascade_models': pipeline.CASCADE_MODELS,
+        'loaded_models': registry.model_stats(),
+        'worker_profile': registry.WORKER_PROFILE
+    })
+
+@app.route('/stats', methods=['GET'])
+def service_stats():
+    return jsonify({
+        'batching': pipeline.batcher.stats() if pipeline.batcher else None,
+        'cache': cache.stats(),
+        'inference_pool': shm_transport.stats(),
+        'archive': archive_store.stats()
     })
 
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/admin/profile', methods=['GET', 'POST', 'DELETE'])
+def profile_requests():
+    if not profiling.authorized(request.headers.get('X-Profile-Token')):
+        return jsonify({'error': 'Not found'}), 404
+
+    if request.method == 'POST':
+        body = (request.get_json(silent=True) if request.is_json else request.form) or {}
+        try:
+            profiler.arm(
+                mode=body.get('mode', 'sample'),
+                requests=int(body.get('requests', 1)),
+                interval_ms=float(body.get('interval_ms', profiling.SAMPLE_INTERVAL_MS))
+            )
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+    elif request.method == 'DELETE':
+        profiler.disarm()
+
+    return jsonify(profiler.status())
+
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    # Development server only; use serve.py in production
+    app.run(host='0.0.0.0', port=5000, debug=os.environ.get('FLASK_DEBUG', '1') == '1')
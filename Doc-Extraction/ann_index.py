@@ -0,0 +1,87 @@
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def _top_k(scores, k):
+    """Indices of the k highest scores, best first"""
+    k = min(k, scores.shape[0])
+    if k <= 0:
+        return np.zeros(0, dtype=np.int64)
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.argsort(-scores[top])]
+
+
+def exact_search(matrix, probe, k=5):
+    """
+    Brute-force cosine search over L2-normalized rows.
+    A single matrix-vector product scores the whole gallery.
+    Returns (row indices, cosine distances) best first.
+    """
+    scores = np.asarray(matrix, dtype=np.float32) @ probe
+    top = _top_k(scores, k)
+    return top, 1.0 - scores[top]
+
+
+class IVFIndex:
+    """
+    Inverted-file index over L2-normalized embeddings, in pure NumPy.
+    Rows are assigned to the nearest of n_lists k-means centroids; a query
+    only scores the rows of its n_probe closest lists.
+    """
+
+    def __init__(self, n_lists=None, n_probe=8, iterations=10, seed=0):
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.iterations = iterations
+        self.seed = seed
+        self.centroids = None
+        self.lists = []
+        self.size = 0
+
+    def build(self, matrix):
+        """Cluster the first len(matrix) rows; rows appended later are not indexed"""
+        matrix = np.asarray(matrix, dtype=np.float32)
+        self.size = matrix.shape[0]
+        n_lists = self.n_lists or max(1, int(np.sqrt(self.size)))
+        rng = np.random.default_rng(self.seed)
+
+        # Spherical k-means on a sample keeps the build cheap for large galleries
+        sample = matrix[rng.choice(self.size, size=min(self.size, n_lists * 64), replace=False)]
+        centroids = sample[rng.choice(sample.shape[0], size=n_lists, replace=False)]
+        for _ in range(self.iterations):
+            assignment = np.argmax(sample @ centroids.T, axis=1)
+            for i in range(n_lists):
+                members = sample[assignment == i]
+                if len(members):
+                    centroid = members.sum(axis=0)
+                    centroids[i] = centroid / max(np.linalg.norm(centroid), 1e-12)
+
+        self.centroids = centroids
+        assignment = np.empty(self.size, dtype=np.int64)
+        for start in range(0, self.size, 65536):
+            block = matrix[start:start + 65536]
+            assignment[start:start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+        self.lists = [np.flatnonzero(assignment == i) for i in range(n_lists)]
+        logger.info(f"Built IVF index over {self.size} embeddings with {n_lists} lists")
+        return self
+
+    def update(self, row, vector):
+        """Move an indexed row whose vector was replaced to its nearest list"""
+        if row >= self.size:
+            return
+        self.lists = [members[members != row] for members in self.lists]
+        nearest = int(np.argmax(self.centroids @ vector))
+        self.lists[nearest] = np.sort(np.append(self.lists[nearest], row))
+
+    def search(self, matrix, probe, k=5):
+        """Approximate top-k over the indexed rows; returns (row indices, cosine distances)"""
+        nearest_lists = _top_k(self.centroids @ probe, self.n_probe)
+        candidates = np.sort(np.concatenate([self.lists[i] for i in nearest_lists]))
+        if candidates.size == 0:
+            return candidates, np.zeros(0, dtype=np.float32)
+        scores = np.asarray(matrix[candidates], dtype=np.float32) @ probe
+        top = _top_k(scores, k)
+        return candidates[top], 1.0 - scores[top]
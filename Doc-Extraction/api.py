@@ -1,11 +1,20 @@
 import os
 import cv2
 import numpy as np
-from deepface import DeepFace
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 from werkzeug.utils import secure_filename
 import logging
 from flask_cors import CORS
+import cache
+import frames
+import jobs
+import metrics
+import ocr
+import pipeline
+import profiling
+import registry
+import shm_transport
+import upload_io
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, 
@@ -14,52 +23,83 @@ logger = logging.getLogger(__name__)
 
 # Initialize Flask app
 app = Flask(__name__)
+app.request_class = upload_io.InMemoryRequest
 CORS(app, resources={r"/*": {"origins": "*"}})
 
+# Per-route latency histograms and the optional per-request 'timings' block
+metrics.init_app(app)
+
 # Configuration
 UPLOAD_FOLDER = 'uploads'
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'}
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # Limit upload size to 16MB
+app.config['ARCHIVE_UPLOADS'] = False  # Persist uploads asynchronously for auditing
+
+# Background writer used only when ARCHIVE_UPLOADS is enabled
+archive_writer = upload_io.ArchiveWriter()
+
+# Shared worker pool for /verify/batch
+job_runner = jobs.JobRunner()
+
+# On-demand profiler for the next N requests, armed through /admin/profile
+profiler = profiling.Profiler(app)
 
 # Create upload directory if it doesn't exist
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
+# Load and warm the configured models before serving the first request;
+# detect-only workers (FACE_WORKER_PROFILE=detect) load just their detector
+registry.preload()
+registry.init_app(app)
+
+def archive_upload(filename, data):
+    """Queue an upload for asynchronous archival if enabled"""
+    if not app.config['ARCHIVE_UPLOADS']:
+        return
+    import time
+    timestamp = str(int(time.time()))
+    filename = f"{timestamp}_{secure_filename(filename)}"
+    archive_writer.submit(os.path.join(app.config['UPLOAD_FOLDER'], filename), data)
+
 def allowed_file(filename):
     """Check if the file extension is allowed"""
     return '.' in filename and \
         filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def verify_face(selfie_path, document_path, model_name="Facenet", distance_metric="cosine"):
+def verify_face(selfie, document, model_name="Facenet", distance_metric="cosine", stages=None):
     """
-    Compare faces between a selfie and document image using DeepFace.
+    Compare faces between an analyzed selfie and document image.
     Returns verification result and similarity score.
+    With model_name 'cascade', the models that ran are appended to stages.
     """
     try:
-        # Check if files exist
-        if not os.path.isfile(selfie_path):
-            logger.error(f"Selfie image not found: {selfie_path}")
-            return False, 0, "Selfie image not found"
-            
-        if not os.path.isfile(document_path):
-            logger.error(f"Document image not found: {document_path}")
-            return False, 0, "Document image not found"
+        # Detection failures are reported once, by analyze_image
+        if selfie["error"]:
+            return False, 0, f"Error during face verification: {selfie['error']}"
+
+        if document["error"]:
+            return False, 0, f"Error during face verification: {document['error']}"
         
         logger.info(f"Analyzing images using {model_name}...")
         
-        # Perform verification
-        result = DeepFace.verify(
-            img1_path=selfie_path,
-            img2_path=document_path,
-            model_name=model_name,
-            distance_metric=distance_metric,
-            enforce_detection=False  # Set to False to avoid errors if face detection fails
-        )
-        
-        # Extract results
-        verified = result["verified"]
-        distance = result["distance"]
-        threshold_value = result.get("threshold", 0.4)
+        # Embed the already detected faces and compare them
+        if model_name == pipeline.CASCADE:
+            # Cheap model first; stronger ones only when the decision is close
+            verified, distance, threshold_value, cascade = pipeline.cascade_analyses(
+                selfie,
+                document,
+                distance_metric=distance_metric
+            )
+            if stages is not None:
+                stages.extend(cascade)
+        else:
+            verified, distance, threshold_value = pipeline.compare_analyses(
+                selfie,
+                document,
+                model_name=model_name,
+                distance_metric=distance_metric
+            )
         
         # Calculate similarity percentage (inverse of distance)
         if distance_metric == "cosine":
@@ -78,42 +118,92 @@ def verify_face(selfie_path, document_path, model_name="Facenet", distance_metri
         logger.error(error_msg)
         return False, 0, error_msg
 
-def extract_faces_info(image_path):
+def extract_faces_info(analysis):
     """
-    Extract face detection information from an image
+    Build face detection information from an analyzed image
     Returns a dictionary with face detection data
     """
-    try:
-        # Extract faces using DeepFace
-        faces = DeepFace.extract_faces(image_path, enforce_detection=False)
+    if analysis["error"]:
+        return {"faces_detected": 0, "message": f"Error: {analysis['error']}"}
+
+    faces = analysis["faces"]
+    if not faces:
+        return {"faces_detected": 0, "message": "No faces detected"}
         
-        if not faces:
-            return {"faces_detected": 0, "message": "No faces detected"}
-            
-        # Return face detection information
-        faces_info = []
-        for i, face in enumerate(faces):
-            facial_area = face.get('facial_area', {})
-            face_info = {
-                "face_id": i + 1,
-                "confidence": face.get('confidence', 0),
-                "position": {
-                    "x": facial_area.get('x', 0),
-                    "y": facial_area.get('y', 0),
-                    "width": facial_area.get('w', 0),
-                    "height": facial_area.get('h', 0)
-                }
+    # Return face detection information
+    faces_info = []
+    for i, face in enumerate(faces):
+        facial_area = face.get('facial_area', {})
+        face_info = {
+            "face_id": i + 1,
+            "confidence": face.get('confidence', 0),
+            "position": {
+                "x": facial_area.get('x', 0),
+                "y": facial_area.get('y', 0),
+                "width": facial_area.get('w', 0),
+                "height": facial_area.get('h', 0)
             }
-            faces_info.append(face_info)
-        
-        return {
-            "faces_detected": len(faces),
-            "faces": faces_info
         }
-        
-    except Exception as e:
-        logger.error(f"Error extracting faces: {str(e)}")
-        return {"faces_detected": 0, "message": f"Error: {str(e)}"}
+        faces_info.append(face_info)
+    
+    return {
+        "faces_detected": len(faces),
+        "faces": faces_info
+    }
+
+def verification_response(selfie, document, model_name="Facenet", fields=None):
+    """
+    Verify two analyzed images and build the /verify response body
+    fields is a pending OCR extraction of the document, if one was started
+    """
+    # Perform face verification on the detected faces
+    stages = []
+    verified, similarity, error = verify_face(
+        selfie, 
+        document, 
+        model_name=model_name,
+        stages=stages
+    )
+    
+    # Get face detection info from the same detections
+    selfie_faces = extract_faces_info(selfie)
+    document_faces = extract_faces_info(document)
+    
+    # Create response
+    response = {
+        'verified': verified,
+        'similarity': round(similarity, 2),
+        'selfie_analysis': selfie_faces,
+        'document_analysis': document_faces,
+        'threshold': 75.0,  # Default threshold
+        'match': similarity >= 75.0,
+        # A cascade reports the model that made the decision, and every stage that ran
+        'model_used': stages[-1]['model'] if stages else model_name
+    }
+    
+    if stages:
+        response['cascade'] = stages
+    
+    # OCR ran alongside the embedding; only its result is waited for here
+    if fields is not None:
+        response['document_fields'] = ocr.result(fields)
+    
+    if error:
+        response['error'] = error
+    
+    return response
+
+def verify_pair(selfie_bytes, document_bytes, model_name="Facenet", extract_fields=ocr.OCR_ENABLED):
+    """
+    Decode, analyze and verify one selfie/document pair of encoded images
+    With extract_fields, the document is decoded once at full resolution and
+    the Aadhaar fields are read from that array on the OCR executor while
+    the faces are embedded.
+    """
+    document = pipeline.analyze_image(document_bytes, localize_portrait=True, keep_image=extract_fields)
+    fields = ocr.submit(document, document_bytes) if extract_fields else None
+    selfie = pipeline.analyze_image(selfie_bytes)
+    return verification_response(selfie, document, model_name=model_name, fields=fields)
 
 @app.route('/')
 def index():
@@ -123,7 +213,12 @@ def index():
         "status": "active",
         "endpoints": {
             "/verify": "POST - Verify face match between selfie and document",
-            "/detect": "POST - Detect faces in an image"
+            "/verify/stream": "POST - Verify selfie frames or a video against a document",
+            "/verify/batch": "POST - Verify many selfie/document pairs",
+            "/jobs/<job_id>": "GET - Status and results of a batch job",
+            "/detect": "POST - Detect faces in an image",
+            "/stats": "GET - Inference scheduler and cache statistics",
+            "/metrics": "GET - Prometheus metrics"
         }
     })
 
@@ -134,7 +229,8 @@ def verify_faces():
     Expects form data with:
     - selfie: image file
     - document: image file
-    - model_name: (optional) name of the face recognition model
+    - model_name: (optional) name of the face recognition model, or 'cascade'
+    - ocr: (optional) '1' to also extract the Aadhaar fields of the document
     """
     # Check if the request has the file parts
     if 'selfie' not in request.files or 'document' not in request.files:
@@ -152,65 +248,140 @@ def verify_faces():
             document_file and allowed_file(document_file.filename)):
         return jsonify({'error': 'Only .png, .jpg, .jpeg files are allowed'}), 400
     
-    # Get optional model name parameter
+    # Get optional model name and OCR parameters
     model_name = request.form.get('model_name', 'Facenet')
+    if not registry.known_model(model_name):
+        return jsonify({'error': f'Unknown model: {model_name}'}), 400
+    extract_fields = request.form.get('ocr', '1' if ocr.OCR_ENABLED else '0') == '1'
+    
+    # Read the uploads straight from the request buffer
+    try:
+        selfie_bytes = upload_io.read_upload(selfie_file)
+        document_bytes = upload_io.read_upload(document_file)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     
     try:
-        # Save the files to the upload folder
-        selfie_filename = secure_filename(selfie_file.filename)
-        document_filename = secure_filename(document_file.filename)
+        archive_upload(selfie_file.filename, selfie_bytes)
+        archive_upload(document_file.filename, document_bytes)
         
-        # Make filenames unique by prepending timestamp
-        import time
-        timestamp = str(int(time.time()))
-        selfie_filename = f"{timestamp}_{selfie_filename}"
-        document_filename = f"{timestamp}_{document_filename}"
+        # Detect each image once
+        return jsonify(verify_pair(selfie_bytes, document_bytes, model_name=model_name,
+                                   extract_fields=extract_fields))
         
-        selfie_path = os.path.join(app.config['UPLOAD_FOLDER'], selfie_filename)
-        document_path = os.path.join(app.config['UPLOAD_FOLDER'], document_filename)
+    except Exception as e:
+        # Return error message
+        logger.error(f"Error in verification process: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/verify/stream', methods=['POST'])
+def verify_stream():
+    """
+    API endpoint to verify a burst of selfie frames or a short selfie video
+    against a document, stopping as soon as the decision is clear
+    Expects form data with:
+    - document: image file
+    - frames: image files, in capture order
+    or
+    - video: video file (.mp4, .mov, .webm, .avi)
+    - model_name: (optional) name of the face recognition model
+    """
+    if 'document' not in request.files or not ('frames' in request.files or 'video' in request.files):
+        return jsonify({'error': 'A document image and selfie frames or a video are required'}), 400
+    
+    document_file = request.files['document']
+    frame_files = request.files.getlist('frames')
+    video_file = request.files.get('video')
+    
+    # Check if files are allowed
+    if not allowed_file(document_file.filename) or not all(allowed_file(f.filename) for f in frame_files):
+        return jsonify({'error': 'Only .png, .jpg, .jpeg files are allowed'}), 400
+    if video_file is not None and video_file.filename.rsplit('.', 1)[-1].lower() not in frames.VIDEO_EXTENSIONS:
+        return jsonify({'error': 'Only .mp4, .mov, .webm, .avi videos are allowed'}), 400
+    
+    model_name = request.form.get('model_name', 'Facenet')
+    if not registry.known_model(model_name):
+        return jsonify({'error': f'Unknown model: {model_name}'}), 400
+    if model_name == pipeline.CASCADE:
+        return jsonify({'error': 'Frame streams are verified with a single model'}), 400
+    
+    try:
+        document_bytes = upload_io.read_upload(document_file)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    try:
+        document = pipeline.analyze_image(document_bytes, localize_portrait=True)
         
-        selfie_file.save(selfie_path)
-        document_file.save(document_path)
+        # Frames are decoded lazily, so an early decision skips the rest of the upload
+        if video_file is not None:
+            selfie_frames = frames.video_frames(video_file.read())
+        else:
+            selfie_frames = frames.image_frames(f.read() for f in frame_files)
         
-        # Perform face verification
-        verified, similarity, error = verify_face(
-            selfie_path, 
-            document_path, 
+        verified, distance, threshold_value, report = frames.verify_frames(
+            selfie_frames,
+            document,
             model_name=model_name
         )
+        similarity = (1 - distance) * 100
         
-        # Get face detection info
-        selfie_faces = extract_faces_info(selfie_path)
-        document_faces = extract_faces_info(document_path)
-        
-        # Create response
-        response = {
-            'verified': verified,
+        return jsonify({
+            'verified': bool(verified),
             'similarity': round(similarity, 2),
-            'selfie_analysis': selfie_faces,
-            'document_analysis': document_faces,
-            'threshold': 75.0,  # Default threshold
+            'threshold': 75.0,
             'match': similarity >= 75.0,
-            'model_used': model_name
-        }
-        
-        if error:
-            response['error'] = error
-            
-        # Clean up files after processing
-        try:
-            os.remove(selfie_path)
-            os.remove(document_path)
-        except Exception as e:
-            logger.warning(f"Failed to remove temporary files: {str(e)}")
-            
-        return jsonify(response)
-        
+            'model_used': model_name,
+            'document_analysis': extract_faces_info(document),
+            'frames': report
+        })
+    
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 422
     except Exception as e:
-        # Return error message
-        logger.error(f"Error in verification process: {str(e)}")
+        logger.error(f"Error in streaming verification process: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/verify/batch', methods=['POST'])
+def verify_batch():
+    """
+    API endpoint to verify many selfie/document pairs in one request
+    Expects either form data with:
+    - selfie: image files
+    - document: image files, matched to the selfies by position
+    or a JSON manifest {"pairs": [{"id", "selfie", "document"}]} with paths
+    relative to the upload folder.
+    - model_name: (optional) name of the face recognition model
+    - mode: (optional) 'stream' for NDJSON results (default) or 'job'
+    """
+    body = (request.get_json(silent=True) if request.is_json else request.form) or {}
+    model_name = body.get('model_name', 'Facenet')
+    mode = request.args.get('mode', body.get('mode', 'stream'))
+    if not registry.known_model(model_name):
+        return jsonify({'error': f'Unknown model: {model_name}'}), 400
+    
+    try:
+        pairs = jobs.parse_pairs(request, app.config['UPLOAD_FOLDER'], allowed_file)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    def run_pair(selfie_bytes, document_bytes):
+        return verify_pair(selfie_bytes, document_bytes, model_name=model_name)
+    
+    if mode == 'job':
+        job_id = job_runner.submit(pairs, run_pair)
+        return jsonify({'job_id': job_id, 'status_url': f'/jobs/{job_id}', 'total': len(pairs)}), 202
+    
+    return Response(job_runner.stream_ndjson(pairs, run_pair), mimetype='application/x-ndjson')
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """Status and results of a batch verification job"""
+    job = job_runner.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job)
+
 @app.route('/detect', methods=['POST'])
 def detect_faces():
     """
@@ -232,25 +403,17 @@ def detect_faces():
     if not (image_file and allowed_file(image_file.filename)):
         return jsonify({'error': 'Only .png, .jpg, .jpeg files are allowed'}), 400
     
+    # Read the upload straight from the request buffer
     try:
-        # Save the file to the upload folder
-        image_filename = secure_filename(image_file.filename)
-        
-        # Make filename unique by prepending timestamp
-        import time
-        timestamp = str(int(time.time()))
-        image_filename = f"{timestamp}_{image_filename}"
+        image_bytes = upload_io.read_upload(image_file)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    try:
+        archive_upload(image_file.filename, image_bytes)
         
-        image_path = os.path.join(app.config['UPLOAD_FOLDER'], image_filename)
-        image_file.save(image_path)
         # Get face detection info
-        faces_info = extract_faces_info(image_path)
-        
-        # Clean up file after processing
-        try:
-            os.remove(image_path)
-        except Exception as e:
-            logger.warning(f"Failed to remove temporary file: {str(e)}")
+        faces_info = extract_faces_info(pipeline.analyze_image(image_bytes))
             
         return jsonify(faces_info)
         
@@ -262,12 +425,57 @@ def detect_faces():
 @app.route('/models', methods=['GET'])
 def list_models():
     """List available face recognition models"""
-    available_models = ['Facenet', 'VGG-Face', 'OpenFace', 'DeepFace', 'ArcFace', 'Dlib']
     return jsonify({
-        'available_models': available_models,
-        'default_model': 'Facenet'
+        'available_models': registry.AVAILABLE_MODELS,
+        'default_model': registry.DEFAULT_MODEL,
+        'cascade_models': pipeline.CASCADE_MODELS,
+        'loaded_models': registry.model_stats(),
+        'worker_profile': registry.WORKER_PROFILE
+    })
+
+@app.route('/stats', methods=['GET'])
+def service_stats():
+    """Runtime statistics of the inference scheduler and caches"""
+    return jsonify({
+        'batching': pipeline.batcher.stats() if pipeline.batcher else None,
+        'cache': cache.stats(),
+        'inference_pool': shm_transport.stats()
     })
 
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Stage and request latency histograms in the Prometheus text format"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/admin/profile', methods=['GET', 'POST', 'DELETE'])
+def profile_requests():
+    """
+    Profile the next requests served by this worker
+    Requires the X-Profile-Token header to match FACE_PROFILE_TOKEN.
+    POST form or JSON data:
+    - mode: (optional) 'sample' for collapsed stacks (default) or 'cprofile' for pstats
+    - requests: (optional) number of requests to profile, default 1
+    - interval_ms: (optional) sampling interval
+    GET returns the profiler status, DELETE disarms it.
+    """
+    if not profiling.authorized(request.headers.get('X-Profile-Token')):
+        return jsonify({'error': 'Not found'}), 404
+    
+    if request.method == 'POST':
+        body = (request.get_json(silent=True) if request.is_json else request.form) or {}
+        try:
+            profiler.arm(
+                mode=body.get('mode', 'sample'),
+                requests=int(body.get('requests', 1)),
+                interval_ms=float(body.get('interval_ms', profiling.SAMPLE_INTERVAL_MS))
+            )
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+    elif request.method == 'DELETE':
+        profiler.disarm()
+    
+    return jsonify(profiler.status())
+
 if __name__ == '__main__':
-    # Run the Flask app on port 5000
-    app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
+    # Run the Flask development server on port 5000; use serve.py in production
+    app.run(host='0.0.0.0', port=5000, debug=os.environ.get('FLASK_DEBUG', '1') == '1')
\ No newline at end of file
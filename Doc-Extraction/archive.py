@@ -0,0 +1,256 @@
+import os
+import sys
+import time
+import sqlite3
+import hashlib
+import logging
+import argparse
+from contextlib import contextmanager
+
+import lz4.frame
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_FOLDER = os.environ.get('FACE_ARCHIVE_DIR', os.path.join('uploads', 'archive'))
+# Records older than this are evicted, and blobs no record points at are deleted; 0 keeps everything
+RETENTION_DAYS = float(os.environ.get('FACE_ARCHIVE_RETENTION_DAYS', '90'))
+EVICT_INTERVAL = 3600
+# Compressed blobs are kept only when they save at least this fraction;
+# JPEGs are already entropy coded, PNG/BMP uploads usually shrink
+MIN_COMPRESSION_SAVING = 0.05
+LZ4_MAGIC = b'\x04\x22\x4d\x18'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS blobs (
+    digest TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    stored_size INTEGER NOT NULL,
+    codec TEXT NOT NULL,
+    created INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS records (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id TEXT,
+    lead_id TEXT,
+    client_id TEXT,
+    role TEXT NOT NULL,
+    filename TEXT,
+    digest TEXT NOT NULL REFERENCES blobs(digest),
+    created INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS records_user ON records(user_id);
+CREATE INDEX IF NOT EXISTS records_lead ON records(lead_id);
+CREATE INDEX IF NOT EXISTS records_client ON records(client_id);
+CREATE INDEX IF NOT EXISTS records_created ON records(created);
+"""
+
+
+def unpack(data):
+    """Original bytes of a blob as stored on disk"""
+    if data[:4] == LZ4_MAGIC:
+        return lz4.frame.decompress(data)
+    return data
+
+
+class ArchiveStore:
+    """
+    Content-addressed archive of uploaded images.
+    Each distinct image is stored once under blobs/<2 hex>/<sha256>,
+    LZ4-compressed when that pays off, and index.sqlite3 maps
+    user_id/lead_id/client_id to the blobs of each upload.
+    Safe to share between worker processes on one node.
+    """
+
+    def __init__(self, root=ARCHIVE_FOLDER, retention_days=RETENTION_DAYS):
+        self.root = root
+        self.retention_days = retention_days
+        self.index_path = os.path.join(root, 'index.sqlite3')
+        self._last_eviction = 0.0
+        os.makedirs(os.path.join(root, 'blobs'), exist_ok=True)
+        with self._connect() as db:
+            db.executescript(SCHEMA)
+
+    @contextmanager
+    def _connect(self):
+        """Short-lived connection per operation, committed and closed on exit"""
+        db = sqlite3.connect(self.index_path, timeout=30)
+        try:
+            db.execute('PRAGMA journal_mode=WAL')
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    @contextmanager
+    def _write(self):
+        """
+        Connection holding the index write lock until committed. Storing and
+        evicting both run under it, so a blob cannot be deleted between being
+        found on disk and gaining the record that keeps it.
+        """
+        with self._connect() as db:
+            db.execute('BEGIN IMMEDIATE')
+            yield db
+
+    @staticmethod
+    def digest(data):
+        return hashlib.sha256(data).hexdigest()
+
+    def blob_path(self, digest):
+        return os.path.join(self.root, 'blobs', digest[:2], digest)
+
+    def put(self, data, digest=None, created=None):
+        """Store bytes once per content; returns the digest"""
+        with self._write() as db:
+            return self._put(db, data, digest, created)
+
+    def _put(self, db, data, digest, created):
+        digest = digest or self.digest(data)
+        path = self.blob_path(digest)
+        if os.path.exists(path):
+            return digest
+
+        compressed = lz4.frame.compress(data)
+        if len(compressed) <= len(data) * (1 - MIN_COMPRESSION_SAVING):
+            stored, codec = compressed, 'lz4'
+        else:
+            stored, codec = data, 'raw'
+
+        # Write then rename, so readers and other workers never see a partial blob
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(stored)
+        os.replace(tmp_path, path)
+        db.execute(
+            'INSERT OR IGNORE INTO blobs (digest, size, stored_size, codec, created) VALUES (?, ?, ?, ?, ?)',
+            (digest, len(data), len(stored), codec, int(created or time.time()))
+        )
+        return digest
+
+    def store(self, record, data):
+        """
+        Archive one upload. record holds role, filename, created and any of
+        user_id/lead_id/client_id; used as the ArchiveWriter sink.
+        """
+        created = int(record.get('created') or time.time())
+        with self._write() as db:
+            digest = self._put(db, data, record.get('digest'), created)
+            db.execute(
+                'INSERT INTO records (user_id, lead_id, client_id, role, filename, digest, created) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (record.get('user_id'), record.get('lead_id'), record.get('client_id'), record['role'],
+                 record.get('filename'), digest, created)
+            )
+        if self.retention_days and time.time() - self._last_eviction > EVICT_INTERVAL:
+            self.evict()
+        return digest
+
+    def read(self, digest):
+        with open(self.blob_path(digest), 'rb') as f:
+            return unpack(f.read())
+
+    def find(self, user_id=None, lead_id=None, client_id=None):
+        """Archived uploads matching every given id, newest first"""
+        clauses, params = [], []
+        for column, value in (('user_id', user_id), ('lead_id', lead_id), ('client_id', client_id)):
+            if value is not None:
+                clauses.append(f"{column} = ?")
+                params.append(value)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ''
+        with self._connect() as db:
+            db.row_factory = sqlite3.Row
+            rows = db.execute(f"SELECT * FROM records {where} ORDER BY created DESC, id DESC", params)
+            return [dict(row) for row in rows]
+
+    def evict(self, now=None):
+        """Drop records past retention and the blobs nothing refers to any more"""
+        now = now or time.time()
+        self._last_eviction = now
+        if not self.retention_days:
+            return 0
+        cutoff = int(now - self.retention_days * 86400)
+        with self._write() as db:
+            db.execute('DELETE FROM records WHERE created < ?', (cutoff,))
+            orphans = [row[0] for row in db.execute(
+                'SELECT digest FROM blobs WHERE created < ? AND digest NOT IN (SELECT digest FROM records)',
+                (cutoff,)
+            )]
+            db.executemany('DELETE FROM blobs WHERE digest = ?', [(digest,) for digest in orphans])
+            # Files go while the lock is held, before a store could find them again
+            for digest in orphans:
+                try:
+                    os.remove(self.blob_path(digest))
+                except FileNotFoundError:
+                    pass
+        if orphans:
+            logger.info(f"Evicted {len(orphans)} archived blobs older than {self.retention_days} days")
+        return len(orphans)
+
+    def stats(self):
+        with self._connect() as db:
+            blobs, size, stored = db.execute(
+                'SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(stored_size), 0) FROM blobs'
+            ).fetchone()
+            records, = db.execute('SELECT COUNT(*) FROM records').fetchone()
+        return {
+            "records": records,
+            "blobs": blobs,
+            "size_mb": round(size / (1024 * 1024), 2),
+            "stored_mb": round(stored / (1024 * 1024), 2)
+        }
+
+
+def import_legacy(store, upload_folder, remove=False):
+    """
+    Move uploads/<user_id>/<timestamp>/<role>_<name> directories written by
+    earlier versions of Newapi.py into the archive
+    """
+    imported = 0
+    for user_id in sorted(os.listdir(upload_folder)):
+        user_dir = os.path.join(upload_folder, user_id)
+        if not os.path.isdir(user_dir) or os.path.abspath(user_dir) == os.path.abspath(store.root):
+            continue
+        for timestamp in sorted(os.listdir(user_dir)):
+            upload_dir = os.path.join(user_dir, timestamp)
+            if not os.path.isdir(upload_dir) or not timestamp.isdigit():
+                continue
+            for filename in sorted(os.listdir(upload_dir)):
+                path = os.path.join(upload_dir, filename)
+                role, _, name = filename.partition('_')
+                with open(path, 'rb') as f:
+                    store.store({
+                        'user_id': user_id,
+                        'role': role if name else 'upload',
+                        'filename': name or filename,
+                        'created': int(timestamp)
+                    }, f.read())
+                imported += 1
+                if remove:
+                    os.remove(path)
+            if remove and not os.listdir(upload_dir):
+                os.rmdir(upload_dir)
+        if remove and not os.listdir(user_dir):
+            os.rmdir(user_dir)
+    return imported
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Maintain the upload archive")
+    parser.add_argument("command", choices=["stats", "evict", "import"])
+    parser.add_argument("--root", default=ARCHIVE_FOLDER, help="Archive directory")
+    parser.add_argument("--uploads", default="uploads", help="Legacy per-request upload folder to import")
+    parser.add_argument("--remove", action="store_true", help="Delete legacy files once imported")
+    args = parser.parse_args()
+
+    store = ArchiveStore(args.root)
+    if args.command == 'evict':
+        print(f"Evicted {store.evict()} blobs")
+    elif args.command == 'import':
+        print(f"Imported {import_legacy(store, args.uploads, remove=args.remove)} files")
+    print(store.stats())
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    main()
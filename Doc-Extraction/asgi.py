@@ -0,0 +1,301 @@
+import os
+import math
+import time
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.formparsers import MultiPartException, MultiPartParser
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse
+from starlette.routing import Mount, Route
+
+import api
+import metrics
+import ocr
+import pipeline
+import registry
+
+logger = logging.getLogger(__name__)
+
+# CPU-bound inference slots, and how many admitted requests may wait for one
+INFERENCE_WORKERS = int(os.environ.get('FACE_ASGI_WORKERS', str(os.cpu_count() or 2)))
+INFERENCE_QUEUE = int(os.environ.get('FACE_ASGI_QUEUE', str(2 * INFERENCE_WORKERS)))
+MAX_CONTENT_LENGTH = api.app.config['MAX_CONTENT_LENGTH']
+
+
+class Overloaded(Exception):
+    def __init__(self, retry_after):
+        super().__init__("Server is at capacity")
+        self.retry_after = retry_after
+
+
+class TooLarge(Exception):
+    pass
+
+
+class InMemoryMultiPartParser(MultiPartParser):
+    """
+    Multipart parser that keeps file parts in memory, like
+    upload_io.InMemoryRequest does for Flask. Starlette spools parts above
+    1MB to temporary files; bodies are capped at MAX_CONTENT_LENGTH while
+    they are read, so buffering them in memory is bounded.
+    """
+    spool_max_size = MAX_CONTENT_LENGTH
+
+
+class BoundedExecutor:
+    """
+    Thread pool with admission control for CPU-bound inference.
+    At most max_workers jobs run and max_queue more wait; beyond that,
+    requests are rejected up front instead of piling up until clients time out.
+    """
+
+    def __init__(self, max_workers=INFERENCE_WORKERS, max_queue=INFERENCE_QUEUE):
+        self.max_workers = max_workers
+        self.capacity = max_workers + max_queue
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='inference')
+        self._admitted = 0
+        self._service_time = 1.0  # EWMA of seconds per job
+        self.rejected = 0
+
+    def admit(self):
+        """Reserve a slot for a request; raises Overloaded when full"""
+        if self._admitted >= self.capacity:
+            self.rejected += 1
+            # Time for the current backlog to drain
+            raise Overloaded(max(1, math.ceil(self._admitted / self.max_workers * self._service_time)))
+        self._admitted += 1
+
+    def release(self):
+        self._admitted -= 1
+
+    async def run(self, fn, *args):
+        """Run fn on the pool from an admitted request"""
+        start = time.perf_counter()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+        finally:
+            self._service_time = 0.9 * self._service_time + 0.1 * (time.perf_counter() - start)
+
+    def stats(self):
+        return {
+            "admitted": self._admitted,
+            "capacity": self.capacity,
+            "rejected": self.rejected,
+            "service_time_seconds": round(self._service_time, 3)
+        }
+
+
+executor = BoundedExecutor()
+metrics.register('face_inference_admitted', 'Requests running or waiting for an inference slot',
+                 lambda: {(): executor.stats()["admitted"]})
+metrics.register('face_inference_rejected_total', 'Requests rejected with 503 at capacity',
+                 lambda: {(): executor.rejected}, kind='counter')
+
+
+def respond(body, status=200, headers=None):
+    # CORS headers, and preflight requests, are handled by CORSMiddleware
+    return JSONResponse(body, status_code=status, headers=headers)
+
+
+def error(message, status):
+    return respond({'error': message}, status)
+
+
+async def read_files(form, *names):
+    """
+    Return the named files' bytes from a parsed multipart form.
+    Returns a JSONResponse instead when validation fails, with the same
+    messages as the Flask views.
+    """
+    uploads = [form.get(name) for name in names]
+    if any(upload is None or isinstance(upload, str) for upload in uploads):
+        if len(names) == 1:
+            return error('Image file is required', 400)
+        return error('Both selfie and document images are required', 400)
+    if any(upload.filename == '' for upload in uploads):
+        return error('No selected files' if len(names) > 1 else 'No selected file', 400)
+    if not all(api.allowed_file(upload.filename) for upload in uploads):
+        return error('Only .png, .jpg, .jpeg files are allowed', 400)
+
+    contents = [await upload.read() for upload in uploads]
+    try:
+        for data in contents:
+            pipeline.image_header(data)
+    except ValueError as e:
+        return error(str(e), 400)
+    return contents
+
+
+def overloaded(e):
+    return respond({'error': str(e)}, 503, headers={'Retry-After': str(e.retry_after)})
+
+
+def too_large(request):
+    return int(request.headers.get('content-length') or 0) > MAX_CONTENT_LENGTH
+
+
+async def limited_stream(request):
+    """The request body, failing once more than MAX_CONTENT_LENGTH has arrived (chunked uploads)"""
+    received = 0
+    async for chunk in request.stream():
+        received += len(chunk)
+        if received > MAX_CONTENT_LENGTH:
+            raise TooLarge()
+        yield chunk
+
+
+@asynccontextmanager
+async def read_form(request):
+    """Parse a multipart body without touching the disk; files are closed on exit"""
+    form = await InMemoryMultiPartParser(request.headers, limited_stream(request)).parse()
+    try:
+        yield form
+    finally:
+        await form.close()
+
+
+def wants_timings(request, form):
+    return '1' in (request.query_params.get('timings'), request.headers.get('x-timings'), form.get('timings'))
+
+
+def instrumented(route, collect_timings, fn, *args):
+    """
+    Run fn on an inference thread with its stages labeled by route,
+    adding the per-request timings block when it was asked for
+    """
+    metrics.start_request(route, collect_timings=collect_timings)
+    # These routes bypass the Flask app, so the profiler is applied here
+    result = api.profiler.call(route, fn, *args)
+    timings = metrics.request_timings()
+    if timings is not None:
+        result = dict(result, timings=timings)
+    return result
+
+
+def observe(request, start, status):
+    path = request.url.path
+    metrics.request_duration.observe(time.perf_counter() - start, (path, request.method))
+    metrics.requests_total.inc((path, request.method, str(status)))
+
+
+async def verify(request):
+    if not registry.serves_recognition():
+        return error('This worker only serves face detection', 503)
+    start = time.perf_counter()
+    try:
+        executor.admit()
+    except Overloaded as e:
+        observe(request, start, 503)
+        return overloaded(e)
+    response = None
+    try:
+        if too_large(request):
+            response = error('Request is too large', 413)
+            return response
+
+        # Uploads are streamed in and buffered in memory by the multipart parser
+        async with read_form(request) as form:
+            parsed = await read_files(form, 'selfie', 'document')
+            model_name = form.get('model_name') or 'Facenet'
+            extract_fields = (form.get('ocr') or ('1' if ocr.OCR_ENABLED else '0')) == '1'
+            collect_timings = wants_timings(request, form)
+        if isinstance(parsed, JSONResponse):
+            response = parsed
+            return response
+        if not registry.known_model(model_name):
+            response = error(f'Unknown model: {model_name}', 400)
+            return response
+        selfie_bytes, document_bytes = parsed
+
+        response = respond(await executor.run(
+            instrumented, '/verify', collect_timings, api.verify_pair, selfie_bytes, document_bytes, model_name,
+            extract_fields
+        ))
+        return response
+    except TooLarge:
+        response = error('Request is too large', 413)
+        return response
+    except MultiPartException as e:
+        response = error(e.message, 400)
+        return response
+    except Exception as e:
+        logger.error(f"Error in verification process: {str(e)}")
+        response = error(str(e), 500)
+        return response
+    finally:
+        executor.release()
+        observe(request, start, response.status_code if response is not None else 500)
+
+
+def _detect(image_bytes):
+    return api.extract_faces_info(pipeline.analyze_image(image_bytes))
+
+
+async def detect(request):
+    start = time.perf_counter()
+    try:
+        executor.admit()
+    except Overloaded as e:
+        observe(request, start, 503)
+        return overloaded(e)
+    response = None
+    try:
+        if too_large(request):
+            response = error('Request is too large', 413)
+            return response
+
+        async with read_form(request) as form:
+            parsed = await read_files(form, 'image')
+            collect_timings = wants_timings(request, form)
+        if isinstance(parsed, JSONResponse):
+            response = parsed
+            return response
+        image_bytes, = parsed
+
+        response = respond(await executor.run(instrumented, '/detect', collect_timings, _detect, image_bytes))
+        return response
+    except TooLarge:
+        response = error('Request is too large', 413)
+        return response
+    except MultiPartException as e:
+        response = error(e.message, 400)
+        return response
+    except Exception as e:
+        logger.error(f"Error in face detection process: {str(e)}")
+        response = error(str(e), 500)
+        return response
+    finally:
+        executor.release()
+        observe(request, start, response.status_code if response is not None else 500)
+
+
+async def admission_stats(request):
+    return respond(executor.stats())
+
+
+# /verify and /detect are served natively; every other route falls through to Flask.
+# CORS matches the Flask app's flask_cors setup, including preflight requests
+# for the native routes.
+app = Starlette(
+    routes=[
+        Route('/verify', verify, methods=['POST']),
+        Route('/detect', detect, methods=['POST']),
+        Route('/admission', admission_stats, methods=['GET']),
+        Mount('/', app=WSGIMiddleware(api.app))
+    ],
+    middleware=[
+        Middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*'],
+                   expose_headers=['Retry-After'])
+    ]
+)
+
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(app, host='0.0.0.0', port=5000)
@@ -0,0 +1,102 @@
+import os
+import time
+import queue
+import logging
+import threading
+from concurrent.futures import Future
+
+logger = logging.getLogger(__name__)
+
+BATCHING_ENABLED = os.environ.get('FACE_BATCHING', '1') == '1'
+MAX_WAIT_MS = float(os.environ.get('FACE_BATCH_MAX_WAIT_MS', '5'))
+MAX_BATCH_SIZE = int(os.environ.get('FACE_BATCH_MAX_SIZE', '16'))
+
+
+class EmbeddingBatcher:
+    """
+    Dynamic micro-batching scheduler for embedding requests.
+    Face crops submitted by concurrent requests are queued per model, and a
+    worker thread per model collects them for up to max_wait_ms or
+    max_batch_size items, runs a single forward(model_name, faces) call and
+    resolves each caller's future with its own embedding.
+    """
+
+    def __init__(self, forward, max_wait_ms=MAX_WAIT_MS, max_batch_size=MAX_BATCH_SIZE):
+        self.forward = forward
+        self.max_wait = max_wait_ms / 1000.0
+        self.max_batch_size = max(1, max_batch_size)
+        self._queues = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def _queue_for(self, model_name):
+        with self._lock:
+            if model_name not in self._queues:
+                self._queues[model_name] = queue.Queue()
+                self._histograms[model_name] = {}
+                threading.Thread(
+                    target=self._run,
+                    args=(model_name,),
+                    name=f"batcher-{model_name}",
+                    daemon=True
+                ).start()
+            return self._queues[model_name]
+
+    def submit(self, model_name, face):
+        """Queue one face crop; returns a Future resolving to its embedding"""
+        future = Future()
+        self._queue_for(model_name).put((face, future))
+        return future
+
+    def embed(self, model_name, faces):
+        """Embed a list of face crops, blocking until every one is done"""
+        futures = [self.submit(model_name, face) for face in faces]
+        return [future.result() for future in futures]
+
+    def _collect(self, pending):
+        batch = [pending.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(pending.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self, model_name):
+        pending = self._queues[model_name]
+        while True:
+            batch = self._collect(pending)
+            with self._lock:
+                histogram = self._histograms[model_name]
+                histogram[len(batch)] = histogram.get(len(batch), 0) + 1
+
+            faces = [face for face, _ in batch]
+            try:
+                embeddings = self.forward(model_name, faces)
+                if len(embeddings) != len(batch):
+                    raise RuntimeError(f"{model_name} returned {len(embeddings)} embeddings for {len(batch)} faces")
+                for (_, future), embedding in zip(batch, embeddings):
+                    future.set_result(embedding)
+            except Exception as e:
+                logger.error(f"Batched embedding failed for {model_name}: {str(e)}")
+                for _, future in batch:
+                    future.set_exception(e)
+
+    def stats(self):
+        """Queue depth and batch-size histogram per model"""
+        with self._lock:
+            return {
+                model_name: {
+                    "queue_depth": self._queues[model_name].qsize(),
+                    "batches": sum(self._histograms[model_name].values()),
+                    "batch_size_histogram": {
+                        str(size): count
+                        for size, count in sorted(self._histograms[model_name].items())
+                    }
+                }
+                for model_name in self._queues
+            }
@@ -0,0 +1,195 @@
+import os
+import sys
+import glob
+import json
+import time
+import platform
+import resource
+import argparse
+
+# Measure raw inference: no cache hits, no batching wait, no startup preload
+os.environ.setdefault('FACE_CACHE', '0')
+os.environ.setdefault('FACE_BATCHING', '0')
+os.environ.setdefault('FACE_PRELOAD_MODELS', '')
+os.environ.setdefault('FACE_PRELOAD_DETECTORS', '')
+
+import numpy as np
+from deepface import DeepFace
+
+import pipeline
+import registry
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def fixture_paths():
+    """Bundled sample images and the uploads/ fixtures"""
+    patterns = ['sample_image*.png', 'sample_image*.jpg', 'image.png', 'uploads/**/*.jpg',
+                'uploads/**/*.jpeg', 'uploads/**/*.png']
+    paths = []
+    for pattern in patterns:
+        paths.extend(sorted(glob.glob(os.path.join(HERE, pattern), recursive=True)))
+    return paths
+
+
+def peak_rss_mb():
+    # ru_maxrss is KB on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def measure(fn, inputs, iterations, warmup):
+    """Run fn over the inputs; returns latency percentiles in ms and throughput"""
+    for i in range(warmup):
+        fn(inputs[i % len(inputs)])
+    samples = []
+    start = time.perf_counter()
+    for i in range(iterations):
+        t0 = time.perf_counter()
+        fn(inputs[i % len(inputs)])
+        samples.append((time.perf_counter() - t0) * 1000)
+    elapsed = time.perf_counter() - start
+    return {
+        "iterations": iterations,
+        "p50_ms": round(float(np.percentile(samples, 50)), 3),
+        "p95_ms": round(float(np.percentile(samples, 95)), 3),
+        "p99_ms": round(float(np.percentile(samples, 99)), 3),
+        "mean_ms": round(float(np.mean(samples)), 3),
+        "throughput_per_s": round(iterations / elapsed, 3) if elapsed else None,
+        "peak_rss_mb": peak_rss_mb()
+    }
+
+
+def run_stages(images, encoded, backends, models, iterations, warmup):
+    results = {}
+    # The request path decodes at reduced resolution
+    results["decode"] = measure(pipeline.decode_scaled, encoded, iterations, warmup)
+
+    faces = None
+    for backend in backends:
+        def detect(img, align):
+            return DeepFace.extract_faces(img, detector_backend=backend,
+                                          enforce_detection=False, align=align)
+        try:
+            results[f"detect:{backend}"] = measure(lambda img: detect(img, False), images, iterations, warmup)
+            results[f"detect_align:{backend}"] = measure(lambda img: detect(img, True), images, iterations, warmup)
+            results[f"align:{backend}"] = {
+                "p50_ms": round(results[f"detect_align:{backend}"]["p50_ms"] - results[f"detect:{backend}"]["p50_ms"], 3)
+            }
+            if faces is None:
+                faces = [detect(img, True)[0]["face"] for img in images]
+        except Exception as e:
+            results[f"detect:{backend}"] = {"error": str(e)}
+
+    if faces is None:
+        return results
+
+    embeddings = []
+    for model_name in models:
+        # Models without cached weights are skipped rather than downloaded, so the benchmark runs offline
+        if not registry.weights_cached(model_name):
+            results[f"embed:{model_name}"] = {"skipped": "weights not cached"}
+            continue
+        try:
+            results[f"embed:{model_name}"] = measure(
+                lambda face: pipeline.forward_batch(model_name, [face]), faces, iterations, warmup
+            )
+            if not embeddings:
+                embeddings = [pipeline.forward_batch(model_name, [face])[0] for face in faces]
+        except Exception as e:
+            results[f"embed:{model_name}"] = {"error": str(e)}
+
+    if len(embeddings) > 1:
+        embedding_pairs = [(embeddings[i], embeddings[i - 1]) for i in range(len(embeddings))]
+        results["distance"] = measure(
+            lambda pair: pipeline.find_distance(pair[0], pair[1]), embedding_pairs, iterations, warmup
+        )
+    return results
+
+
+def run_routes(paths, iterations, warmup):
+    import api
+    client = api.app.test_client()
+    documents = [path for path in paths if 'sample_image' in os.path.basename(path)] or paths
+    selfies = [path for path in paths if path not in documents] or paths
+
+    def post_verify(i):
+        with open(selfies[i % len(selfies)], 'rb') as selfie, open(documents[i % len(documents)], 'rb') as document:
+            data = {'selfie': (selfie, 'selfie.jpg'), 'document': (document, 'document.jpg')}
+            response = client.post('/verify', data=data, content_type='multipart/form-data')
+        assert response.status_code == 200, response.get_data(as_text=True)
+
+    def post_detect(i):
+        with open(paths[i % len(paths)], 'rb') as image:
+            response = client.post('/detect', data={'image': (image, 'image.jpg')},
+                                   content_type='multipart/form-data')
+        assert response.status_code == 200, response.get_data(as_text=True)
+
+    indices = list(range(max(len(paths), 1)))
+    return {
+        "route:/verify": measure(post_verify, indices, iterations, warmup),
+        "route:/detect": measure(post_detect, indices, iterations, warmup)
+    }
+
+
+def compare(current, previous_path):
+    """Print p50 changes against a previous results file"""
+    with open(previous_path) as f:
+        previous = json.load(f)["results"]
+    print(f"\n{'stage':32} {'before':>10} {'after':>10} {'change':>8}")
+    for stage, stats in current.items():
+        before = previous.get(stage, {}).get("p50_ms")
+        after = stats.get("p50_ms")
+        if before and after is not None:
+            print(f"{stage:32} {before:>10.2f} {after:>10.2f} {(after - before) / before * 100:>7.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark detection, embedding and /verify latency")
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--backends", default=pipeline.DEFAULT_DETECTOR, help="Comma separated detector backends")
+    parser.add_argument("--models", default=",".join(registry.AVAILABLE_MODELS), help="Comma separated models")
+    parser.add_argument("--skip-routes", action="store_true", help="Only time the individual stages")
+    parser.add_argument("--output", default=os.path.join(HERE, "benchmarks"), help="Directory for JSON results")
+    parser.add_argument("--compare", help="Previous results file to diff against")
+    args = parser.parse_args()
+
+    paths = fixture_paths()
+    if not paths:
+        sys.exit("No fixture images found")
+    encoded = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            encoded.append(f.read())
+    images = [pipeline.decode_scaled(data)[0] for data in encoded]
+
+    print(f"Benchmarking on {len(paths)} images...")
+    results = run_stages(images, encoded, args.backends.split(','), args.models.split(','),
+                         args.iterations, args.warmup)
+    if not args.skip_routes:
+        results.update(run_routes(paths, args.iterations, args.warmup))
+
+    report = {
+        "created_at": time.strftime('%Y-%m-%dT%H:%M:%S'),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "cpu_count": os.cpu_count(),
+        "fixtures": [os.path.relpath(path, HERE) for path in paths],
+        "iterations": args.iterations,
+        "results": results
+    }
+    os.makedirs(args.output, exist_ok=True)
+    output_path = os.path.join(args.output, f"benchmark_{time.strftime('%Y%m%d_%H%M%S')}.json")
+    with open(output_path, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    for stage, stats in results.items():
+        print(f"{stage:32} {json.dumps(stats)}")
+    print(f"Results written to {output_path}")
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+import os
+import time
+import pickle
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+CACHE_ENABLED = os.environ.get('FACE_CACHE', '1') == '1'
+CACHE_MAX_MB = float(os.environ.get('FACE_CACHE_MAX_MB', '256'))
+CACHE_TTL = float(os.environ.get('FACE_CACHE_TTL', '3600'))
+# Directory shared by every worker on the node; unset disables the disk tier
+CACHE_DIR = os.environ.get('FACE_CACHE_DIR', '')
+
+
+def content_digest(data):
+    """SHA-256 of the encoded image bytes"""
+    return hashlib.sha256(data).hexdigest()
+
+
+def cache_key(digest, *names):
+    """Cache key of an image digest combined with detector/model names"""
+    return ':'.join((digest,) + names)
+
+
+def _sizeof(value):
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, dict):
+        return sum(_sizeof(v) for v in value.values()) + 64
+    if isinstance(value, (list, tuple)):
+        return sum(_sizeof(v) for v in value) + 64
+    return 64
+
+
+class DiskTier:
+    """
+    Pickled cache entries in a directory shared between worker processes.
+    Expiry uses file mtimes, so any worker can evict stale entries.
+    """
+
+    def __init__(self, root, ttl):
+        self.root = root
+        self.ttl = ttl
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.root, hashlib.sha1(key.encode()).hexdigest() + '.pkl')
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            if time.time() - os.stat(path).st_mtime > self.ttl:
+                os.remove(path)
+                return None
+            with open(path, 'rb') as f:
+                return pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+
+    def set(self, key, value):
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"Failed to write cache entry: {str(e)}")
+
+
+class LRUCache:
+    """
+    Thread-safe LRU cache bounded by approximate size in bytes and entry age.
+    Misses fall through to an optional shared DiskTier.
+    """
+
+    def __init__(self, max_bytes, ttl, disk=None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.disk = disk
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.counters = {"hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0}
+
+    def _remove(self, key):
+        _, _, size = self._entries.pop(key)
+        self._bytes -= size
+
+    def _store(self, key, value):
+        size = _sizeof(value)
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (value, time.monotonic(), size)
+        self._bytes += size
+        while self._bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+            self.counters["evictions"] += 1
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if time.monotonic() - entry[1] <= self.ttl:
+                    self._entries.move_to_end(key)
+                    self.counters["hits"] += 1
+                    return entry[0]
+                self._remove(key)
+                self.counters["evictions"] += 1
+
+        value = self.disk.get(key) if self.disk else None
+        with self._lock:
+            if value is None:
+                self.counters["misses"] += 1
+                return None
+            self.counters["disk_hits"] += 1
+            self._store(key, value)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._store(key, value)
+        if self.disk:
+            self.disk.set(key, value)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.counters["hits"] + self.counters["disk_hits"] + self.counters["misses"]
+            return dict(
+                self.counters,
+                entries=len(self._entries),
+                size_mb=round(self._bytes / (1024 * 1024), 2),
+                hit_rate=round((lookups - self.counters["misses"]) / lookups, 4) if lookups else 0.0
+            )
+
+
+def _build(name):
+    if not CACHE_ENABLED:
+        return None
+    disk = DiskTier(os.path.join(CACHE_DIR, name), CACHE_TTL) if CACHE_DIR else None
+    return LRUCache(int(CACHE_MAX_MB * 1024 * 1024 / 2), CACHE_TTL, disk)
+
+
+# Detections keyed by (digest, detector), embeddings by (digest, detector, model)
+detections = _build('detections')
+embeddings = _build('embeddings')
+
+
+def _counters():
+    values = {}
+    for name, tier in (("detections", detections), ("embeddings", embeddings)):
+        if tier:
+            for event, count in dict(tier.counters).items():
+                values[(("cache", name), ("event", event))] = count
+    return values
+
+
+metrics.register('face_cache_events_total', 'Cache lookups and evictions', _counters, kind='counter')
+
+
+def stats():
+    return {
+        "detections": detections.stats() if detections else None,
+        "embeddings": embeddings.stats() if embeddings else None
+    }
@@ -0,0 +1,197 @@
+import os
+import re
+import json
+import logging
+import threading
+
+import numpy as np
+
+import ann_index
+import registry
+
+try:
+    import fcntl
+except ImportError:  # Windows: single-process locking only
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+STORE_FOLDER = os.environ.get('FACE_EMBEDDING_STORE', 'embeddings')
+
+# Galleries at least this large are searched through an IVF index
+ANN_THRESHOLD = int(os.environ.get('FACE_ANN_THRESHOLD', '50000'))
+ANN_PROBES = int(os.environ.get('FACE_ANN_PROBES', '8'))
+# Rebuild the index once the gallery has grown by this fraction
+ANN_REBUILD_GROWTH = 0.1
+
+
+def store_name(model_name):
+    """File name stem of a model's store: letters, digits, '-' and '_' only"""
+    return re.sub(r'[^A-Za-z0-9_-]', '_', model_name)
+
+
+def l2_normalize(vector):
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+
+class EmbeddingStore:
+    """
+    Append-only on-disk store of enrolled embeddings for one model.
+    Vectors are L2-normalized float32 rows of <model>.f32, read through a
+    memory map; <model>.ids.json maps each row to its user_id. Rows are
+    written before the index, so a crash never exposes a partial vector.
+    """
+
+    def __init__(self, model_name, root=STORE_FOLDER):
+        self.model_name = model_name
+        os.makedirs(root, exist_ok=True)
+        name = store_name(model_name)
+        self.matrix_path = os.path.join(root, f"{name}.f32")
+        self.index_path = os.path.join(root, f"{name}.ids.json")
+        self.lock_path = os.path.join(root, f"{name}.lock")
+        self._lock = threading.RLock()
+        self._index_mtime = None
+        self._ids = []
+        self._rows = {}
+        self._dim = None
+        self._matrix = None
+        self._index = None
+
+    def _refresh(self):
+        """Reload the index if another process has written to it"""
+        try:
+            mtime = os.stat(self.index_path).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime == self._index_mtime:
+            return
+        with open(self.index_path) as f:
+            index = json.load(f)
+        self._ids = index["ids"]
+        self._rows = {user_id: row for row, user_id in enumerate(self._ids)}
+        self._dim = index["dim"]
+        self._matrix = None
+        self._index_mtime = mtime
+
+    def _write_index(self):
+        tmp_path = f"{self.index_path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({"model_name": self.model_name, "dim": self._dim, "ids": self._ids}, f)
+        os.replace(tmp_path, self.index_path)
+        self._index_mtime = os.stat(self.index_path).st_mtime_ns
+
+    def matrix(self):
+        """Memory-mapped (rows, dim) float32 matrix of every enrolled embedding"""
+        with self._lock:
+            self._refresh()
+            if not self._ids:
+                return np.zeros((0, self._dim or 0), dtype=np.float32)
+            if self._matrix is None or self._matrix.shape[0] != len(self._ids):
+                self._matrix = np.memmap(
+                    self.matrix_path, dtype=np.float32, mode='r', shape=(len(self._ids), self._dim)
+                )
+            return self._matrix
+
+    def ids(self):
+        with self._lock:
+            self._refresh()
+            return list(self._ids)
+
+    def __len__(self):
+        return len(self.ids())
+
+    def __contains__(self, user_id):
+        with self._lock:
+            self._refresh()
+            return user_id in self._rows
+
+    def get(self, user_id):
+        """Stored embedding of a user, or None if not enrolled"""
+        with self._lock:
+            self._refresh()
+            row = self._rows.get(user_id)
+            if row is None:
+                return None
+            return np.array(self.matrix()[row])
+
+    def _ann_index(self, matrix):
+        if matrix.shape[0] < ANN_THRESHOLD:
+            self._index = None
+        elif self._index is None or matrix.shape[0] > self._index.size * (1 + ANN_REBUILD_GROWTH):
+            self._index = ann_index.IVFIndex(n_probe=ANN_PROBES).build(matrix)
+        return self._index
+
+    def search(self, probe, k=5):
+        """
+        Find the k enrolled users closest to a probe embedding by cosine distance.
+        Returns a list of (user_id, distance) best first, and the search method used.
+        """
+        probe = l2_normalize(probe)
+        with self._lock:
+            matrix = self.matrix()
+            ids = list(self._ids)
+            if matrix.shape[0] == 0:
+                return [], 'exact'
+            index = self._ann_index(matrix)
+
+        if index is None:
+            rows, distances = ann_index.exact_search(matrix, probe, k)
+            method = 'exact'
+        else:
+            rows, distances = index.search(matrix, probe, k)
+            # Users enrolled since the index was built are scored exactly
+            if index.size < matrix.shape[0]:
+                tail_rows, tail_distances = ann_index.exact_search(matrix[index.size:], probe, k)
+                rows = np.concatenate([rows, tail_rows + index.size])
+                distances = np.concatenate([distances, tail_distances])
+                order = np.argsort(distances)[:k]
+                rows, distances = rows[order], distances[order]
+            method = 'ivf'
+
+        return [(ids[row], float(distance)) for row, distance in zip(rows, distances)], method
+
+    def add(self, user_id, embedding):
+        """Store or replace the embedding of a user"""
+        vector = l2_normalize(embedding)
+        with self._lock, open(self.lock_path, 'w') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            self._refresh()
+            if self._dim is None:
+                self._dim = int(vector.shape[0])
+            if vector.shape[0] != self._dim:
+                raise ValueError(f"Embedding size {vector.shape[0]} does not match store size {self._dim}")
+
+            row = self._rows.get(user_id)
+            if row is None:
+                # Drop any bytes left behind by an interrupted append
+                with open(self.matrix_path, 'ab') as f:
+                    f.truncate(len(self._ids) * self._dim * 4)
+                    f.write(vector.tobytes())
+                self._rows[user_id] = len(self._ids)
+                self._ids.append(user_id)
+                self._write_index()
+            else:
+                with open(self.matrix_path, 'r+b') as f:
+                    f.seek(row * self._dim * 4)
+                    f.write(vector.tobytes())
+                if self._index is not None:
+                    self._index.update(row, vector)
+            self._matrix = None
+        logger.info(f"Enrolled {user_id} for {self.model_name} ({len(self._ids)} identities)")
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_store(model_name):
+    """Shared store instance for one of registry.AVAILABLE_MODELS"""
+    if model_name not in registry.AVAILABLE_MODELS:
+        raise ValueError(f"Unknown model: {model_name}")
+    with _stores_lock:
+        if model_name not in _stores:
+            _stores[model_name] = EmbeddingStore(model_name)
+        return _stores[model_name]
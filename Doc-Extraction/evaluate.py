@@ -0,0 +1,248 @@
+import os
+import sys
+import csv
+import json
+import time
+import argparse
+
+# Each image is analyzed once here; caching and cross-request batching only add overhead
+os.environ.setdefault('FACE_CACHE', '0')
+os.environ.setdefault('FACE_BATCHING', '0')
+os.environ.setdefault('FACE_PRELOAD_MODELS', '')
+os.environ.setdefault('FACE_PRELOAD_DETECTORS', '')
+
+import numpy as np
+
+import pipeline
+import registry
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+METRICS = ('cosine', 'euclidean', 'euclidean_l2')
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+# Distances are accumulated into this many histogram bins per metric, so
+# memory stays constant however many pairs there are
+BINS = 4000
+EMBED_BATCH = 32
+CURVE_POINTS = 200
+
+
+def load_dataset(source):
+    """
+    Labeled images as (paths, labels), from a <root>/<identity>/<image>
+    directory tree or a CSV file with path and identity columns
+    """
+    items = []
+    if os.path.isdir(source):
+        for identity in sorted(os.listdir(source)):
+            folder = os.path.join(source, identity)
+            if not os.path.isdir(folder):
+                continue
+            for name in sorted(os.listdir(folder)):
+                if name.lower().endswith(IMAGE_EXTENSIONS):
+                    items.append((os.path.join(folder, name), identity))
+    else:
+        base = os.path.dirname(os.path.abspath(source))
+        with open(source, newline='') as f:
+            for row in csv.DictReader(f):
+                items.append((os.path.join(base, row['path']), row['identity']))
+    if not items:
+        raise ValueError(f"No labeled images found in {source}")
+    paths, labels = zip(*items)
+    return list(paths), list(labels)
+
+
+def detect_all(paths, detector_backend):
+    """Most confident face crop of every image, detected once for all models"""
+    faces = []
+    for path in paths:
+        analysis = pipeline.analyze_image(path, detector_backend=detector_backend)
+        index = pipeline.primary_face(analysis)
+        faces.append(None if analysis["error"] or index is None else analysis["faces"][index]["face"])
+    return faces
+
+
+def embed_all(faces, model_name):
+    """One embedding per face, computed in batched forward passes"""
+    present = [i for i, face in enumerate(faces) if face is not None]
+    embeddings = None
+    for start in range(0, len(present), EMBED_BATCH):
+        chunk = present[start:start + EMBED_BATCH]
+        vectors = np.asarray(pipeline.forward_batch(model_name, [faces[i] for i in chunk]), dtype=np.float32)
+        if embeddings is None:
+            embeddings = np.zeros((len(faces), vectors.shape[1]), dtype=np.float32)
+        embeddings[chunk] = vectors
+    return embeddings, np.asarray(present, dtype=np.int64)
+
+
+def metric_range(embeddings, metric):
+    if metric == 'euclidean':
+        return float(2 * np.linalg.norm(embeddings, axis=1).max()) or 1.0
+    return 2.0
+
+
+def pair_histograms(embeddings, labels, metric, block_size):
+    """
+    Histograms of genuine and impostor distances over every unordered pair,
+    computed block by block so only block_size x N distances exist at once
+    """
+    upper = metric_range(embeddings, metric)
+    genuine = np.zeros(BINS, dtype=np.int64)
+    impostor = np.zeros(BINS, dtype=np.int64)
+
+    vectors = embeddings
+    if metric in ('cosine', 'euclidean_l2'):
+        vectors = embeddings / np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+    squared = np.einsum('ij,ij->i', vectors, vectors)
+
+    count = len(vectors)
+    for start in range(0, count, block_size):
+        stop = min(start + block_size, count)
+        block = vectors[start:stop]
+        # Pairs (i, j) with j > i only
+        others = vectors[start:]
+        dots = block @ others.T
+        if metric == 'cosine':
+            distances = 1.0 - dots
+        else:
+            distances = np.sqrt(np.maximum(squared[start:stop, None] + squared[None, start:] - 2 * dots, 0))
+        rows, cols = np.triu_indices(stop - start, k=1, m=count - start)
+        distances = distances[rows, cols]
+        same = labels[start + rows] == labels[start + cols]
+
+        bins = np.clip((distances / upper * BINS).astype(np.int64), 0, BINS - 1)
+        genuine += np.bincount(bins[same], minlength=BINS)
+        impostor += np.bincount(bins[~same], minlength=BINS)
+    return genuine, impostor, upper
+
+
+def error_rates(genuine, impostor, upper):
+    """
+    FAR and FRR when accepting every distance below each bin edge.
+    Returns (thresholds, far, frr).
+    """
+    thresholds = np.arange(1, BINS + 1) * (upper / BINS)
+    accepted_genuine = np.cumsum(genuine)
+    accepted_impostor = np.cumsum(impostor)
+    far = accepted_impostor / max(1, impostor.sum())
+    frr = 1.0 - accepted_genuine / max(1, genuine.sum())
+    return thresholds, far, frr
+
+
+def summarize(model_name, metric, genuine, impostor, upper, target_far):
+    thresholds, far, frr = error_rates(genuine, impostor, upper)
+    eer_index = int(np.argmin(np.abs(far - frr)))
+    # Largest threshold whose false accept rate stays within the target
+    within = np.nonzero(far <= target_far)[0]
+    target_index = int(within[-1]) if len(within) else 0
+
+    try:
+        default = pipeline.find_threshold(model_name, metric)
+        default_index = min(BINS - 1, int(default / upper * BINS))
+        at_default = {"threshold": round(default, 4), "far": round(float(far[default_index]), 6),
+                      "frr": round(float(frr[default_index]), 6)}
+    except Exception:
+        at_default = None
+
+    recommended = float(thresholds[target_index])
+    step = max(1, BINS // CURVE_POINTS)
+    summary = {
+        "genuine_pairs": int(genuine.sum()),
+        "impostor_pairs": int(impostor.sum()),
+        # Area under TAR (1 - FRR) against FAR
+        "auc": round(float(np.trapezoid(1.0 - frr, far)), 6),
+        "eer": round(float((far[eer_index] + frr[eer_index]) / 2), 6),
+        "eer_threshold": round(float(thresholds[eer_index]), 4),
+        "target_far": target_far,
+        "recommended_threshold": round(recommended, 4),
+        "far_at_recommended": round(float(far[target_index]), 6),
+        "frr_at_recommended": round(float(frr[target_index]), 6),
+        "deepface_default": at_default,
+        "curve": {
+            "threshold": [round(float(t), 4) for t in thresholds[::step]],
+            "far": [round(float(v), 6) for v in far[::step]],
+            "frr": [round(float(v), 6) for v in frr[::step]]
+        }
+    }
+    if metric == 'cosine':
+        # The API compares (1 - distance) * 100 against its similarity threshold
+        summary["recommended_similarity"] = round((1 - recommended) * 100, 2)
+    return summary
+
+
+def evaluate(paths, labels, models, metrics, detector_backend, target_far, block_size):
+    start = time.perf_counter()
+    faces = detect_all(paths, detector_backend)
+    label_ids = {label: i for i, label in enumerate(sorted(set(labels)))}
+    results = {
+        "images": len(paths),
+        "identities": len(label_ids),
+        "no_face": sum(face is None for face in faces),
+        "detect_seconds": round(time.perf_counter() - start, 2),
+        "models": {}
+    }
+
+    for model_name in models:
+        if not registry.weights_cached(model_name):
+            results["models"][model_name] = {"skipped": "weights not cached"}
+            continue
+        start = time.perf_counter()
+        try:
+            embeddings, present = embed_all(faces, model_name)
+        except Exception as e:
+            results["models"][model_name] = {"error": str(e)}
+            continue
+        if embeddings is None:
+            results["models"][model_name] = {"error": "No faces to embed"}
+            continue
+        vectors = embeddings[present]
+        model_labels = np.asarray([label_ids[labels[i]] for i in present], dtype=np.int64)
+        entry = {"embed_seconds": round(time.perf_counter() - start, 2)}
+
+        for metric in metrics:
+            start = time.perf_counter()
+            genuine, impostor, upper = pair_histograms(vectors, model_labels, metric, block_size)
+            entry[metric] = summarize(model_name, metric, genuine, impostor, upper, target_far)
+            entry[metric]["distance_seconds"] = round(time.perf_counter() - start, 2)
+        results["models"][model_name] = entry
+        print(f"{model_name}: " + ", ".join(
+            f"{metric} EER {entry[metric]['eer']:.4f} threshold {entry[metric]['recommended_threshold']}"
+            for metric in metrics
+        ))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tune verification thresholds on a labeled dataset")
+    parser.add_argument("dataset", help="<root>/<identity>/<image> folder, or CSV with path,identity columns")
+    parser.add_argument("--models", default=",".join(registry.AVAILABLE_MODELS), help="Comma separated models")
+    parser.add_argument("--metrics", default=",".join(METRICS), help="Comma separated distance metrics")
+    parser.add_argument("--detector", default=pipeline.DEFAULT_DETECTOR, help="Detector backend")
+    parser.add_argument("--target-far", type=float, default=0.001,
+                        help="False accept rate the recommended threshold must not exceed")
+    parser.add_argument("--block-size", type=int, default=1024, help="Rows of the distance matrix per block")
+    parser.add_argument("--output", default=os.path.join(HERE, "evaluations"), help="Directory for JSON results")
+    args = parser.parse_args()
+
+    try:
+        paths, labels = load_dataset(args.dataset)
+    except (OSError, KeyError, ValueError) as e:
+        sys.exit(str(e))
+    print(f"Evaluating {len(paths)} images of {len(set(labels))} identities...")
+
+    report = {
+        "created_at": time.strftime('%Y-%m-%dT%H:%M:%S'),
+        "dataset": os.path.abspath(args.dataset),
+        "detector_backend": args.detector,
+        "results": evaluate(paths, labels, args.models.split(','), args.metrics.split(','),
+                            args.detector, args.target_far, args.block_size)
+    }
+    os.makedirs(args.output, exist_ok=True)
+    output_path = os.path.join(args.output, f"evaluation_{time.strftime('%Y%m%d_%H%M%S')}.json")
+    with open(output_path, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {output_path}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,16 @@
 import os
 import cv2
+import csv
+import sys
+import json
+import time
 import argparse
+import functools
+import multiprocessing
 import numpy as np
 from deepface import DeepFace
+import archive
+import pipeline
 
 def verify_face(selfie_path, aadhaar_path, model_name="Facenet", distance_metric="cosine", threshold=None):
     """
@@ -181,5 +189,162 @@ def main():
     # Visualize face detection results
     display_faces(selfie_path, aadhaar_path)
 
+def load_pairs(pairs_path):
+    """
+    Read (selfie, document) pairs from a CSV file with selfie,document columns
+    or a JSONL file with one {"selfie": ..., "document": ...} object per line.
+    Extra columns/keys (id, label, ...) are carried into the report.
+    """
+    with open(pairs_path, newline='') as f:
+        if pairs_path.lower().endswith('.csv'):
+            for row in csv.DictReader(f):
+                yield dict(row)
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+def walk_archive(root):
+    """
+    Yield pairs from the upload archive written by Newapi.py: the selfie and
+    document archived by one /verify request share a user_id and timestamp
+    """
+    store = archive.ArchiveStore(root)
+    uploads = {}
+    for record in reversed(store.find()):
+        uploads.setdefault((record["user_id"], record["created"]), {}).setdefault(record["role"], record["digest"])
+    for (user_id, created), roles in uploads.items():
+        if "selfie" in roles and "document" in roles:
+            yield {
+                "id": f"{user_id}/{created}",
+                "selfie": store.blob_path(roles["selfie"]),
+                "document": store.blob_path(roles["document"])
+            }
+
+def _read_image(path):
+    """
+    Bytes of an image file or of an archived blob
+    """
+    with open(path, 'rb') as f:
+        return archive.unpack(f.read())
+
+def _init_worker(model_name):
+    """
+    Load the model once per worker process
+    """
+    # One pair at a time per process: nothing to batch, so skip the scheduler wait
+    pipeline.batcher = None
+    DeepFace.build_model(model_name)
+
+def _verify_pair(pair, model_name, distance_metric, threshold):
+    """
+    Verify one pair in a worker; returns a report row
+    """
+    start = time.perf_counter()
+    row = dict(pair, model=model_name, verified=False, similarity=0.0, distance=None, error=None)
+    try:
+        selfie = pipeline.analyze_image(_read_image(pair["selfie"]))
+        document = pipeline.analyze_image(_read_image(pair["document"]))
+        for analysis in (selfie, document):
+            if analysis["error"]:
+                raise ValueError(analysis["error"])
+        verified, distance, threshold_value = pipeline.compare_analyses(
+            selfie, document, model_name=model_name, distance_metric=distance_metric
+        )
+        if distance_metric == "cosine":
+            similarity = (1 - distance) * 100
+        else:
+            similarity = max(0, (1 - (distance / (threshold_value * 2))) * 100)
+        row.update(
+            verified=bool(verified),
+            similarity=round(similarity, 2),
+            distance=round(distance, 6),
+            model_threshold=threshold_value,
+            match=bool(verified) and similarity >= threshold
+        )
+    except Exception as e:
+        row["error"] = str(e)
+    row["seconds"] = round(time.perf_counter() - start, 4)
+    return row
+
+def bulk_mode(pairs, output_path, model_name="Facenet", distance_metric="cosine", threshold=75.0, workers=None):
+    """
+    Verify many pairs over a process pool, streaming a JSONL or CSV report
+    """
+    workers = workers or os.cpu_count() or 1
+    # Split the cores between workers so TensorFlow thread pools don't oversubscribe
+    threads = str(max(1, (os.cpu_count() or 1) // workers))
+    os.environ.setdefault('TF_NUM_INTRAOP_THREADS', threads)
+    os.environ.setdefault('TF_NUM_INTEROP_THREADS', '1')
+    os.environ.setdefault('OMP_NUM_THREADS', threads)
+
+    as_csv = output_path.lower().endswith('.csv')
+    fields = ['id', 'selfie', 'document', 'model', 'verified', 'match', 'similarity',
+              'distance', 'model_threshold', 'seconds', 'error']
+    verify = functools.partial(_verify_pair, model_name=model_name,
+                               distance_metric=distance_metric, threshold=threshold)
+    latencies = []
+    errors = 0
+    start = time.perf_counter()
+
+    print(f"Verifying pairs with {model_name} on {workers} workers...")
+    # Spawned workers avoid inheriting TensorFlow state across fork
+    context = multiprocessing.get_context('spawn')
+    with open(output_path, 'w', newline='') as out, \
+            context.Pool(workers, initializer=_init_worker, initargs=(model_name,)) as pool:
+        writer = csv.DictWriter(out, fieldnames=fields, extrasaction='ignore') if as_csv else None
+        if writer:
+            writer.writeheader()
+        for row in pool.imap_unordered(verify, pairs):
+            if writer:
+                writer.writerow(row)
+            else:
+                out.write(json.dumps(row) + "\n")
+            out.flush()
+            latencies.append(row["seconds"])
+            errors += row["error"] is not None
+            if len(latencies) % 100 == 0:
+                print(f"  {len(latencies)} pairs, {len(latencies) / (time.perf_counter() - start):.2f} pairs/s")
+
+    elapsed = time.perf_counter() - start
+    stats = {
+        "pairs": len(latencies),
+        "errors": errors,
+        "elapsed_seconds": round(elapsed, 2),
+        "pairs_per_second": round(len(latencies) / elapsed, 3) if elapsed else 0,
+        "p50_seconds": round(float(np.percentile(latencies, 50)), 4) if latencies else None,
+        "p95_seconds": round(float(np.percentile(latencies, 95)), 4) if latencies else None
+    }
+    print(f"✅ Report written to '{output_path}'")
+    print(json.dumps(stats, indent=2))
+    return stats
+
+def cli():
+    parser = argparse.ArgumentParser(description="Compare selfies with Aadhaar/ID document photos")
+    subcommands = parser.add_subparsers(dest="command")
+    subcommands.add_parser("interactive", help="Compare pairs entered one at a time")
+
+    bulk = subcommands.add_parser("bulk", help="Verify many pairs in parallel")
+    source = bulk.add_mutually_exclusive_group(required=True)
+    source.add_argument("--pairs", help="CSV or JSONL file of selfie/document pairs")
+    source.add_argument("--archive", help="Upload archive written by Newapi.py (e.g. uploads/archive); "
+                                          "import older upload trees with archive.py import")
+    bulk.add_argument("--output", default="bulk_report.jsonl", help="Report path (.jsonl or .csv)")
+    bulk.add_argument("--model", default="Facenet", help="Face recognition model")
+    bulk.add_argument("--metric", default="cosine", help="Distance metric")
+    bulk.add_argument("--threshold", type=float, default=75.0, help="Similarity threshold in percent")
+    bulk.add_argument("--workers", type=int, default=None, help="Worker processes (default: CPU count)")
+
+    args = parser.parse_args()
+    if args.command == "interactive":
+        interactive_mode()
+    elif args.command == "bulk":
+        pairs = load_pairs(args.pairs) if args.pairs else walk_archive(args.archive)
+        stats = bulk_mode(pairs, args.output, model_name=args.model, distance_metric=args.metric,
+                          threshold=args.threshold, workers=args.workers)
+        sys.exit(1 if stats["pairs"] == 0 else 0)
+    else:
+        main()
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    cli()
\ No newline at end of file
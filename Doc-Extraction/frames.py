@@ -0,0 +1,136 @@
+import os
+import tempfile
+import logging
+
+import cv2
+import numpy as np
+
+import metrics
+import pipeline
+
+logger = logging.getLogger(__name__)
+
+VIDEO_EXTENSIONS = {'mp4', 'mov', 'webm', 'avi'}
+# Frames of a video looked at per second of footage; the rest are skipped with grab()
+SAMPLE_FPS = float(os.environ.get('FACE_FRAME_SAMPLE_FPS', '5'))
+# Frames embedded before a decision is allowed, and at most
+MIN_FRAMES = int(os.environ.get('FACE_FRAMES_MIN', '2'))
+MAX_FRAMES = int(os.environ.get('FACE_FRAMES_MAX', '8'))
+# Frames decoded in total, including skipped ones
+MAX_DECODED = int(os.environ.get('FACE_FRAMES_MAX_DECODED', '40'))
+# Stop once the mean distance is further than this fraction of the threshold from it
+DECISION_BAND = float(os.environ.get('FACE_FRAMES_BAND', '0.15'))
+# Variance of the Laplacian on a QUALITY_SIDE-wide grayscale copy
+MIN_SHARPNESS = float(os.environ.get('FACE_MIN_SHARPNESS', '60'))
+# Mean absolute difference of 32x32 thumbnails below which a frame repeats the last one
+DUPLICATE_DIFF = 3.0
+QUALITY_SIDE = 256
+
+
+def image_frames(uploads):
+    """Decode uploaded frame images one at a time, as they are consumed"""
+    for data in uploads:
+        img, _ = pipeline.decode_scaled(data)
+        yield img
+
+
+def video_frames(data, sample_fps=SAMPLE_FPS):
+    """
+    Decode sampled frames of a video clip one at a time.
+    Frames between samples are only grabbed, not decoded to pixels.
+    OpenCV reads videos from paths, so the clip is spooled to a temporary
+    file that is removed when the generator is closed.
+    """
+    with tempfile.NamedTemporaryFile(suffix='.video') as clip:
+        clip.write(data)
+        clip.flush()
+        capture = cv2.VideoCapture(clip.name)
+        if not capture.isOpened():
+            raise ValueError("Could not decode video")
+        try:
+            fps = capture.get(cv2.CAP_PROP_FPS) or 30.0
+            stride = max(1, int(round(fps / sample_fps)))
+            index = 0
+            while capture.grab():
+                if index % stride == 0:
+                    ok, frame = capture.retrieve()
+                    if ok:
+                        yield frame
+                index += 1
+        finally:
+            capture.release()
+
+
+def _quality_view(img):
+    height, width = img.shape[:2]
+    scale = min(1.0, QUALITY_SIDE / width)
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    if scale < 1.0:
+        gray = cv2.resize(gray, (QUALITY_SIDE, int(height * scale)), interpolation=cv2.INTER_AREA)
+    return gray
+
+
+def sharpness(gray):
+    return float(cv2.Laplacian(gray, cv2.CV_64F).var())
+
+
+def thumbnail(gray):
+    return cv2.resize(gray, (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32)
+
+
+def verify_frames(frames, document, model_name="Facenet", distance_metric="cosine"):
+    """
+    Verify a stream of selfie frames against an analyzed document.
+    Blurry and repeated frames are dropped before detection; the others are
+    embedded one by one and compared with the document embedding, stopping
+    once the mean distance is clearly on one side of the threshold.
+    Returns (verified, distance, threshold, report).
+    """
+    # Embedded once, and reused from the cache for repeat documents
+    if document["error"] or not pipeline.embed_analysis(document, model_name):
+        raise ValueError("No face found in document")
+    threshold = pipeline.find_threshold(model_name, distance_metric)
+
+    report = {"decoded": 0, "blurry": 0, "duplicate": 0, "no_face": 0, "distances": [], "early_exit": False}
+    previous = None
+    try:
+        for img in frames:
+            report["decoded"] += 1
+            with metrics.stage('frame_quality'):
+                gray = _quality_view(img)
+                blurry = sharpness(gray) < MIN_SHARPNESS
+                current = thumbnail(gray)
+                duplicate = previous is not None and float(np.mean(np.abs(current - previous))) < DUPLICATE_DIFF
+            if blurry:
+                report["blurry"] += 1
+            elif duplicate:
+                report["duplicate"] += 1
+            else:
+                previous = current
+                selfie = pipeline.analyze_image(img)
+                # DeepFace returns the whole frame with zero confidence when it finds no face
+                if selfie["error"] or not any(face.get('confidence', 0) > 0 for face in selfie["faces"]):
+                    report["no_face"] += 1
+                else:
+                    _, distance, _ = pipeline.compare_analyses(selfie, document, model_name, distance_metric)
+                    report["distances"].append(round(distance, 4))
+
+            distances = report["distances"]
+            if len(distances) >= MIN_FRAMES:
+                mean = sum(distances) / len(distances)
+                if abs(mean - threshold) > DECISION_BAND * threshold:
+                    report["early_exit"] = True
+                    break
+            if len(distances) >= MAX_FRAMES or report["decoded"] >= MAX_DECODED:
+                break
+    finally:
+        # Stops decoding and removes a spooled video
+        close = getattr(frames, 'close', None)
+        if close is not None:
+            close()
+
+    if not report["distances"]:
+        raise ValueError("No usable face found in the selfie frames")
+    distance = sum(report["distances"]) / len(report["distances"])
+    report["frames_used"] = len(report["distances"])
+    return distance <= threshold, distance, threshold, report
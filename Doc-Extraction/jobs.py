@@ -0,0 +1,149 @@
+import os
+import json
+import time
+import uuid
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from werkzeug.security import safe_join
+
+import archive
+
+logger = logging.getLogger(__name__)
+
+# Threads share the embedding batcher, so concurrent pairs are embedded together
+BATCH_WORKERS = int(os.environ.get('FACE_BATCH_WORKERS', str(os.cpu_count() or 4)))
+BATCH_MAX_PAIRS = int(os.environ.get('FACE_BATCH_MAX_PAIRS', '10000'))
+# Finished jobs are kept this many seconds for polling
+JOB_RETENTION = float(os.environ.get('FACE_JOB_RETENTION', '3600'))
+
+
+def parse_pairs(req, upload_folder, allowed_file=None):
+    """
+    Read the (selfie, document) pairs of a batch request.
+    Accepts multipart 'selfie'/'document' file lists matched by position, or
+    a JSON manifest {"pairs": [{"id", "selfie", "document"}]} whose paths are
+    relative to upload_folder. Manifest files are read lazily by the workers.
+    Uploaded files must pass allowed_file(filename), as on /verify; manifest
+    paths may name extensionless archive blobs and are not checked.
+    Raises ValueError for malformed requests.
+    """
+    pairs = []
+    if req.is_json:
+        manifest = req.get_json(silent=True) or {}
+        for i, pair in enumerate(manifest.get('pairs', [])):
+            selfie_path = safe_join(upload_folder, str(pair.get('selfie', '')))
+            document_path = safe_join(upload_folder, str(pair.get('document', '')))
+            if not pair.get('selfie') or not pair.get('document') or not selfie_path or not document_path:
+                raise ValueError(f"Pair {i} must reference files under {upload_folder}")
+            pairs.append({"id": pair.get('id', str(i)), "selfie": selfie_path, "document": document_path})
+    else:
+        selfies = req.files.getlist('selfie')
+        documents = req.files.getlist('document')
+        if len(selfies) != len(documents):
+            raise ValueError('Every selfie needs a matching document')
+        if allowed_file and not all(allowed_file(upload.filename) for upload in selfies + documents):
+            raise ValueError('Only .png, .jpg, .jpeg files are allowed')
+        for i, (selfie_file, document_file) in enumerate(zip(selfies, documents)):
+            pairs.append({
+                "id": f"{i}:{selfie_file.filename}:{document_file.filename}",
+                "selfie": selfie_file.read(),
+                "document": document_file.read()
+            })
+
+    if not pairs:
+        raise ValueError('At least one selfie/document pair is required')
+    if len(pairs) > BATCH_MAX_PAIRS:
+        raise ValueError(f'At most {BATCH_MAX_PAIRS} pairs are allowed per batch')
+    return pairs
+
+
+def load_bytes(source):
+    """Bytes of an uploaded image, or of a manifest path"""
+    if isinstance(source, (bytes, bytearray)):
+        return source
+    with open(source, 'rb') as f:
+        # Paths may point at (possibly compressed) blobs of the upload archive
+        return archive.unpack(f.read())
+
+
+class JobRunner:
+    """
+    Runs batches of verification pairs on a shared thread pool, either
+    streaming results as they finish or recording them in a pollable job.
+    """
+
+    def __init__(self, max_workers=BATCH_WORKERS):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='verify-batch')
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _run_pair(index, pair, verify_pair):
+        try:
+            result = verify_pair(load_bytes(pair["selfie"]), load_bytes(pair["document"]))
+        except Exception as e:
+            logger.error(f"Batch pair {pair['id']} failed: {str(e)}")
+            result = {'error': str(e)}
+        return dict(result, index=index, id=pair["id"])
+
+    def run(self, pairs, verify_pair):
+        """Yield each pair's result as soon as it completes"""
+        futures = [
+            self._executor.submit(self._run_pair, i, pair, verify_pair)
+            for i, pair in enumerate(pairs)
+        ]
+        for future in as_completed(futures):
+            yield future.result()
+
+    def stream_ndjson(self, pairs, verify_pair):
+        """Results as newline-delimited JSON lines"""
+        for result in self.run(pairs, verify_pair):
+            yield json.dumps(result) + '\n'
+
+    def submit(self, pairs, verify_pair):
+        """Start a background job and return its id"""
+        self._prune()
+        job_id = str(uuid.uuid4())
+        job = {
+            "job_id": job_id,
+            "status": "running",
+            "total": len(pairs),
+            "completed": 0,
+            "created_at": time.time(),
+            "finished_at": None,
+            "results": []
+        }
+        with self._lock:
+            self._jobs[job_id] = job
+
+        def collect():
+            for result in self.run(pairs, verify_pair):
+                with self._lock:
+                    job["results"].append(result)
+                    job["completed"] += 1
+            with self._lock:
+                job["status"] = "done"
+                job["finished_at"] = time.time()
+
+        threading.Thread(target=collect, name=f"job-{job_id}", daemon=True).start()
+        return job_id
+
+    def get(self, job_id):
+        """Snapshot of a job, or None if unknown or expired"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            return dict(job, results=sorted(job["results"], key=lambda r: r["index"]))
+
+    def _prune(self):
+        now = time.time()
+        with self._lock:
+            expired = [
+                job_id for job_id, job in self._jobs.items()
+                if job["finished_at"] and now - job["finished_at"] > JOB_RETENTION
+            ]
+            for job_id in expired:
+                del self._jobs[job_id]
@@ -0,0 +1,409 @@
+import os
+import sys
+import glob
+import json
+import time
+import shlex
+import random
+import argparse
+import threading
+import subprocess
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import requests
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+ROUTES = ('verify', 'detect')
+LOCAL_HOSTS = {'localhost', '127.0.0.1', '::1'}
+PERCENTILES = (50, 90, 95, 99)
+
+
+def fixture_images():
+    """Sample images bundled next to the API, as (name, bytes, mimetype)"""
+    images = []
+    for path in sorted(glob.glob(os.path.join(HERE, 'sample_image*')) + glob.glob(os.path.join(HERE, 'image*.png'))):
+        with open(path, 'rb') as f:
+            mimetype = 'image/png' if path.lower().endswith('.png') else 'image/jpeg'
+            images.append((os.path.basename(path), f.read(), mimetype))
+    return images
+
+
+def parse_mix(text):
+    """'verify=3,detect=1' -> (routes, weights)"""
+    mix = {}
+    for part in text.split(','):
+        route, _, weight = part.partition('=')
+        route = route.strip()
+        if route not in ROUTES:
+            raise ValueError(f"Unknown route {route}; expected one of {', '.join(ROUTES)}")
+        mix[route] = float(weight or 1)
+    return list(mix), list(mix.values())
+
+
+class Traffic:
+    """Random multipart /verify and /detect requests built from the fixtures"""
+
+    def __init__(self, base_url, images, mix, model_name=None, seed=None, timeout=60):
+        self.base_url = base_url.rstrip('/')
+        self.images = images
+        self.routes, self.weights = mix
+        self.model_name = model_name
+        self.timeout = timeout
+        self._random = random.Random(seed)
+        self._random_lock = threading.Lock()
+        self._local = threading.local()
+
+    def _session(self):
+        # One keep-alive connection per client thread, like real clients
+        if not hasattr(self._local, 'session'):
+            self._local.session = requests.Session()
+        return self._local.session
+
+    def next_request(self):
+        with self._random_lock:
+            route = self._random.choices(self.routes, self.weights)[0]
+            if route == 'verify':
+                selfie, document = self._random.sample(self.images, 2) if len(self.images) > 1 else self.images * 2
+                files = {'selfie': selfie, 'document': document}
+            else:
+                files = {'image': self._random.choice(self.images)}
+        data = {'model_name': self.model_name} if self.model_name and route == 'verify' else {}
+        return route, files, data
+
+    def send(self, route, files, data):
+        """POST one request; returns (status, error) with status 0 for transport failures"""
+        try:
+            response = self._session().post(f"{self.base_url}/{route}", files=files, data=data, timeout=self.timeout)
+        except requests.RequestException as e:
+            return 0, type(e).__name__
+        if response.status_code >= 400:
+            try:
+                return response.status_code, response.json().get('error', response.reason)
+            except ValueError:
+                return response.status_code, response.reason
+        return response.status_code, None
+
+
+class Recorder:
+    """Thread-safe log of (start, latency, route, status, error) samples"""
+
+    def __init__(self):
+        self.samples = []
+        self._lock = threading.Lock()
+
+    def record(self, start, latency, route, status, error):
+        with self._lock:
+            self.samples.append((start, latency, route, status, error))
+
+    def snapshot(self):
+        with self._lock:
+            return list(self.samples)
+
+
+def timed_send(traffic, recorder, started, scheduled=None):
+    """
+    Send one request and record it. Open-loop latency counts from the
+    scheduled arrival time, so queueing in the generator is not hidden.
+    """
+    route, files, data = traffic.next_request()
+    start = time.perf_counter()
+    status, error = traffic.send(route, files, data)
+    origin = start if scheduled is None else min(start, scheduled)
+    recorder.record(origin - started, time.perf_counter() - origin, route, status, error)
+
+
+def run_closed(traffic, recorder, concurrency, duration, started):
+    """concurrency clients, each sending its next request as soon as the last one returns"""
+    deadline = started + duration
+
+    def client():
+        while time.perf_counter() < deadline:
+            timed_send(traffic, recorder, started)
+
+    threads = [threading.Thread(target=client, name=f"client-{i}", daemon=True) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def run_open(traffic, recorder, rate, duration, started, max_in_flight, poisson=True, seed=None):
+    """
+    Requests arrive at a fixed mean rate whatever the server's latency.
+    Arrivals that find max_in_flight requests outstanding wait for a free
+    client; their wait counts towards their latency.
+    """
+    schedule = random.Random(seed)
+    deadline = started + duration
+    next_arrival = started
+    with ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix='client') as executor:
+        while next_arrival < deadline:
+            delay = next_arrival - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(timed_send, traffic, recorder, started, next_arrival)
+            next_arrival += schedule.expovariate(rate) if poisson else 1.0 / rate
+
+
+def process_tree(root_pid):
+    """root_pid and all its descendants, from the parent pids in /proc"""
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                # The command name may contain spaces; the fields after it do not
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    pids, pending = [], [root_pid]
+    while pending:
+        pid = pending.pop()
+        pids.append(pid)
+        pending.extend(children.get(pid, []))
+    return pids
+
+
+def resource_usage(root_pid):
+    """Summed RSS, open file descriptors and threads of a server's process tree"""
+    usage = {"processes": 0, "rss_mb": 0.0, "fds": 0, "threads": 0}
+    for pid in process_tree(root_pid):
+        try:
+            with open(f'/proc/{pid}/status') as f:
+                status = dict(line.split(':', 1) for line in f if ':' in line)
+            fds = len(os.listdir(f'/proc/{pid}/fd'))
+        except OSError:  # Exited since the tree was read
+            continue
+        usage["processes"] += 1
+        usage["rss_mb"] += int(status.get('VmRSS', '0 kB').split()[0]) / 1024
+        usage["threads"] += int(status.get('Threads', '0'))
+        usage["fds"] += fds
+    usage["rss_mb"] = round(usage["rss_mb"], 1)
+    return usage
+
+
+class ResourceSampler(threading.Thread):
+    """Samples the server's resource usage every interval seconds until stopped"""
+
+    def __init__(self, pid, interval, started):
+        super().__init__(name='resource-sampler', daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.started = started
+        self.samples = []
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while True:
+            self.samples.append(dict(resource_usage(self.pid), t=round(time.perf_counter() - self.started, 1)))
+            if self._stop_event.wait(self.interval):
+                return
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        self.samples.append(dict(resource_usage(self.pid), t=round(time.perf_counter() - self.started, 1)))
+
+
+def latency_summary(samples, elapsed):
+    latencies = np.asarray([latency for _, latency, _, _, _ in samples]) * 1000
+    errors = [error for _, _, _, status, error in samples if error is not None or status >= 400 or status == 0]
+    summary = {
+        "requests": len(samples),
+        "errors": len(errors),
+        "error_rate": round(len(errors) / len(samples), 4) if samples else 0.0,
+        "throughput_per_s": round(len(samples) / elapsed, 2) if elapsed else None
+    }
+    if samples:
+        summary.update({f"p{p}_ms": round(float(np.percentile(latencies, p)), 1) for p in PERCENTILES})
+        summary["max_ms"] = round(float(latencies.max()), 1)
+        summary["mean_ms"] = round(float(latencies.mean()), 1)
+    return summary
+
+
+def summarize(samples, warmup, duration, interval, resources):
+    """Overall and per-route results after warmup, and a timeline per interval"""
+    measured = [sample for sample in samples if sample[0] >= warmup]
+    elapsed = max(0.0, duration - warmup)
+    report = {"overall": latency_summary(measured, elapsed), "routes": {}, "status_codes": {}, "errors": {}}
+    for route in sorted({sample[2] for sample in measured}):
+        report["routes"][route] = latency_summary([s for s in measured if s[2] == route], elapsed)
+    for _, _, _, status, error in measured:
+        report["status_codes"][str(status)] = report["status_codes"].get(str(status), 0) + 1
+        if error is not None:
+            report["errors"][error] = report["errors"].get(error, 0) + 1
+
+    timeline = []
+    for window_start in np.arange(0.0, duration, interval):
+        window = [s for s in samples if window_start <= s[0] < window_start + interval]
+        entry = {"t": round(float(window_start), 1)}
+        entry.update({key: value for key, value in latency_summary(window, interval).items()
+                      if key in ("requests", "error_rate", "throughput_per_s", "p50_ms", "p95_ms", "p99_ms")})
+        usage = [r for r in resources if window_start <= r["t"] < window_start + interval]
+        if usage:
+            entry.update({key: usage[-1][key] for key in ("rss_mb", "fds", "threads", "processes")})
+        timeline.append(entry)
+    report["timeline"] = timeline
+
+    if resources:
+        # Growth from the end of warmup, when models and caches are loaded
+        baseline = next((r for r in resources if r["t"] >= warmup), resources[0])
+        final = resources[-1]
+        rss_growth = final["rss_mb"] - baseline["rss_mb"]
+        report["resources"] = {
+            "baseline": baseline,
+            "final": final,
+            "peak_rss_mb": max(r["rss_mb"] for r in resources),
+            "rss_growth_mb": round(rss_growth, 1),
+            "fd_growth": final["fds"] - baseline["fds"],
+            "thread_growth": final["threads"] - baseline["threads"],
+            "rss_mb_per_1000_requests": round(rss_growth / len(measured) * 1000, 2) if measured else None
+        }
+    return report
+
+
+def start_server(app_module, port, server_args):
+    """Start serve.py for app_module on a local port; returns the Popen"""
+    command = [sys.executable, os.path.join(HERE, 'serve.py'), '--app', app_module,
+               '--bind', f'127.0.0.1:{port}'] + shlex.split(server_args)
+    print(f"Starting {' '.join(command)}")
+    return subprocess.Popen(command, cwd=HERE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def wait_ready(base_url, timeout, server=None):
+    """Poll the index route until the server answers; models load before it does"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server is not None and server.poll() is not None:
+            raise RuntimeError(f"Server exited with code {server.returncode} during startup")
+        try:
+            if requests.get(f"{base_url}/", timeout=5).status_code == 200:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(1)
+    raise RuntimeError(f"Server at {base_url} not ready after {timeout}s")
+
+
+def check_limits(report, args):
+    """Failed capacity checks, as messages"""
+    failures = []
+    overall = report["overall"]
+    if args.max_error_rate is not None and overall["error_rate"] > args.max_error_rate:
+        failures.append(f"error rate {overall['error_rate']} > {args.max_error_rate}")
+    if args.max_p95_ms is not None and overall.get("p95_ms", 0) > args.max_p95_ms:
+        failures.append(f"p95 {overall['p95_ms']}ms > {args.max_p95_ms}ms")
+    growth = report.get("resources", {}).get("rss_growth_mb")
+    if args.max_rss_growth_mb is not None and growth is not None and growth > args.max_rss_growth_mb:
+        failures.append(f"RSS growth {growth}MB > {args.max_rss_growth_mb}MB")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load and soak test a locally running verification API")
+    parser.add_argument("--url", default=None, help="Base URL of a running server (default: the started one)")
+    parser.add_argument("--start", choices=["api", "Newapi"], help="Start serve.py with this app for the run")
+    parser.add_argument("--port", type=int, default=5055, help="Port for the started server")
+    parser.add_argument("--server-args", default="", help="Extra serve.py arguments, e.g. '--workers 2'")
+    parser.add_argument("--pid", type=int, help="Server process to watch when not started here")
+    parser.add_argument("--allow-remote", action="store_true", help="Allow a URL that is not on this machine")
+    parser.add_argument("--mode", choices=["closed", "open"], default="closed")
+    parser.add_argument("--concurrency", type=int, default=4,
+                        help="Clients (closed loop) or most requests in flight (open loop)")
+    parser.add_argument("--rate", type=float, default=2.0, help="Mean arrivals per second (open loop)")
+    parser.add_argument("--uniform", action="store_true", help="Evenly spaced instead of Poisson arrivals")
+    parser.add_argument("--duration", type=float, default=60.0, help="Seconds of traffic, warmup included")
+    parser.add_argument("--warmup", type=float, default=10.0, help="Initial seconds left out of the results")
+    parser.add_argument("--interval", type=float, default=5.0, help="Seconds per timeline window and resource sample")
+    parser.add_argument("--mix", default="verify=3,detect=1", help="Relative weights of the routes")
+    parser.add_argument("--model", help="model_name sent with /verify")
+    parser.add_argument("--timeout", type=float, default=60.0, help="Per request timeout in seconds")
+    parser.add_argument("--startup-timeout", type=float, default=300.0)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--max-error-rate", type=float, help="Exit non-zero above this error rate")
+    parser.add_argument("--max-p95-ms", type=float, help="Exit non-zero above this p95 latency")
+    parser.add_argument("--max-rss-growth-mb", type=float, help="Exit non-zero above this RSS growth")
+    parser.add_argument("--output", default=os.path.join(HERE, "loadtests"), help="Directory for JSON results")
+    args = parser.parse_args()
+
+    if args.url is None and args.start is None:
+        parser.error("either --url or --start is required")
+    base_url = (args.url or f"http://127.0.0.1:{args.port}").rstrip('/')
+    if urlparse(base_url).hostname not in LOCAL_HOSTS and not args.allow_remote:
+        parser.error(f"{base_url} is not local; pass --allow-remote to load test it anyway")
+    try:
+        mix = parse_mix(args.mix)
+    except ValueError as e:
+        parser.error(str(e))
+    images = fixture_images()
+    if not images:
+        sys.exit("No sample images found")
+
+    server = start_server(args.start, args.port, args.server_args) if args.start else None
+    try:
+        wait_ready(base_url, args.startup_timeout, server)
+        pid = server.pid if server else args.pid
+        traffic = Traffic(base_url, images, mix, model_name=args.model, seed=args.seed, timeout=args.timeout)
+        recorder = Recorder()
+        started = time.perf_counter()
+        sampler = ResourceSampler(pid, args.interval, started) if pid else None
+        if sampler:
+            sampler.start()
+
+        print(f"{args.mode} loop against {base_url} for {args.duration}s...")
+        if args.mode == 'closed':
+            run_closed(traffic, recorder, args.concurrency, args.duration, started)
+        else:
+            run_open(traffic, recorder, args.rate, args.duration, started, args.concurrency,
+                     poisson=not args.uniform, seed=args.seed)
+        duration = time.perf_counter() - started
+        if sampler:
+            sampler.stop()
+    finally:
+        if server is not None:
+            server.terminate()
+            try:
+                server.wait(timeout=60)
+            except subprocess.TimeoutExpired:
+                server.kill()
+
+    report = {
+        "created_at": time.strftime('%Y-%m-%dT%H:%M:%S'),
+        "url": base_url,
+        "server": args.start or None,
+        "server_args": args.server_args,
+        "mode": args.mode,
+        "concurrency": args.concurrency,
+        "rate": args.rate if args.mode == 'open' else None,
+        "duration": round(duration, 1),
+        "warmup": args.warmup,
+        "mix": dict(zip(*mix)),
+        "fixtures": [name for name, _, _ in images]
+    }
+    report.update(summarize(recorder.snapshot(), args.warmup, duration, args.interval,
+                            sampler.samples if sampler else []))
+    failures = check_limits(report, args)
+    report["failed_checks"] = failures
+
+    os.makedirs(args.output, exist_ok=True)
+    output_path = os.path.join(args.output, f"loadtest_{time.strftime('%Y%m%d_%H%M%S')}.json")
+    with open(output_path, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    for route, stats in [("overall", report["overall"])] + sorted(report["routes"].items()):
+        print(f"{route:10} {json.dumps(stats)}")
+    if "resources" in report:
+        print(f"{'resources':10} {json.dumps({k: v for k, v in report['resources'].items() if k not in ('baseline', 'final')})}")
+    print(f"Results written to {output_path}")
+    for failure in failures:
+        print(f"FAILED: {failure}")
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,118 @@
+import os
+import logging
+import threading
+
+import cv2
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# 'haar', 'yolo' (needs the Darknet weights for yolov3.cfg), 'off', or 'auto':
+# no first stage for DeepFace's 'opencv' backend, which is itself a Haar
+# cascade, so a Haar pass in front of it costs a detection and gains nothing;
+# 'haar' for the slower backends
+LOCALIZER = os.environ.get('FACE_LOCALIZER', 'auto')
+YOLO_CONFIG = os.path.join(HERE, 'yolov3.cfg')
+YOLO_WEIGHTS = os.environ.get('FACE_YOLO_WEIGHTS', os.path.join(HERE, 'yolov3.weights'))
+# Long side of the downscaled frame the first stage runs on
+LOCALIZE_MAX_SIDE = int(os.environ.get('FACE_LOCALIZE_MAX_SIDE', '640'))
+# Margin added around the found region, as a fraction of its size
+LOCALIZE_MARGIN = 0.5
+
+YOLO_INPUT_SIZE = 416
+YOLO_PERSON_CLASS = 0
+YOLO_MIN_CONFIDENCE = 0.3
+
+_models = {}
+_lock = threading.Lock()
+# cv2.dnn networks are not safe to run from several threads at once
+_yolo_lock = threading.Lock()
+
+
+def _haar():
+    with _lock:
+        if 'haar' not in _models:
+            _models['haar'] = cv2.CascadeClassifier(
+                os.path.join(cv2.data.haarcascades, 'haarcascade_frontalface_default.xml')
+            )
+        return _models['haar']
+
+
+def _yolo():
+    """Darknet YOLOv3 from the bundled config, or None when the weights are missing"""
+    with _lock:
+        if 'yolo' not in _models:
+            if os.path.isfile(YOLO_WEIGHTS):
+                net = cv2.dnn.readNetFromDarknet(YOLO_CONFIG, YOLO_WEIGHTS)
+                _models['yolo'] = (net, net.getUnconnectedOutLayersNames())
+            else:
+                logger.warning(f"YOLO weights not found at {YOLO_WEIGHTS}, using Haar cascade")
+                _models['yolo'] = None
+        return _models['yolo']
+
+
+def _haar_regions(small):
+    gray = cv2.equalizeHist(cv2.cvtColor(small, cv2.COLOR_BGR2GRAY))
+    min_side = max(20, min(gray.shape) // 12)
+    faces = _haar().detectMultiScale(gray, scaleFactor=1.1, minNeighbors=5, minSize=(min_side, min_side))
+    return [tuple(int(v) for v in face) for face in faces]
+
+
+def _yolo_regions(small, yolo):
+    net, output_names = yolo
+    blob = cv2.dnn.blobFromImage(small, 1 / 255.0, (YOLO_INPUT_SIZE, YOLO_INPUT_SIZE), swapRB=True, crop=False)
+    with _yolo_lock:
+        net.setInput(blob)
+        outputs = net.forward(output_names)
+    height, width = small.shape[:2]
+    regions = []
+    for output in outputs:
+        for row in output:
+            scores = row[5:]
+            if np.argmax(scores) != YOLO_PERSON_CLASS or scores[YOLO_PERSON_CLASS] < YOLO_MIN_CONFIDENCE:
+                continue
+            cx, cy, w, h = row[:4] * np.array([width, height, width, height])
+            regions.append((int(cx - w / 2), int(cy - h / 2), int(w), int(h)))
+    return regions
+
+
+def localizer(detector_backend):
+    """The first stage run in front of detector_backend: 'haar', 'yolo' or 'off'"""
+    if LOCALIZER == 'auto':
+        return 'off' if detector_backend == 'opencv' else 'haar'
+    return LOCALIZER
+
+
+def locate_portrait(img, detector_backend):
+    """
+    Find the portrait region of a document photo on a downscaled copy.
+    Returns (x, y, w, h) in full-resolution coordinates, or None if nothing
+    was found, or no first stage runs for detector_backend, and the whole
+    image should be searched.
+    """
+    stage = localizer(detector_backend)
+    if stage == 'off':
+        return None
+
+    height, width = img.shape[:2]
+    scale = min(1.0, LOCALIZE_MAX_SIDE / max(height, width))
+    small = cv2.resize(img, (int(width * scale), int(height * scale)), interpolation=cv2.INTER_AREA) \
+        if scale < 1.0 else img
+
+    yolo = _yolo() if stage == 'yolo' else None
+    regions = _yolo_regions(small, yolo) if yolo else _haar_regions(small)
+    if not regions:
+        return None
+
+    # The portrait is the largest face/person on the card
+    x, y, w, h = max(regions, key=lambda region: region[2] * region[3])
+    x, y, w, h = (v / scale for v in (x, y, w, h))
+    x0 = int(max(0, x - w * LOCALIZE_MARGIN))
+    y0 = int(max(0, y - h * LOCALIZE_MARGIN))
+    x1 = int(min(width, x + w * (1 + LOCALIZE_MARGIN)))
+    y1 = int(min(height, y + h * (1 + LOCALIZE_MARGIN)))
+    if x1 <= x0 or y1 <= y0:
+        return None
+    return x0, y0, x1 - x0, y1 - y0
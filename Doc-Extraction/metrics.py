@@ -0,0 +1,204 @@
+import time
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds in seconds, from fast cache hits to slow full-resolution inference
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+STAGE_LABELS = ('route', 'stage', 'model', 'detector')
+REQUEST_LABELS = ('route', 'method', 'status')
+
+_route = contextvars.ContextVar('metrics_route', default='')
+_timings = contextvars.ContextVar('metrics_timings', default=None)
+
+# Every Histogram and Counter, in creation order, for render()
+_metrics = []
+
+# Model names come from requests; only these become label values, the rest
+# are recorded as OTHER_MODEL so clients cannot create unbounded series
+_models = set()
+OTHER_MODEL = 'other'
+
+
+def allow_models(names):
+    """Record these model names as label values"""
+    _models.update(names)
+
+
+def model_label(model_name):
+    """model_name as a label value: itself when allowed, empty or OTHER_MODEL otherwise"""
+    if not model_name or model_name in _models:
+        return model_name or ''
+    return OTHER_MODEL
+
+
+class Histogram:
+    """Cumulative-bucket histogram keyed by label values, Prometheus style"""
+
+    def __init__(self, name, help_text, label_names, buckets=BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def observe(self, value, labels):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series["buckets"][i] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for labels, series in sorted(self._series.items()):
+                base = _format_labels(self.label_names, labels)
+                for bound, count in zip(self.buckets, series["buckets"]):
+                    lines.append(f'{self.name}_bucket{{{base},le="{bound}"}} {count}')
+                lines.append(f'{self.name}_bucket{{{base},le="+Inf"}} {series["count"]}')
+                lines.append(f"{self.name}_sum{{{base}}} {series['sum']:.6f}")
+                lines.append(f"{self.name}_count{{{base}}} {series['count']}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name, help_text, label_names):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self._values = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def inc(self, labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{{{_format_labels(self.label_names, labels)}}} {value}")
+        return lines
+
+
+def _escape(value):
+    """A label value escaped as the text exposition format requires"""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values):
+    return ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+
+
+stage_duration = Histogram(
+    'face_stage_duration_seconds', 'Time spent in each pipeline stage', STAGE_LABELS
+)
+request_duration = Histogram(
+    'face_request_duration_seconds', 'End-to-end request latency', ('route', 'method')
+)
+requests_total = Counter('face_requests_total', 'Requests served', REQUEST_LABELS)
+
+# name -> (help, type, callable) for values read from other modules at scrape time
+_collectors = {}
+
+
+def register(name, help_text, collect, kind='gauge'):
+    """
+    Expose a value computed at scrape time; collect() returns a mapping of
+    label tuples ((name, value), ...) to numbers.
+    """
+    _collectors[name] = (help_text, kind, collect)
+
+
+@contextmanager
+def stage(name, model='', detector=''):
+    """Time a pipeline stage for the histograms and the current request's timings"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        stage_duration.observe(elapsed, (_route.get(), name, model_label(model), detector or ''))
+        timings = _timings.get()
+        if timings is not None:
+            entry = {"stage": name, "ms": round(elapsed * 1000, 3)}
+            if model:
+                entry["model"] = model
+            if detector:
+                entry["detector"] = detector
+            timings.append(entry)
+
+
+def start_request(route, collect_timings=False):
+    """Label following stages with route, optionally recording per-request timings"""
+    _route.set(route)
+    _timings.set([] if collect_timings else None)
+
+
+def request_timings():
+    return _timings.get()
+
+
+def render():
+    """All metrics in the Prometheus text exposition format"""
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    for name, (help_text, kind, collect) in sorted(_collectors.items()):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        try:
+            values = collect()
+        except Exception as e:
+            logger.error(f"Failed to collect {name}: {str(e)}")
+            continue
+        for labels, value in sorted(values.items()):
+            label_text = _format_labels(*zip(*labels)) if labels else ''
+            lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+    return '\n'.join(lines) + '\n'
+
+
+def init_app(app):
+    """
+    Record request latency for a Flask app and, when the client asks with
+    ?timings=1, a timings form field or an X-Timings header, add a per-stage
+    'timings' block to JSON responses.
+    """
+    from flask import g, request
+
+    @app.before_request
+    def _start_timer():
+        g.metrics_start = time.perf_counter()
+        wants_timings = '1' in (
+            request.args.get('timings'), request.headers.get('X-Timings'),
+            request.form.get('timings') if request.mimetype == 'multipart/form-data' else None
+        )
+        rule = request.url_rule.rule if request.url_rule else 'unmatched'
+        start_request(rule, collect_timings=wants_timings)
+
+    @app.after_request
+    def _record(response):
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        if 'metrics_start' in g:
+            request_duration.observe(time.perf_counter() - g.metrics_start, (route, request.method))
+        requests_total.inc((route, request.method, str(response.status_code)))
+
+        timings = request_timings()
+        if timings is not None and response.is_json and not response.is_streamed:
+            body = response.get_json()
+            if isinstance(body, dict):
+                body["timings"] = timings
+                response.set_data(app.json.dumps(body))
+        return response
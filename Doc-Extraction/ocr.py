@@ -0,0 +1,170 @@
+import os
+import re
+import logging
+import threading
+import contextvars
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import numpy as np
+
+import metrics
+import pipeline
+
+logger = logging.getLogger(__name__)
+
+# Extract Aadhaar fields on /verify unless the request says otherwise
+OCR_ENABLED = os.environ.get('FACE_OCR', '0') == '1'
+OCR_LANGUAGES = [lang.strip() for lang in os.environ.get('FACE_OCR_LANGS', 'en').split(',') if lang.strip()]
+OCR_WORKERS = int(os.environ.get('FACE_OCR_WORKERS', '1'))
+# Extractions running or waiting for a worker; requests beyond this skip OCR
+OCR_QUEUE = int(os.environ.get('FACE_OCR_QUEUE', str(4 * OCR_WORKERS)))
+# Seconds a response waits for its fields once verification is done
+OCR_TIMEOUT = float(os.environ.get('FACE_OCR_TIMEOUT', '10'))
+
+# Text regions of an Aadhaar front side relative to the detected face box,
+# as (left, top, right, bottom) in face widths/heights from its top-left
+# corner: name, date of birth and gender are printed right of the portrait,
+# the number centred below it
+REGIONS = {
+    'details': (1.2, -0.4, 6.0, 1.8),
+    'number': (-0.6, 1.6, 6.0, 3.2)
+}
+
+DOB_PATTERN = re.compile(r'(\d{2})\s*[/-]\s*(\d{2})\s*[/-]\s*(\d{4})')
+YEAR_PATTERN = re.compile(r'\b(19|20)\d{2}\b')
+NUMBER_PATTERN = re.compile(r'(?:[\dX]{4}\s*){2}\d{4}')
+GENDER_PATTERN = re.compile(r'\b(male|female|transgender)\b', re.IGNORECASE)
+# Lines in the details region that are labels or headings, not the name
+NOT_A_NAME = re.compile(r'government|india|dob|birth|year|male|female|father|address|\d', re.IGNORECASE)
+
+_reader = None
+_reader_lock = threading.Lock()
+_executor = ThreadPoolExecutor(max_workers=OCR_WORKERS, thread_name_prefix='ocr')
+_queued = threading.BoundedSemaphore(OCR_QUEUE)
+
+
+def reader():
+    """The EasyOCR reader, created once per process and kept resident"""
+    global _reader
+    with _reader_lock:
+        if _reader is None:
+            import easyocr
+            _reader = easyocr.Reader(OCR_LANGUAGES, gpu=False, verbose=False)
+        return _reader
+
+
+def regions(img, face):
+    """Crops of the text regions around a face box given in img coordinates"""
+    height, width = img.shape[:2]
+    x, y, w, h = face
+    crops = {}
+    for name, (left, top, right, bottom) in REGIONS.items():
+        x0, y0 = max(0, int(x + left * w)), max(0, int(y + top * h))
+        x1, y1 = min(width, int(x + right * w)), min(height, int(y + bottom * h))
+        if x1 - x0 > 8 and y1 - y0 > 8:
+            crops[name] = img[y0:y1, x0:x1]
+    return crops
+
+
+def _lines(crop):
+    """Recognized text lines of a crop in reading order, with confidences"""
+    results = reader().readtext(crop, detail=1, paragraph=False)
+    results.sort(key=lambda result: (min(point[1] for point in result[0]), min(point[0] for point in result[0])))
+    return [(text.strip(), float(confidence)) for _, text, confidence in results if text.strip()]
+
+
+def mask_number(text):
+    """Only the last four digits of an Aadhaar number are ever returned"""
+    digits = re.sub(r'[^\dX]', '', text.upper())
+    return f"XXXX XXXX {digits[-4:]}" if len(digits) == 12 else None
+
+
+def parse_fields(details, number):
+    fields = {"name": None, "dob": None, "gender": None, "aadhaar_number": None}
+    confidences = []
+
+    name_candidates = []
+    for text, confidence in details:
+        dob = DOB_PATTERN.search(text)
+        if dob and fields["dob"] is None:
+            fields["dob"] = '/'.join(dob.groups())
+            confidences.append(confidence)
+        elif fields["dob"] is None and 'birth' in text.lower() and YEAR_PATTERN.search(text):
+            fields["dob"] = YEAR_PATTERN.search(text).group(0)
+            confidences.append(confidence)
+        gender = GENDER_PATTERN.search(text)
+        if gender and fields["gender"] is None:
+            fields["gender"] = gender.group(1).capitalize()
+        if fields["dob"] is None and not NOT_A_NAME.search(text) and len(re.sub(r'[^A-Za-z]', '', text)) >= 3:
+            name_candidates.append((text, confidence))
+    if name_candidates:
+        # The name is the last plain line above the date of birth
+        fields["name"], confidence = name_candidates[-1]
+        confidences.append(confidence)
+
+    for text, confidence in details + number:
+        match = NUMBER_PATTERN.search(text.upper())
+        if match:
+            fields["aadhaar_number"] = mask_number(match.group(0))
+            confidences.append(confidence)
+            break
+
+    fields["confidence"] = round(min(confidences), 4) if confidences else 0.0
+    return fields
+
+
+def extract_fields(analysis, data=None):
+    """
+    Read the name, date of birth, gender and masked number of an Aadhaar card
+    from the text regions next to its portrait. Reads the full-resolution
+    array kept by analyze_image(keep_image=True); the document is only
+    decoded here when detection came from the cache.
+    """
+    face_index = pipeline.primary_face(analysis)
+    if analysis["error"] or face_index is None:
+        return {"error": "No portrait found to locate the text fields"}
+
+    img = analysis.get("image")
+    if img is None:
+        with metrics.stage('decode'):
+            img = pipeline.decode_image(data)
+
+    # Facial areas are in original image coordinates, as is the full decode
+    area = analysis["faces"][face_index]["facial_area"]
+    face = tuple(area.get(field, 0) for field in ('x', 'y', 'w', 'h'))
+    if face[2] <= 0 or face[3] <= 0:
+        return {"error": "No portrait found to locate the text fields"}
+
+    with metrics.stage('ocr'):
+        crops = regions(np.ascontiguousarray(img), face)
+        details = _lines(crops['details']) if 'details' in crops else []
+        number = _lines(crops['number']) if 'number' in crops else []
+    return parse_fields(details, number)
+
+
+def submit(analysis, data):
+    """
+    Start field extraction on the OCR executor; returns a Future.
+    When OCR_QUEUE extractions are already running or waiting, OCR is
+    skipped and the Future holds an error entry instead.
+    """
+    if not _queued.acquire(blocking=False):
+        logger.warning("OCR queue full, skipping field extraction")
+        future = Future()
+        future.set_result({"error": "OCR is at capacity, fields were not extracted"})
+        return future
+    # Copy the request context so OCR timings are labeled with the route
+    future = _executor.submit(contextvars.copy_context().run, extract_fields, analysis, data)
+    future.add_done_callback(lambda _: _queued.release())
+    return future
+
+
+def result(future, timeout=OCR_TIMEOUT):
+    """Fields from a submitted extraction, or an error entry"""
+    try:
+        return future.result(timeout=timeout)
+    except Exception as e:
+        # An extraction still waiting for a worker is dropped rather than run for nobody
+        future.cancel()
+        logger.error(f"Error extracting document fields: {str(e)}")
+        return {"error": str(e) or "OCR timed out"}
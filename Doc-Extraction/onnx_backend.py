@@ -0,0 +1,222 @@
+import os
+import glob
+import json
+import logging
+import argparse
+import threading
+
+import cv2
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# 'keras' runs DeepFace's TensorFlow models; 'onnx' runs exported graphs
+# where one exists for the model and falls back to Keras otherwise
+EMBEDDING_BACKEND = os.environ.get('FACE_EMBEDDING_BACKEND', 'keras')
+ONNX_DIR = os.environ.get('FACE_ONNX_DIR', os.path.join(HERE, 'onnx_models'))
+# 'fp32', 'fp16' or 'int8'
+ONNX_PRECISION = os.environ.get('FACE_ONNX_PRECISION', 'fp32')
+PRECISIONS = ('fp32', 'fp16', 'int8')
+ONNX_THREADS = int(os.environ.get('TF_NUM_INTRAOP_THREADS', '0'))
+# Largest cosine distance between backends for the same face before parity fails
+PARITY_TOLERANCE = 0.02
+
+_embedders = {}
+_lock = threading.Lock()
+
+
+def model_path(model_name, precision=ONNX_PRECISION, root=ONNX_DIR):
+    suffix = '' if precision == 'fp32' else f".{precision}"
+    return os.path.join(root, f"{model_name}{suffix}.onnx")
+
+
+def metadata_path(model_name, root=ONNX_DIR):
+    return os.path.join(root, f"{model_name}.json")
+
+
+def _onnxruntime():
+    """onnxruntime if installed, imported only once an ONNX model is loaded"""
+    try:
+        import onnxruntime
+    except ImportError:  # Fall back to OpenCV's DNN module
+        return None
+    return onnxruntime
+
+
+class OnnxEmbedder:
+    """
+    Exported recognition model run by onnxruntime, or by cv2.dnn when
+    onnxruntime is not installed. Takes the same NHWC float32 batches
+    as the Keras model it was exported from.
+    """
+
+    def __init__(self, path, input_size):
+        self.path = path
+        self.input_size = tuple(input_size)
+        onnxruntime = _onnxruntime()
+        if onnxruntime is not None:
+            options = onnxruntime.SessionOptions()
+            options.intra_op_num_threads = ONNX_THREADS
+            options.inter_op_num_threads = 1
+            self._session = onnxruntime.InferenceSession(
+                path, sess_options=options, providers=['CPUExecutionProvider']
+            )
+            self._input_name = self._session.get_inputs()[0].name
+            self.runtime = 'onnxruntime'
+        else:
+            self._net = cv2.dnn.readNetFromONNX(path)
+            # cv2.dnn networks are not safe to run from several threads at once
+            self._net_lock = threading.Lock()
+            self.runtime = 'cv2.dnn'
+
+    def embed(self, batch):
+        batch = np.ascontiguousarray(batch, dtype=np.float32)
+        if self.runtime == 'onnxruntime':
+            return np.asarray(self._session.run(None, {self._input_name: batch})[0], dtype=np.float32)
+        with self._net_lock:
+            self._net.setInput(batch)
+            return np.asarray(self._net.forward(), dtype=np.float32).reshape(len(batch), -1)
+
+
+def load_embedder(model_name, precision=ONNX_PRECISION, root=ONNX_DIR):
+    """ONNX embedder for an exported model, or None if it has not been exported"""
+    path = model_path(model_name, precision, root)
+    if not os.path.isfile(path) or not os.path.isfile(metadata_path(model_name, root)):
+        return None
+    with open(metadata_path(model_name, root)) as f:
+        return OnnxEmbedder(path, json.load(f)["input_size"])
+
+
+def backend(model_name):
+    """
+    (backend, precision) that embeds model_name, for cache keys: ('onnx', the
+    configured precision) when an export is served, ('keras', 'fp32') otherwise.
+    Decided from the exported files, so no model is loaded to answer.
+    """
+    if (EMBEDDING_BACKEND == 'onnx' and os.path.isfile(model_path(model_name))
+            and os.path.isfile(metadata_path(model_name))):
+        return 'onnx', ONNX_PRECISION
+    return 'keras', 'fp32'
+
+
+def get_embedder(model_name):
+    """
+    Cached ONNX embedder for a model, or None when the ONNX backend is off
+    or no exported graph exists for the model at the configured precision
+    """
+    if EMBEDDING_BACKEND != 'onnx':
+        return None
+    with _lock:
+        if model_name not in _embedders:
+            embedder = load_embedder(model_name)
+            if embedder is not None:
+                logger.info(f"Serving {model_name} from {embedder.path} with {embedder.runtime}")
+            else:
+                logger.warning(f"No {ONNX_PRECISION} ONNX export of {model_name} in {ONNX_DIR}, using Keras")
+            _embedders[model_name] = embedder
+        return _embedders[model_name]
+
+
+def export(model_name, precision='fp32', root=ONNX_DIR):
+    """
+    Export a DeepFace Keras model to ONNX, optionally quantized.
+    Needs tf2onnx; fp16 also needs onnxconverter-common and int8 onnxruntime.
+    """
+    import tensorflow as tf
+    import tf2onnx
+    import pipeline
+
+    client = pipeline.deepface().build_model(model_name)
+    width, height = client.input_shape
+    os.makedirs(root, exist_ok=True)
+
+    fp32_path = model_path(model_name, 'fp32', root)
+    if not os.path.isfile(fp32_path):
+        signature = (tf.TensorSpec((None, height, width, 3), tf.float32, name='input'),)
+        tf2onnx.convert.from_keras(client.model, input_signature=signature, opset=13, output_path=fp32_path)
+        with open(metadata_path(model_name, root), 'w') as f:
+            json.dump({"input_size": [width, height], "layout": "NHWC"}, f)
+
+    path = model_path(model_name, precision, root)
+    if precision == 'fp16':
+        import onnx
+        from onnxconverter_common import float16
+        # Inputs and outputs stay float32 so callers are unchanged
+        onnx.save(float16.convert_float_to_float16(onnx.load(fp32_path), keep_io_types=True), path)
+    elif precision == 'int8':
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        quantize_dynamic(fp32_path, path, weight_type=QuantType.QInt8)
+    logger.info(f"Exported {model_name} ({precision}) to {path}")
+    return path
+
+
+def parity(model_names, paths, precision=ONNX_PRECISION):
+    """
+    Embed the faces of the given images with both backends.
+    Returns, per model, the largest cosine distance between the two embeddings
+    of a face and whether every pairwise verification decision agrees.
+    """
+    import pipeline
+
+    faces = []
+    for path in paths:
+        analysis = pipeline.analyze_image(path)
+        faces.extend(face["face"] for face in analysis["faces"])
+    if not faces:
+        raise ValueError("No faces found in the parity images")
+
+    report = {}
+    for model_name in model_names:
+        embedder = load_embedder(model_name, precision)
+        if embedder is None:
+            report[model_name] = {"error": f"No {precision} ONNX export available"}
+            continue
+        reference = np.stack([pipeline.keras_forward(model_name, [face])[0] for face in faces])
+        candidate = embedder.embed(pipeline.prepare_batch(faces, *embedder.input_size))
+
+        drift = max(
+            pipeline.find_distance(r, c, "cosine") for r, c in zip(reference, candidate)
+        )
+        threshold = pipeline.find_threshold(model_name, "cosine")
+        agree, pairs = 0, 0
+        for i in range(len(faces)):
+            for j in range(i + 1, len(faces)):
+                pairs += 1
+                agree += (pipeline.find_distance(reference[i], reference[j]) <= threshold) == \
+                    (pipeline.find_distance(candidate[i], candidate[j]) <= threshold)
+        report[model_name] = {
+            "precision": precision,
+            "runtime": embedder.runtime,
+            "faces": len(faces),
+            "max_cosine_drift": round(drift, 5),
+            "decision_agreement": round(agree / pairs, 4) if pairs else 1.0,
+            "passed": drift <= PARITY_TOLERANCE and agree == pairs
+        }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export and check ONNX embedding models")
+    parser.add_argument("command", choices=["export", "parity"])
+    parser.add_argument("--models", default="Facenet,ArcFace", help="Comma separated models")
+    parser.add_argument("--precision", default=ONNX_PRECISION, choices=PRECISIONS)
+    parser.add_argument("--images", nargs="*", default=None, help="Images for the parity check")
+    args = parser.parse_args()
+
+    model_names = [name.strip() for name in args.models.split(',') if name.strip()]
+    if args.command == 'export':
+        for model_name in model_names:
+            export(model_name, args.precision)
+        return 0
+
+    paths = args.images or sorted(glob.glob(os.path.join(HERE, 'sample_image*')))
+    report = parity(model_names, paths, args.precision)
+    print(json.dumps(report, indent=2))
+    return 0 if all(entry.get("passed") for entry in report.values()) else 1
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    raise SystemExit(main())
@@ -0,0 +1,449 @@
+import io
+import os
+import logging
+
+import cv2
+import numpy as np
+from PIL import Image
+
+import batching
+import cache
+import localize
+import metrics
+import onnx_backend
+import shm_transport
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DETECTOR = 'opencv'
+
+# Decode large uploads at reduced resolution, keeping the smallest expected
+# face (MIN_FACE_FRACTION of the shorter side) at least MIN_FACE_PX wide
+ADAPTIVE_DECODE = os.environ.get('FACE_ADAPTIVE_DECODE', '1') == '1'
+MIN_FACE_PX = int(os.environ.get('FACE_MIN_FACE_PX', '64'))
+MIN_FACE_FRACTION = float(os.environ.get('FACE_MIN_FACE_FRACTION', '0.15'))
+
+# libjpeg scales by these factors during the DCT, so reduced decodes are cheap
+REDUCED_DECODE_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8
+}
+EXIF_ORIENTATION = 0x0112
+
+# model_name that selects the cascade: the models are tried in order, and a
+# later one runs only while the distance is within CASCADE_BAND (a fraction
+# of the threshold) of the previous model's threshold
+CASCADE = 'cascade'
+CASCADE_MODELS = [name.strip() for name in os.environ.get('FACE_CASCADE_MODELS', 'OpenFace,ArcFace').split(',')
+                  if name.strip()]
+CASCADE_BAND = float(os.environ.get('FACE_CASCADE_BAND', '0.15'))
+
+
+def deepface():
+    """
+    The DeepFace module, imported on first use: it pulls in TensorFlow and
+    Keras, which processes that never detect or embed should not pay for
+    """
+    from deepface import DeepFace
+    return DeepFace
+
+
+# DeepFace 0.0.89's verification thresholds, copied so that comparing
+# embeddings never imports DeepFace (and TensorFlow) in serving processes
+THRESHOLDS = {
+    "VGG-Face": {"cosine": 0.68, "euclidean": 1.17, "euclidean_l2": 1.17},
+    "Facenet": {"cosine": 0.40, "euclidean": 10, "euclidean_l2": 0.80},
+    "Facenet512": {"cosine": 0.30, "euclidean": 23.56, "euclidean_l2": 1.04},
+    "ArcFace": {"cosine": 0.68, "euclidean": 4.15, "euclidean_l2": 1.13},
+    "Dlib": {"cosine": 0.07, "euclidean": 0.6, "euclidean_l2": 0.4},
+    "SFace": {"cosine": 0.593, "euclidean": 10.734, "euclidean_l2": 1.055},
+    "OpenFace": {"cosine": 0.10, "euclidean": 0.55, "euclidean_l2": 0.55},
+    "DeepFace": {"cosine": 0.23, "euclidean": 64, "euclidean_l2": 0.64},
+    "DeepID": {"cosine": 0.015, "euclidean": 45, "euclidean_l2": 0.17},
+    "GhostFaceNet": {"cosine": 0.65, "euclidean": 35.71, "euclidean_l2": 1.10},
+}
+DEFAULT_THRESHOLD = 0.4
+
+if not CASCADE_MODELS:
+    raise ValueError("FACE_CASCADE_MODELS must name at least one model")
+for _name in CASCADE_MODELS:
+    if _name not in THRESHOLDS:
+        raise ValueError(f"Unknown model in FACE_CASCADE_MODELS: {_name}")
+
+
+def find_threshold(model_name, distance_metric="cosine"):
+    """DeepFace's verification threshold for a model and metric"""
+    return THRESHOLDS.get(model_name, {}).get(distance_metric, DEFAULT_THRESHOLD)
+
+
+def decode_image(data):
+    """Decode encoded image bytes into a BGR array without touching the disk"""
+    img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if img is None:
+        raise ValueError("Could not decode image")
+    return img
+
+
+def image_header(data):
+    """
+    Width and height of encoded image bytes as displayed (after EXIF rotation),
+    read from the header without decoding pixels.
+    Raises ValueError if the bytes are not a readable image.
+    """
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            width, height = img.size
+            orientation = img.getexif().get(EXIF_ORIENTATION, 1)
+    except Exception:
+        raise ValueError("Could not decode image")
+    # Orientations 5-8 rotate by 90 degrees
+    if orientation in (5, 6, 7, 8):
+        width, height = height, width
+    return width, height
+
+
+def reduction_factor(width, height):
+    """Largest decode reduction that keeps the smallest expected face above MIN_FACE_PX"""
+    expected_face = MIN_FACE_FRACTION * min(width, height)
+    factor = 1
+    for candidate in (2, 4, 8):
+        if expected_face / candidate >= MIN_FACE_PX:
+            factor = candidate
+    return factor
+
+
+def decode_scaled(data):
+    """
+    Decode image bytes at the smallest useful resolution, honouring EXIF orientation.
+    Returns the BGR array and the factor mapping its coordinates back to the original.
+    """
+    with metrics.stage('decode'):
+        width, height = image_header(data)
+        factor = reduction_factor(width, height) if ADAPTIVE_DECODE else 1
+        img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), REDUCED_DECODE_FLAGS[factor])
+    if img is None:
+        raise ValueError("Could not decode image")
+    return img, width / img.shape[1]
+
+
+def decode_full(data):
+    """
+    Decode image bytes once at full resolution, for stages that read small
+    print, and derive the reduced image detection runs on by resizing it.
+    Returns the full array, the reduced array and the reduced array's scale
+    relative to the original, as decode_scaled does.
+    """
+    with metrics.stage('decode'):
+        full = decode_image(data)
+        height, width = full.shape[:2]
+        factor = reduction_factor(width, height) if ADAPTIVE_DECODE else 1
+        reduced = full if factor == 1 else cv2.resize(
+            full, (-(-width // factor), -(-height // factor)), interpolation=cv2.INTER_AREA
+        )
+    return full, reduced, width / reduced.shape[1]
+
+
+def load_image(image):
+    """
+    Decode an image path or bytes once; arrays are passed through untouched.
+    Returns the BGR array and its scale relative to the original image.
+    """
+    if isinstance(image, np.ndarray):
+        return image, 1.0
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        return decode_scaled(bytes(image))
+    if not os.path.isfile(image):
+        raise ValueError(f"Could not read image: {image}")
+    with open(image, 'rb') as f:
+        return decode_scaled(f.read())
+
+
+def _scale_faces(faces, scale):
+    """Map facial areas detected on a reduced decode back to original coordinates"""
+    if scale == 1.0:
+        return faces
+    for face in faces:
+        area = face.get('facial_area', {})
+        for field in ('x', 'y', 'w', 'h'):
+            area[field] = int(round(area.get(field, 0) * scale))
+        for eye in ('left_eye', 'right_eye'):
+            if area.get(eye) is not None:
+                area[eye] = (int(round(area[eye][0] * scale)), int(round(area[eye][1] * scale)))
+    return faces
+
+
+def _offset_faces(faces, x_offset, y_offset):
+    """Map facial areas detected on a crop back to full-image coordinates"""
+    for face in faces:
+        area = face.get('facial_area', {})
+        area['x'] = area.get('x', 0) + x_offset
+        area['y'] = area.get('y', 0) + y_offset
+        for eye in ('left_eye', 'right_eye'):
+            if area.get(eye) is not None:
+                area[eye] = (area[eye][0] + x_offset, area[eye][1] + y_offset)
+    return faces
+
+
+def _found_face(faces, img):
+    """False when DeepFace fell back to returning the whole frame"""
+    return any(
+        (face['facial_area'].get('w'), face['facial_area'].get('h')) != (img.shape[1], img.shape[0])
+        for face in faces
+    )
+
+
+def detect_faces(img, detector_backend=DEFAULT_DETECTOR, localize_portrait=False):
+    """
+    Run the face detector and aligner on a decoded image.
+    With localize_portrait, a cheap first stage finds the portrait on a
+    downscaled copy (for ID documents) and only that crop is searched at
+    full resolution; the whole frame is searched if the crop has no face.
+    DeepFace aligns faces inside extract_faces, so the 'detection' stage
+    timing includes alignment.
+    """
+    if localize_portrait and localize.localizer(detector_backend) != 'off':
+        with metrics.stage('localization', detector=localize.localizer(detector_backend)):
+            region = localize.locate_portrait(img, detector_backend)
+        if region is not None:
+            x, y, w, h = region
+            crop = img[y:y + h, x:x + w]
+            with metrics.stage('detection', detector=detector_backend):
+                faces = deepface().extract_faces(crop, detector_backend=detector_backend, enforce_detection=False)
+            if _found_face(faces, crop):
+                return _offset_faces(faces, x, y)
+
+    with metrics.stage('detection', detector=detector_backend):
+        return deepface().extract_faces(img, detector_backend=detector_backend, enforce_detection=False)
+
+
+def analyze_image(image, detector_backend=DEFAULT_DETECTOR, data=None, localize_portrait=False, keep_image=False):
+    """
+    Decode an image and detect its faces exactly once.
+    Returns a dictionary with the detected faces that both the embedding
+    step and the *_analysis response fields are built from.
+    When the encoded bytes are given, detections and embeddings are cached
+    under their content hash, so resubmitted images skip inference.
+    Positions are always reported in original image coordinates, even when
+    the image was decoded at reduced resolution.
+    With keep_image, encoded bytes are decoded once at full resolution, kept
+    on the analysis as "image" for OCR, and detection runs on a reduced copy
+    (not set on cache hits, which decode nothing).
+    """
+    if data is None and isinstance(image, (bytes, bytearray)):
+        data = image
+    digest = cache.content_digest(data) if data is not None and cache.detections else None
+    key = cache.cache_key(digest, detector_backend, 'portrait' if localize_portrait else 'full') if digest else None
+    analysis = {"faces": [], "embeddings": {}, "detector_backend": detector_backend, "error": None,
+                "digest": digest, "cache_key": key}
+
+    if key:
+        faces = cache.detections.get(key)
+        if faces is not None:
+            analysis["faces"] = list(faces)
+            return analysis
+
+    try:
+        if keep_image and isinstance(image, (bytes, bytearray, memoryview)):
+            analysis["image"], img, scale = decode_full(bytes(image))
+        else:
+            img, scale = load_image(image)
+        if shm_transport.INFERENCE_PROCESSES:
+            # Only descriptors of the decoded image cross to the inference process
+            with metrics.stage('detection', detector=detector_backend):
+                faces = shm_transport.detect(img, detector_backend, localize_portrait)
+        else:
+            faces = detect_faces(img, detector_backend, localize_portrait=localize_portrait)
+        analysis["faces"] = _scale_faces(faces, scale)
+        if key:
+            cache.detections.set(key, analysis["faces"])
+    except Exception as e:
+        logger.error(f"Error extracting faces: {str(e)}")
+        analysis["error"] = str(e)
+    return analysis
+
+
+def represent_face(face, model_name="Facenet"):
+    """
+    Embed a face crop returned by analyze_image without detecting it again.
+    Crops are RGB scaled to [0, 1]; DeepFace expects BGR input.
+    """
+    result = deepface().represent(
+        face[:, :, ::-1],
+        model_name=model_name,
+        detector_backend='skip',
+        enforce_detection=False
+    )
+    return np.asarray(result[0]["embedding"], dtype=np.float32)
+
+
+def prepare_batch(faces, width, height):
+    """
+    Stack face crops into one model input batch, with the same preprocessing
+    as the 'skip' path of DeepFace.represent: BGR, [0, 1], model input size
+    """
+    return np.stack([
+        cv2.resize(np.asarray(face, dtype=np.float32)[:, :, ::-1], (width, height))
+        for face in faces
+    ])
+
+
+# Models whose DeepFace client L2-normalizes the graph output in find_embeddings
+L2_NORMALIZED = {'VGG-Face'}
+
+
+def postprocess(model_name, embeddings):
+    """Apply the DeepFace client's post-processing to raw graph outputs, one row per face"""
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    if model_name in L2_NORMALIZED:
+        embeddings = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+    return embeddings
+
+
+def keras_forward(model_name, faces):
+    """
+    Embed several face crops with one forward pass of the Keras model.
+    The raw graph output goes through postprocess(), so embeddings match
+    those of DeepFace.represent and its distance thresholds.
+    Models without a Keras graph (Dlib) fall back to one call per face.
+    """
+    client = deepface().build_model(model_name)
+    keras_model = getattr(client, 'model', None)
+    if not hasattr(keras_model, 'predict') or not hasattr(client, 'input_shape'):
+        return [represent_face(face, model_name) for face in faces]
+
+    batch = prepare_batch(faces, *client.input_shape)
+    return list(postprocess(model_name, keras_model(batch, training=False)))
+
+
+def forward_batch(model_name, faces):
+    """Embed several face crops in one call of the configured embedding backend"""
+    if not faces:
+        return []
+    embedder = onnx_backend.get_embedder(model_name)
+    if embedder is not None:
+        return list(postprocess(model_name, embedder.embed(prepare_batch(faces, *embedder.input_size))))
+    return keras_forward(model_name, faces)
+
+
+def forward(model_name, faces):
+    """forward_batch in the inference processes when they are enabled, else in this one"""
+    if shm_transport.INFERENCE_PROCESSES:
+        return shm_transport.embed(model_name, faces)
+    return forward_batch(model_name, faces)
+
+
+# Shared scheduler that batches embedding work across concurrent requests
+batcher = batching.EmbeddingBatcher(forward) if batching.BATCHING_ENABLED else None
+
+if batcher is not None:
+    metrics.register(
+        'face_batch_queue_depth', 'Embedding requests waiting for a batch',
+        lambda: {(('model', name),): s["queue_depth"] for name, s in batcher.stats().items()}
+    )
+
+
+def embed_faces(faces, model_name="Facenet"):
+    """Embed face crops through the batching scheduler when it is enabled"""
+    if batcher is not None:
+        return batcher.embed(model_name, faces)
+    return forward(model_name, faces)
+
+
+def embed_analysis(analysis, model_name="Facenet"):
+    """Embed every face of an analysis, memoized per model on the analysis itself"""
+    if model_name not in analysis["embeddings"]:
+        key = None
+        if analysis.get("cache_key") and cache.embeddings:
+            # Backends and precisions produce slightly different embeddings
+            key = cache.cache_key(analysis["cache_key"], model_name, *onnx_backend.backend(model_name))
+
+        embeddings = cache.embeddings.get(key) if key else None
+        if embeddings is None:
+            with metrics.stage('embedding', model=model_name, detector=analysis["detector_backend"]):
+                embeddings = embed_faces([face["face"] for face in analysis["faces"]], model_name)
+            if key:
+                cache.embeddings.set(key, embeddings)
+        analysis["embeddings"][model_name] = embeddings
+    return analysis["embeddings"][model_name]
+
+
+def find_distance(source, target, distance_metric="cosine"):
+    """Distance between two embeddings using the DeepFace metric names"""
+    source = np.asarray(source, dtype=np.float32)
+    target = np.asarray(target, dtype=np.float32)
+    if distance_metric == "cosine":
+        return float(1 - np.dot(source, target) / (np.linalg.norm(source) * np.linalg.norm(target)))
+    if distance_metric == "euclidean":
+        return float(np.linalg.norm(source - target))
+    if distance_metric == "euclidean_l2":
+        return float(np.linalg.norm(source / np.linalg.norm(source) - target / np.linalg.norm(target)))
+    raise ValueError(f"Unsupported distance metric: {distance_metric}")
+
+
+def compare_analyses(selfie, document, model_name="Facenet", distance_metric="cosine"):
+    """
+    Compare the faces of two analyses the way DeepFace.verify does: the closest
+    pair of faces decides. Returns (verified, distance, threshold).
+    """
+    selfie_embeddings = embed_analysis(selfie, model_name)
+    document_embeddings = embed_analysis(document, model_name)
+    if not selfie_embeddings or not document_embeddings:
+        raise ValueError("No face available to compare")
+
+    with metrics.stage('distance', model=model_name):
+        distance = min(
+            find_distance(s, d, distance_metric)
+            for s in selfie_embeddings
+            for d in document_embeddings
+        )
+    threshold = find_threshold(model_name, distance_metric)
+    return distance <= threshold, distance, threshold
+
+
+cascade_decisions = metrics.Counter(
+    'face_cascade_decisions_total', 'Cascade verifications by the model that decided them', ('model',)
+)
+
+
+def cascade_analyses(selfie, document, distance_metric="cosine", models=None, band=None):
+    """
+    Compare two analyses with a cascade of models, cheapest first. A decision
+    is accepted once its distance is outside the uncertainty band around the
+    model's threshold; the last model always decides.
+    Returns (verified, distance, threshold, stages) where stages describes
+    every model that ran.
+    """
+    models = models or CASCADE_MODELS
+    if not models:
+        raise ValueError("The cascade needs at least one model")
+    band = CASCADE_BAND if band is None else band
+    stages = []
+    for model_name in models:
+        verified, distance, threshold = compare_analyses(selfie, document, model_name, distance_metric)
+        confident = abs(distance - threshold) > band * threshold
+        stages.append({
+            "model": model_name,
+            "distance": round(distance, 4),
+            "threshold": round(threshold, 4),
+            "verified": bool(verified),
+            "confident": confident
+        })
+        if confident:
+            break
+    cascade_decisions.inc((metrics.model_label(model_name),))
+    return verified, distance, threshold, stages
+
+
+def primary_face(analysis):
+    """Index of the most confident face of an analysis, or None if there is none"""
+    faces = analysis["faces"]
+    if not faces:
+        return None
+    return max(range(len(faces)), key=lambda i: faces[i].get('confidence', 0))
+
+
+def enrolled_analysis(embedding, model_name="Facenet"):
+    """Analysis stand-in for a stored embedding, comparable without an image"""
+    return {"faces": [], "embeddings": {model_name: [embedding]}, "detector_backend": None, "error": None, "digest": None, "cache_key": None}
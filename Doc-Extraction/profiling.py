@@ -0,0 +1,220 @@
+import os
+import sys
+import hmac
+import time
+import logging
+import cProfile
+import itertools
+import threading
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+PROFILE_DIR = os.environ.get('FACE_PROFILE_DIR', 'profiles')
+# The admin endpoint is disabled unless a token is configured
+PROFILE_TOKEN = os.environ.get('FACE_PROFILE_TOKEN', '')
+SAMPLE_INTERVAL_MS = float(os.environ.get('FACE_PROFILE_INTERVAL_MS', '5'))
+MAX_PROFILED_REQUESTS = 100
+MODES = ('cprofile', 'sample')
+# Innermost frames of threads blocked waiting for work; their samples are dropped
+IDLE_FRAMES = {
+    'threading.py:wait', 'selectors.py:select', 'socket.py:accept', 'connection.py:_recv', 'thread.py:_worker'
+}
+
+
+def authorized(token):
+    """Whether a request may control the profiler; always False without FACE_PROFILE_TOKEN"""
+    return bool(PROFILE_TOKEN) and hmac.compare_digest((token or '').encode(), PROFILE_TOKEN.encode())
+
+
+class StackSampler:
+    """
+    Samples the stacks of every busy thread in the process from a background
+    thread and counts the collapsed stacks, each rooted at its thread's name.
+    Work handed to the embedding batcher or the OCR pool is sampled where it
+    runs. Threads run untouched between samples.
+    """
+
+    def __init__(self, interval_ms=SAMPLE_INTERVAL_MS):
+        self.interval = interval_ms / 1000
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                if stack and stack[0] not in IDLE_FRAMES:
+                    stack.append(names.get(thread_id, str(thread_id)))
+                    self.stacks[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def write(self, path):
+        """Collapsed-stack output, as read by flamegraph.pl and speedscope"""
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+class _Finishing:
+    """WSGI response iterable that calls finish once the server closes it, after streaming the body"""
+
+    def __init__(self, iterable, finish):
+        self._iterable = iterable
+        self._finish = finish
+
+    def __iter__(self):
+        return iter(self._iterable)
+
+    def close(self):
+        try:
+            if hasattr(self._iterable, 'close'):
+                self._iterable.close()
+        finally:
+            self._finish()
+
+
+class Profiler:
+    """
+    Profiles the next N requests of a Flask app on demand.
+    Arming wraps app.wsgi_app and the last profiled request unwraps it again,
+    so nothing runs per request while the profiler is off. Routes served
+    outside the WSGI app (asgi.py) are profiled through call().
+
+    A profile covers a request until its response body has been sent, so
+    streamed responses are included. 'sample' mode samples every thread of
+    the process, so requests overlapping a profiled one show up in it too.
+    'cprofile' mode only sees the request's own thread: time spent in the
+    embedding batcher, the OCR pool or inference processes appears as
+    waiting on their futures.
+    """
+
+    def __init__(self, app, output_dir=PROFILE_DIR):
+        self.app = app
+        self.output_dir = output_dir
+        self._original = None
+        self._lock = threading.Lock()
+        self._cprofile_lock = threading.Lock()
+        self.mode = None
+        self.remaining = 0
+        self.interval_ms = SAMPLE_INTERVAL_MS
+        self.written = []
+        self._sequence = itertools.count(1)
+
+    def arm(self, mode='sample', requests=1, interval_ms=SAMPLE_INTERVAL_MS):
+        if mode not in MODES:
+            raise ValueError(f"Unsupported profiling mode: {mode}")
+        if not 1 <= requests <= MAX_PROFILED_REQUESTS:
+            raise ValueError(f"requests must be between 1 and {MAX_PROFILED_REQUESTS}")
+        os.makedirs(self.output_dir, exist_ok=True)
+        with self._lock:
+            self.mode = mode
+            self.remaining = requests
+            self.interval_ms = interval_ms
+            self.written = []
+            if self._original is None:
+                self._original = self.app.wsgi_app
+                self.app.wsgi_app = self._profiled
+        logger.info(f"Profiling the next {requests} requests with {mode}")
+
+    def disarm(self):
+        with self._lock:
+            self.remaining = 0
+            if self._original is not None:
+                self.app.wsgi_app = self._original
+                self._original = None
+
+    def status(self):
+        return {
+            "armed": self._original is not None,
+            "mode": self.mode,
+            "remaining": self.remaining,
+            "output_dir": os.path.abspath(self.output_dir),
+            "written": list(self.written)
+        }
+
+    def _claim(self):
+        """Take one of the remaining profiling slots; returns the wrapped app too"""
+        with self._lock:
+            original = self._original
+            if original is None or self.remaining <= 0:
+                return original or self.app.wsgi_app, False
+            self.remaining -= 1
+            if self.remaining == 0:
+                self.app.wsgi_app = original
+                self._original = None
+            return original, True
+
+    def _output_path(self, route, extension):
+        route = route.strip('/').replace('/', '_') or 'index'
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{next(self._sequence)}-{route}.{extension}"
+        return os.path.join(self.output_dir, name)
+
+    def _start(self, route):
+        """Start profiling a claimed request on this thread; returns the function that stops and saves it"""
+        # Only one cProfile profiler can be active per process, so requests
+        # that overlap a profiled one are sampled instead
+        if self.mode == 'cprofile' and self._cprofile_lock.acquire(blocking=False):
+            profile = cProfile.Profile()
+            profile.enable()
+
+            def finish():
+                profile.disable()
+                self._cprofile_lock.release()
+                self._save(profile.dump_stats, route, 'prof')
+            return finish
+
+        sampler = StackSampler(self.interval_ms)
+        sampler.start()
+
+        def finish():
+            sampler.stop()
+            self._save(sampler.write, route, 'folded')
+        return finish
+
+    def _profiled(self, environ, start_response):
+        wsgi_app, claimed = self._claim()
+        if not claimed:
+            return wsgi_app(environ, start_response)
+
+        finish = self._start(environ.get('PATH_INFO', '/'))
+        try:
+            result = wsgi_app(environ, start_response)
+        except BaseException:
+            finish()
+            raise
+        return _Finishing(result, finish)
+
+    def call(self, route, fn, *args):
+        """Run fn(*args) on this thread, profiled as a request to route while the profiler is armed"""
+        if self._original is None or not self._claim()[1]:
+            return fn(*args)
+        finish = self._start(route)
+        try:
+            return fn(*args)
+        finally:
+            finish()
+
+    def _save(self, write, route, extension):
+        path = self._output_path(route, extension)
+        try:
+            write(path)
+            self.written.append(path)
+            logger.info(f"Wrote profile {path}")
+        except Exception as e:
+            logger.error(f"Failed to write profile {path}: {str(e)}")
@@ -0,0 +1,199 @@
+import os
+import time
+import logging
+import threading
+
+import numpy as np
+
+import metrics
+import ocr
+import onnx_backend
+import pipeline
+import shm_transport
+
+logger = logging.getLogger(__name__)
+
+AVAILABLE_MODELS = ['Facenet', 'VGG-Face', 'OpenFace', 'DeepFace', 'ArcFace', 'Dlib']
+DEFAULT_MODEL = 'Facenet'
+
+# Weight files DeepFace looks for under $DEEPFACE_HOME/.deepface/weights
+WEIGHT_FILES = {
+    'Facenet': 'facenet_weights.h5',
+    'VGG-Face': 'vgg_face_weights.h5',
+    'OpenFace': 'openface_weights.h5',
+    'DeepFace': 'VGGFace2_DeepFace_weights_val-0.9034.h5',
+    'ArcFace': 'arcface_weights.h5',
+    'Dlib': 'dlib_face_recognition_resnet_model_v1.dat'
+}
+
+# 'full' serves every route; 'detect' workers load only their detector
+# backend and answer recognition routes with 503
+WORKER_PROFILE = os.environ.get('FACE_WORKER_PROFILE', 'full')
+# Routes, by view function name, that a detect-only worker serves
+DETECT_PROFILE_ENDPOINTS = {
+    'index', 'detect_faces', 'list_models', 'service_stats', 'prometheus_metrics', 'profile_requests'
+}
+
+# Comma separated lists; an empty value disables preloading for that kind.
+# Detect workers preload nothing, so they start without importing TensorFlow
+PRELOAD_MODELS = os.environ.get('FACE_PRELOAD_MODELS', '' if WORKER_PROFILE == 'detect' else DEFAULT_MODEL)
+PRELOAD_DETECTORS = os.environ.get(
+    'FACE_PRELOAD_DETECTORS', '' if WORKER_PROFILE == 'detect' else pipeline.DEFAULT_DETECTOR
+)
+
+for _name in pipeline.CASCADE_MODELS:
+    if _name not in AVAILABLE_MODELS:
+        raise ValueError(f"FACE_CASCADE_MODELS names {_name}, which is not one of {', '.join(AVAILABLE_MODELS)}")
+
+metrics.allow_models(AVAILABLE_MODELS + [pipeline.CASCADE])
+
+_stats = {}
+_lock = threading.Lock()
+
+
+def _parse_names(value):
+    if isinstance(value, str):
+        value = value.split(',')
+    return [name.strip() for name in value if name.strip()]
+
+
+def weights_cached(model_name):
+    """Whether a model's weights are already downloaded, so building it needs no network"""
+    home = os.environ.get('DEEPFACE_HOME', os.path.expanduser('~'))
+    return os.path.isfile(os.path.join(home, '.deepface', 'weights', WEIGHT_FILES[model_name]))
+
+
+def _rss_bytes():
+    """Resident set size of this process, or 0 where /proc is unavailable"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def _load(kind, name, build, warmup, backend=None):
+    rss_before = _rss_bytes()
+    start = time.perf_counter()
+    entry = {"kind": kind, "loaded": False}
+    if backend:
+        entry["backend"] = backend
+    try:
+        model = build()
+        entry["load_seconds"] = round(time.perf_counter() - start, 3)
+
+        start = time.perf_counter()
+        warmup()
+        entry["warmup_seconds"] = round(time.perf_counter() - start, 3)
+        entry["loaded"] = True
+
+        if hasattr(getattr(model, 'model', None), 'count_params'):
+            entry["parameters"] = int(model.model.count_params())
+    except Exception as e:
+        logger.error(f"Failed to load {kind} {name}: {str(e)}")
+        entry["error"] = str(e)
+    entry["memory_mb"] = round(max(0, _rss_bytes() - rss_before) / (1024 * 1024), 1)
+
+    with _lock:
+        _stats[f"{kind}:{name}"] = entry
+    return entry
+
+
+def load_model(model_name):
+    """
+    Build and warm a recognition model, recording load time and memory.
+    DeepFace and the ONNX backend cache built models, so later requests
+    reuse this instance.
+    """
+    def warmup():
+        pipeline.forward_batch(model_name, [np.zeros((224, 224, 3), dtype=np.float32)])
+
+    embedder = onnx_backend.get_embedder(model_name)
+    if embedder is not None:
+        entry = _load("model", model_name, lambda: embedder, warmup, backend=f"onnx:{embedder.runtime}")
+    else:
+        entry = _load("model", model_name, lambda: pipeline.deepface().build_model(model_name), warmup, backend="keras")
+    logger.info(f"Loaded model {model_name} in {entry.get('load_seconds', 0)}s")
+    return entry
+
+
+def load_detector(detector_backend):
+    """Build and warm a detector backend by running it on a blank frame"""
+    def warmup():
+        pipeline.deepface().extract_faces(
+            np.zeros((224, 224, 3), dtype=np.uint8),
+            detector_backend=detector_backend,
+            enforce_detection=False
+        )
+
+    # Detectors are built lazily by DeepFace, so the warm-up is the load
+    entry = _load("detector", detector_backend, lambda: None, warmup)
+    logger.info(f"Loaded detector {detector_backend} in {entry.get('warmup_seconds', 0)}s")
+    return entry
+
+
+def preload(models=PRELOAD_MODELS, detectors=PRELOAD_DETECTORS):
+    """Load and warm everything this process serves at start"""
+    if shm_transport.INFERENCE_PROCESSES:
+        # Models live in the inference processes, which load them as they start
+        shm_transport.pool()
+    else:
+        preload_models(models, detectors)
+    if ocr.OCR_ENABLED and serves_recognition():
+        load_ocr()
+
+
+def preload_models(models=PRELOAD_MODELS, detectors=PRELOAD_DETECTORS):
+    """Load and warm the configured models and detectors in this process"""
+    for detector_backend in _parse_names(detectors):
+        load_detector(detector_backend)
+    names = _parse_names(models)
+    if pipeline.CASCADE in names:
+        names = [name for name in names if name != pipeline.CASCADE] + pipeline.CASCADE_MODELS
+    for model_name in dict.fromkeys(names):
+        if model_name not in AVAILABLE_MODELS:
+            logger.warning(f"Skipping unknown model {model_name}")
+            continue
+        load_model(model_name)
+
+
+def load_ocr():
+    """Create the resident OCR reader so the first /verify does not pay for it"""
+    def warmup():
+        ocr.reader().readtext(np.full((32, 128, 3), 255, dtype=np.uint8))
+
+    entry = _load("ocr", ",".join(ocr.OCR_LANGUAGES), ocr.reader, warmup)
+    logger.info(f"Loaded OCR reader in {entry.get('load_seconds', 0)}s")
+    return entry
+
+
+def known_model(model_name):
+    """
+    Whether a request may name model_name: one of AVAILABLE_MODELS or the
+    cascade. Checked before anything per model (batcher threads, stores,
+    metric series) is created for it.
+    """
+    return model_name in AVAILABLE_MODELS or model_name == pipeline.CASCADE
+
+
+def serves_recognition():
+    return WORKER_PROFILE != 'detect'
+
+
+def init_app(app):
+    """Reject the recognition routes of a Flask app on detect-only workers"""
+    if serves_recognition():
+        return
+
+    from flask import jsonify, request
+
+    @app.before_request
+    def _detect_only():
+        if request.endpoint is not None and request.endpoint not in DETECT_PROFILE_ENDPOINTS:
+            return jsonify({'error': 'This worker only serves face detection'}), 503
+
+
+def model_stats():
+    """Load time and memory per preloaded model, keyed by '<kind>:<name>'"""
+    with _lock:
+        return {key: dict(entry) for key, entry in _stats.items()}
@@ -0,0 +1,126 @@
+import os
+import argparse
+import importlib
+import logging
+import multiprocessing
+
+from gunicorn.app.base import BaseApplication
+
+logger = logging.getLogger(__name__)
+
+
+def thread_env(threads):
+    """Environment that caps TensorFlow/OpenMP/MKL thread pools for one worker"""
+    return {
+        'TF_NUM_INTRAOP_THREADS': str(threads),
+        'TF_NUM_INTEROP_THREADS': '1',
+        'OMP_NUM_THREADS': str(threads),
+        'MKL_NUM_THREADS': str(threads),
+        'OPENBLAS_NUM_THREADS': str(threads)
+    }
+
+
+class FaceAuthApplication(BaseApplication):
+    """
+    Pre-forking gunicorn server for api.py or Newapi.py.
+    Without preload, every worker imports the app (and loads its models)
+    after fork, with its thread pools sized to its share of the cores.
+    """
+
+    def __init__(self, app_module, options, tf_threads, pin_cpus=False):
+        self.app_module = app_module
+        self.options = options
+        self.tf_threads = tf_threads
+        self.pin_cpus = pin_cpus
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+        self.cfg.set('post_fork', self.post_fork)
+        self.cfg.set('post_worker_init', self.post_worker_init)
+        self.cfg.set('worker_exit', self.worker_exit)
+
+    def load(self):
+        return importlib.import_module(self.app_module).app
+
+    def post_fork(self, server, worker):
+        # Runs in the worker before the app, and with it TensorFlow, is imported
+        os.environ.update(thread_env(self.tf_threads))
+        if self.pin_cpus and hasattr(os, 'sched_setaffinity'):
+            cores = sorted(os.sched_getaffinity(0))
+            slot = worker.age % max(1, len(cores) // self.tf_threads)
+            own = cores[slot * self.tf_threads:(slot + 1) * self.tf_threads]
+            if own:
+                os.sched_setaffinity(0, own)
+        server.log.info(f"Worker {worker.pid}: {self.tf_threads} inference threads")
+
+    def post_worker_init(self, worker):
+        import cv2
+        cv2.setNumThreads(self.tf_threads)
+        try:
+            import tensorflow as tf
+            tf.config.threading.set_intra_op_parallelism_threads(self.tf_threads)
+            tf.config.threading.set_inter_op_parallelism_threads(1)
+        except (ImportError, RuntimeError):
+            # RuntimeError: TensorFlow already initialized from the environment
+            pass
+
+    def worker_exit(self, server, worker):
+        # Let queued archive writes land before the worker goes away
+        module = importlib.import_module(self.app_module)
+        writer = getattr(module, 'archive_writer', None)
+        if writer is not None:
+            writer.flush()
+
+
+def main():
+    cores = multiprocessing.cpu_count()
+    parser = argparse.ArgumentParser(description="Serve the face authentication API with gunicorn")
+    parser.add_argument("--app", default="api", choices=["api", "Newapi"], help="Flask module to serve")
+    parser.add_argument("--bind", default="0.0.0.0:5000")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes (default: cores / tf-threads)")
+    parser.add_argument("--tf-threads", type=int, default=None, help="Inference threads per worker")
+    parser.add_argument("--http-threads", type=int, default=4, help="Request threads per worker")
+    parser.add_argument("--models", default=None, help="Comma separated models each worker preloads")
+    parser.add_argument("--inference-processes", type=int, default=None,
+                        help="Model-holding processes per worker, fed images through shared memory")
+    parser.add_argument("--pin-cpus", action="store_true", help="Pin each worker to its own cores")
+    parser.add_argument("--preload", action="store_true",
+                        help="Import the app before forking to share memory copy-on-write "
+                             "(TensorFlow is not fork-safe once it has started its thread pools)")
+    parser.add_argument("--timeout", type=int, default=120)
+    parser.add_argument("--graceful-timeout", type=int, default=30)
+    args = parser.parse_args()
+
+    if args.workers and not args.tf_threads:
+        tf_threads = max(1, cores // args.workers)
+    else:
+        tf_threads = args.tf_threads or min(2, cores)
+    workers = args.workers or max(1, cores // tf_threads)
+
+    if args.models is not None:
+        os.environ['FACE_PRELOAD_MODELS'] = args.models
+    if args.inference_processes is not None:
+        os.environ['FACE_INFERENCE_PROCESSES'] = str(args.inference_processes)
+    if args.preload:
+        os.environ.update(thread_env(tf_threads))
+
+    options = {
+        'bind': args.bind,
+        'workers': workers,
+        'worker_class': 'gthread',
+        'threads': args.http_threads,
+        'timeout': args.timeout,
+        'graceful_timeout': args.graceful_timeout,
+        'preload_app': args.preload,
+        'accesslog': '-'
+    }
+    logger.info(f"Starting {workers} workers x {tf_threads} inference threads on {cores} cores")
+    FaceAuthApplication(args.app, options, tf_threads, pin_cpus=args.pin_cpus).run()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    main()
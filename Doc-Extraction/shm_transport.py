@@ -0,0 +1,437 @@
+import os
+import time
+import queue
+import atexit
+import logging
+import itertools
+import threading
+import multiprocessing
+from multiprocessing import shared_memory
+from multiprocessing.connection import wait
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+
+import numpy as np
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+WORKER_PREFIX = 'inference-'
+
+
+def in_worker():
+    """True inside an inference process; spawn names the process before importing modules"""
+    return multiprocessing.current_process().name.startswith(WORKER_PREFIX)
+
+
+# Detection and embedding run in this many separate processes holding the
+# models; 0 keeps inference in the serving process
+INFERENCE_PROCESSES = 0 if in_worker() else int(os.environ.get('FACE_INFERENCE_PROCESSES', '0'))
+# Each in-flight request holds one slot for its input and results
+SLOTS = int(os.environ.get('FACE_SHM_SLOTS', str(4 * max(1, INFERENCE_PROCESSES))))
+SLOT_BYTES = int(float(os.environ.get('FACE_SHM_SLOT_MB', '16')) * 1024 * 1024)
+# Seconds to wait for a free slot, and for an inference process to answer
+TIMEOUT = float(os.environ.get('FACE_INFERENCE_TIMEOUT', '60'))
+ALIGNMENT = 64
+# An inference process that exits is restarted after RESTART_DELAY seconds,
+# doubling per consecutive failure up to RESTART_MAX_DELAY; failures count
+# as consecutive unless the process ran for RESTART_RESET seconds, and a
+# process is given up on after RESTART_LIMIT of them
+RESTART_DELAY = float(os.environ.get('FACE_INFERENCE_RESTART_DELAY', '1'))
+RESTART_MAX_DELAY = 60.0
+RESTART_RESET = 300.0
+RESTART_LIMIT = int(os.environ.get('FACE_INFERENCE_RESTART_LIMIT', '5'))
+
+spilled = metrics.Counter(
+    'face_shm_spilled_total', 'Arrays too large for a shared memory slot, pickled instead', ('op',)
+)
+restarts = metrics.Counter(
+    'face_inference_restarts_total', 'Inference processes restarted after exiting', ('process',)
+)
+
+
+def pack(buffer, arrays, start=0):
+    """
+    Copy arrays into buffer one after another from start.
+    Returns their descriptors and the end offset. A descriptor is
+    (offset, shape, dtype); arrays that do not fit are returned as
+    themselves, to be pickled with the message.
+    """
+    descriptors, offset = [], start
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        begin = -(-offset // ALIGNMENT) * ALIGNMENT
+        if array.dtype.hasobject or begin + array.nbytes > len(buffer):
+            descriptors.append(array)
+            continue
+        np.ndarray(array.shape, array.dtype, buffer=buffer, offset=begin)[...] = array
+        descriptors.append((begin, array.shape, array.dtype.str))
+        offset = begin + array.nbytes
+    return descriptors, offset
+
+
+def view(buffer, descriptor):
+    """Array described by pack, backed by the buffer itself"""
+    if isinstance(descriptor, np.ndarray):
+        return descriptor
+    offset, shape, dtype = descriptor
+    return np.ndarray(shape, np.dtype(dtype), buffer=buffer, offset=offset)
+
+
+def _spills(descriptors):
+    return sum(isinstance(descriptor, np.ndarray) for descriptor in descriptors)
+
+
+def _embed(pipeline, inputs, model_name):
+    return [np.asarray(pipeline.forward_batch(model_name, inputs), dtype=np.float32)], None
+
+
+def _detect(pipeline, inputs, detector_backend, localize_portrait):
+    faces = pipeline.detect_faces(inputs[0], detector_backend, localize_portrait=localize_portrait)
+    # Crops travel through the slot; the rest of each face is small
+    return [face.pop('face') for face in faces], faces
+
+
+OPERATIONS = {'embed': _embed, 'detect': _detect}
+
+
+def _serve(name, slot_bytes, requests, responses):
+    """
+    Inference process loop: read inputs in place from the slot named by each
+    request, write results after them and answer with their descriptors on
+    this process's own response pipe
+    """
+    import pipeline
+    import registry
+
+    memory = shared_memory.SharedMemory(name=name)
+    registry.preload_models()
+    logger.info(f"{multiprocessing.current_process().name} ready")
+    while True:
+        message = requests.get()
+        if message is None:
+            break
+        request_id, slot, end, op, args, descriptors = message
+        buffer = memory.buf[slot * slot_bytes:(slot + 1) * slot_bytes]
+        inputs = arrays = None
+        try:
+            inputs = [view(buffer, descriptor) for descriptor in descriptors]
+            arrays, extra = OPERATIONS[op](pipeline, inputs, *args)
+            result = (pack(buffer, arrays, end)[0], extra)
+            responses.send((request_id, slot, result, None))
+        except Exception as e:
+            logger.error(f"Inference {op} failed: {str(e)}")
+            responses.send((request_id, slot, None, str(e) or type(e).__name__))
+        # Views into the slot must not outlive the request
+        del buffer, inputs, arrays
+
+
+class InferencePool:
+    """
+    Inference processes fed through a ring of shared memory slots.
+    A request copies its arrays (a decoded image, or a batch of face crops)
+    into a free slot and sends only their offsets, shapes and dtypes; the
+    process reads them in place and writes its results into the same slot.
+    The slot goes back to the ring once the caller has copied the results
+    out. Nothing larger than a descriptor is pickled between processes.
+    Each process has its own request queue and response pipe, so the pool
+    knows which requests a process holds and a dying process cannot wedge
+    the others' answers: when one exits, its requests fail, their slots
+    return to the ring and it is restarted after a backoff. A process that
+    keeps failing is retired after RESTART_LIMIT restarts in a row.
+    """
+
+    def __init__(self, processes=INFERENCE_PROCESSES, slots=SLOTS, slot_bytes=SLOT_BYTES):
+        # TensorFlow is not fork-safe, so workers start from a fresh interpreter
+        self._context = multiprocessing.get_context('spawn')
+        self.pid = os.getpid()
+        self.slots = slots
+        self.slot_bytes = slot_bytes
+        self.restarts = 0
+        self._memory = shared_memory.SharedMemory(create=True, size=slots * slot_bytes)
+        self._free = queue.Queue()
+        for slot in range(slots):
+            self._free.put(slot)
+        # request_id -> (future, process index, slot); callers that timed out
+        # leave (process index, slot) in _abandoned until the answer arrives
+        self._pending = {}
+        self._abandoned = {}
+        self._load = [0] * processes
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self._closed = False
+
+        # Per process: request queue, process, parent end of its response
+        # pipe, start time, consecutive failures and pending restart time.
+        # A process is None while it waits for a restart, or once retired
+        self._queues = [None] * processes
+        self._processes = [None] * processes
+        self._readers = [None] * processes
+        self._started = [0.0] * processes
+        self._failures = [0] * processes
+        self._restart_at = [None] * processes
+        self._retired = set()
+        for index in range(processes):
+            self._queues[index] = self._context.Queue()
+            self._start(index)
+        threading.Thread(target=self._dispatch, name='inference-results', daemon=True).start()
+        atexit.register(self.close)
+        logger.info(f"Started {processes} inference processes with {slots} x {slot_bytes // (1024 * 1024)}MB slots")
+
+    def _start(self, index):
+        reader, writer = self._context.Pipe(duplex=False)
+        process = self._context.Process(
+            target=_serve,
+            args=(self._memory.name, self.slot_bytes, self._queues[index], writer),
+            name=f"{WORKER_PREFIX}{index}",
+            daemon=True
+        )
+        process.start()
+        # Only the child writes, so its exit closes the pipe
+        writer.close()
+        self._processes[index], self._readers[index] = process, reader
+        self._started[index] = time.monotonic()
+        self._restart_at[index] = None
+
+    def _dispatch(self):
+        """Deliver answers, notice processes that exit and restart them when their backoff is over"""
+        while not self._closed:
+            with self._lock:
+                workers = [
+                    (index, process, self._readers[index])
+                    for index, process in enumerate(self._processes) if process is not None
+                ]
+                due = [at for at in self._restart_at if at is not None]
+            timeout = max(0.0, min(due) - time.monotonic()) if due else 1.0
+            ready = wait(
+                [reader for _, _, reader in workers] + [process.sentinel for _, process, _ in workers],
+                timeout=min(1.0, timeout)
+            )
+            for index, process, reader in workers:
+                if reader in ready:
+                    self._receive(reader)
+                if process.sentinel in ready:
+                    self._replace(index, process, reader)
+            self._restart_due()
+
+    def _receive(self, reader):
+        """Deliver one answer from a response pipe; False once the pipe is closed"""
+        try:
+            request_id, slot, result, error = reader.recv()
+        except (EOFError, OSError):  # The process exited; its sentinel says so too
+            return False
+        with self._lock:
+            entry = self._pending.pop(request_id, None)
+            abandoned = self._abandoned.pop(request_id, None)
+            if entry is not None:
+                self._load[entry[1]] -= 1
+            if abandoned is not None:
+                self._load[abandoned[0]] -= 1
+        if entry is not None:
+            entry[0].set_result((result, error))
+        elif abandoned is not None:
+            # The caller timed out; the slot is only safe to reuse now
+            self._free.put(slot)
+        return True
+
+    def _replace(self, index, process, reader):
+        """Fail what an exited process held and schedule its restart, or retire it"""
+        process.join(timeout=1)
+        # Answers sent before the exit are still delivered
+        while reader.poll() and self._receive(reader):
+            pass
+        reader.close()
+        message = f"Inference process {process.name} exited with code {process.exitcode}"
+
+        with self._lock:
+            if self._closed or self._processes[index] is not process:
+                return
+            self._processes[index] = None
+            if time.monotonic() - self._started[index] > RESTART_RESET:
+                self._failures[index] = 0
+            self._failures[index] += 1
+            if self._failures[index] > RESTART_LIMIT:
+                self._retired.add(index)
+            else:
+                delay = min(RESTART_MAX_DELAY, RESTART_DELAY * 2 ** (self._failures[index] - 1))
+                self._restart_at[index] = time.monotonic() + delay
+            failed, reclaimed = self._release(index)
+            # Requests still queued for the dead process are failed above
+            self._queues[index].cancel_join_thread()
+            self._queues[index].close()
+            self._queues[index] = self._context.Queue()
+
+        if index in self._retired:
+            logger.error(f"{message}; failed {len(failed)} requests and gave up after {RESTART_LIMIT} restarts")
+        else:
+            logger.error(f"{message}; failed {len(failed)} requests, restarting it in {delay:.1f}s")
+        self._finish(failed, reclaimed, message)
+
+    def _release(self, index):
+        """Take the requests held by a process out of the books; call with the lock held"""
+        lost = [request_id for request_id, entry in self._pending.items() if entry[1] == index]
+        failed = [self._pending.pop(request_id)[0] for request_id in lost]
+        lost = [request_id for request_id, entry in self._abandoned.items() if entry[0] == index]
+        reclaimed = [self._abandoned.pop(request_id)[1] for request_id in lost]
+        self._load[index] = 0
+        return failed, reclaimed
+
+    def _finish(self, failed, reclaimed, message):
+        for slot in reclaimed:
+            self._free.put(slot)
+        for future in failed:
+            # The caller returns the slot to the ring
+            future.set_result((None, message))
+
+    def _restart_due(self):
+        now = time.monotonic()
+        with self._lock:
+            for index, at in enumerate(self._restart_at):
+                if at is None or at > now or self._closed:
+                    continue
+                self._start(index)
+                self.restarts += 1
+                restarts.inc((self._processes[index].name,))
+                # Requests that waited out the backoff in its queue are now served
+                logger.info(f"Restarted inference process {self._processes[index].name}")
+
+    def _call(self, op, args, arrays, copy):
+        """Run op on arrays in an inference process; copy(buffer, result) copies results out of the slot"""
+        try:
+            slot = self._free.get(timeout=TIMEOUT)
+        except queue.Empty:
+            raise RuntimeError("No shared memory slot free for inference") from None
+
+        release = True
+        buffer = self._memory.buf[slot * self.slot_bytes:(slot + 1) * self.slot_bytes]
+        try:
+            descriptors, end = pack(buffer, arrays)
+            if _spills(descriptors):
+                spilled.inc((op,), _spills(descriptors))
+
+            future = Future()
+            request_id = next(self._ids)
+            with self._lock:
+                candidates = [index for index in range(len(self._load)) if index not in self._retired]
+                if not candidates:
+                    raise RuntimeError("Every inference process failed to restart")
+                # The least busy process; a restarting one queues requests until it is back
+                index = min(candidates, key=self._load.__getitem__)
+                self._load[index] += 1
+                self._pending[request_id] = (future, index, slot)
+                self._queues[index].put((request_id, slot, end, op, args, descriptors))
+            try:
+                result, error = future.result(timeout=TIMEOUT)
+            except FutureTimeout:
+                with self._lock:
+                    entry = self._pending.pop(request_id, None)
+                    if entry is not None:
+                        # Still owned by the inference process until its answer arrives
+                        self._abandoned[request_id] = (entry[1], slot)
+                        release = False
+                raise RuntimeError(f"Inference {op} timed out after {TIMEOUT}s") from None
+            if error:
+                raise RuntimeError(error)
+            return copy(buffer, result)
+        finally:
+            if release:
+                self._free.put(slot)
+
+    def embed(self, model_name, faces):
+        """Embeddings of face crops, computed in one forward pass of an inference process"""
+        if not faces:
+            return []
+
+        def copy(buffer, result):
+            descriptors, _ = result
+            return list(np.array(view(buffer, descriptors[0])))
+
+        # prepare_batch works in float32 anyway, so crops cross at half the size
+        crops = [np.asarray(face, dtype=np.float32) for face in faces]
+        return self._call('embed', (model_name,), crops, copy)
+
+    def detect(self, img, detector_backend, localize_portrait=False):
+        """detect_faces on a decoded image, run in an inference process"""
+        def copy(buffer, result):
+            descriptors, faces = result
+            if _spills(descriptors):
+                spilled.inc(('detect',), _spills(descriptors))
+            for face, descriptor in zip(faces, descriptors):
+                face['face'] = np.array(view(buffer, descriptor))
+            return faces
+
+        return self._call('detect', (detector_backend, localize_portrait), [img], copy)
+
+    def stats(self):
+        return {
+            "processes": len(self._processes),
+            "alive": sum(process is not None and process.is_alive() for process in self._processes),
+            "restarts": self.restarts,
+            "retired": len(self._retired),
+            "slots": self.slots,
+            "free_slots": self._free.qsize(),
+            "slot_mb": round(self.slot_bytes / (1024 * 1024), 1)
+        }
+
+    def close(self):
+        if self._closed or self.pid != os.getpid():
+            return
+        with self._lock:
+            self._closed = True
+            failed, reclaimed = [], []
+            for index in range(len(self._processes)):
+                lost, slots = self._release(index)
+                failed += lost
+                reclaimed += slots
+        self._finish(failed, reclaimed, "Inference pool closed")
+        for requests, process in zip(self._queues, self._processes):
+            if process is not None:
+                requests.put(None)
+        for process in self._processes:
+            if process is None:
+                continue
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+        try:
+            self._memory.close()
+        except BufferError:  # A request still holds a view of its slot
+            pass
+        self._memory.unlink()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def pool():
+    """
+    The inference pool of this process, started on first use.
+    A worker forked from a process that already started one (serve.py
+    --preload) starts its own, as the result thread does not survive fork.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool.pid != os.getpid():
+            _pool = InferencePool()
+        return _pool
+
+
+def embed(model_name, faces):
+    return pool().embed(model_name, faces)
+
+
+def detect(img, detector_backend, localize_portrait=False):
+    return pool().detect(img, detector_backend, localize_portrait)
+
+
+def stats():
+    """Pool statistics, or None when inference runs in this process"""
+    return pool().stats() if INFERENCE_PROCESSES else None
+
+
+if INFERENCE_PROCESSES:
+    metrics.register(
+        'face_shm_free_slots', 'Shared memory slots free for inference requests',
+        lambda: {(): _pool.stats()["free_slots"] if _pool else SLOTS}
+    )
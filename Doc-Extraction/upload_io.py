@@ -0,0 +1,90 @@
+import io
+import os
+import queue
+import logging
+import threading
+
+from flask import Request
+
+import metrics
+import pipeline
+
+logger = logging.getLogger(__name__)
+
+# Pending archival writes; when full, new writes are dropped rather than
+# blocking the request thread
+ARCHIVE_QUEUE_SIZE = 256
+
+
+class InMemoryRequest(Request):
+    """
+    Request class that keeps multipart file parts in memory.
+    Werkzeug spools parts above 500KB to temporary files; uploads are already
+    capped by MAX_CONTENT_LENGTH, so buffering them in memory is bounded.
+    """
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return io.BytesIO()
+
+
+def read_upload(file_storage):
+    """
+    Read an uploaded file straight from the request buffer.
+    The image header is checked here so unreadable uploads fail fast;
+    pixels are decoded later, at the resolution detection needs.
+    """
+    with metrics.stage('upload_read'):
+        data = file_storage.read()
+        pipeline.image_header(data)
+    return data
+
+
+def write_file(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+class ArchiveWriter:
+    """
+    Optional asynchronous sink that persists uploads off the request path.
+    Writes are queued and handed to sink(target, data) by a single daemon
+    thread; the default sink writes data to the file path target.
+    """
+
+    def __init__(self, maxsize=ARCHIVE_QUEUE_SIZE, sink=write_file):
+        self._sink = sink
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="archive-writer", daemon=True)
+                self._thread.start()
+
+    def submit(self, target, data):
+        """Queue bytes to be archived under target; returns False if the write was dropped"""
+        with metrics.stage('archive'):
+            self._ensure_started()
+            try:
+                self._queue.put_nowait((target, data))
+                return True
+            except queue.Full:
+                logger.warning(f"Archive queue full, dropping write to {target}")
+                return False
+
+    def _run(self):
+        while True:
+            target, data = self._queue.get()
+            try:
+                self._sink(target, data)
+            except Exception as e:
+                logger.error(f"Failed to archive upload to {target}: {str(e)}")
+            finally:
+                self._queue.task_done()
+
+    def flush(self):
+        """Block until every queued write has been handled"""
+        self._queue.join()
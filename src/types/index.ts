@@ -14,6 +14,22 @@ export interface FaceData {
 export interface DetectionResponse {
   faces_detected: number;
   faces: FaceData[];
+  timings?: StageTiming[];
+}
+
+export interface StageTiming {
+  stage: string;
+  ms: number;
+  model?: string;
+  detector?: string;
+}
+
+export interface CascadeStage {
+  model: string;
+  distance: number;
+  threshold: number;
+  verified: boolean;
+  confident: boolean;
 }
 
 export interface VerificationResponse {
@@ -24,6 +40,39 @@ export interface VerificationResponse {
   threshold: number;
   match: boolean;
   model_used: string;
+  cascade?: CascadeStage[];
+  document_fields?: DocumentFields;
+  timings?: StageTiming[];
+}
+
+export interface DocumentFields {
+  name?: string | null;
+  dob?: string | null;
+  gender?: string | null;
+  aadhaar_number?: string | null;
+  confidence?: number;
+  error?: string;
+}
+
+export interface FrameReport {
+  decoded: number;
+  blurry: number;
+  duplicate: number;
+  no_face: number;
+  distances: number[];
+  early_exit: boolean;
+  frames_used: number;
+}
+
+export interface StreamVerificationResponse {
+  verified: boolean;
+  similarity: number;
+  threshold: number;
+  match: boolean;
+  model_used: string;
+  document_analysis: DetectionResponse;
+  frames: FrameReport;
+  timings?: StageTiming[];
 }
 
 export interface Model {
@@ -31,9 +80,23 @@ export interface Model {
   isDefault: boolean;
 }
 
+export interface LoadedModel {
+  kind: 'model' | 'detector' | 'ocr';
+  backend?: string;
+  loaded: boolean;
+  load_seconds?: number;
+  warmup_seconds?: number;
+  memory_mb: number;
+  parameters?: number;
+  error?: string;
+}
+
 export interface ModelsResponse {
   available_models: string[];
   default_model: string;
+  cascade_models?: string[];
+  loaded_models?: { [key: string]: LoadedModel };
+  worker_profile?: 'full' | 'detect';
 }
 
 export interface ApiResponse {